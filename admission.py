@@ -0,0 +1,79 @@
+import threading
+import time
+
+# 正在登录的连接数达到上限时,再次检查的间隔(秒)
+PENDING_RETRY_INTERVAL = 0.05
+
+
+class AdmissionControl(object):
+    """
+    登录准入控制:断网恢复后大量设备同时重连时,令牌桶限制每秒开始登录的连接数(rate,最多攒burst个),
+    同时正在登录的连接数不超过max_pending,超出的连接在内核的等待队列(线程模式)或暂停读取(异步模式)中排队;
+    同一IP未登录的连接数不超过max_per_ip,超出的新连接直接断开;各项为0时不限制
+    """
+
+    def __init__(self, rate=0, burst=0, max_pending=0, max_per_ip=0):
+        self.lock = threading.Lock()
+        self.set_limits(rate, burst, max_pending, max_per_ip)
+        self.tokens = self.burst
+        self.last_time = time.monotonic()
+        # 正在登录的连接数
+        self.pending = 0
+        # 每个IP未登录的连接数 ip -> 个数
+        self.ip_counts = {}
+
+    # 修改限制,修改后立即生效
+    def set_limits(self, rate, burst, max_pending, max_per_ip):
+        with self.lock:
+            self.rate = rate
+            self.burst = max(burst, 1)
+            self.max_pending = max_pending
+            self.max_per_ip = max_per_ip
+
+    # 按经过的时间补充令牌,调用前需持有锁
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+
+    # 距离可以开始下一个登录的秒数,0为现在就可以
+    def wait_time(self):
+        with self.lock:
+            if self.max_pending and self.pending >= self.max_pending:
+                return PENDING_RETRY_INTERVAL
+            if not self.rate:
+                return 0
+            self.refill(time.monotonic())
+            if self.tokens >= 1:
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    # 开始处理一个连接的登录:消耗一个令牌,正在登录的连接数加1
+    def start(self):
+        with self.lock:
+            if self.rate:
+                self.refill(time.monotonic())
+                self.tokens -= 1
+            self.pending += 1
+
+    # 连接登录成功或断开
+    def finish(self):
+        with self.lock:
+            self.pending -= 1
+
+    # 新连接:记录来源IP,同一IP未登录的连接数已经达到上限时返回False
+    def open(self, ip):
+        with self.lock:
+            count = self.ip_counts.get(ip, 0)
+            if self.max_per_ip and count >= self.max_per_ip:
+                return False
+            self.ip_counts[ip] = count + 1
+            return True
+
+    # 来自ip的连接登录成功或断开
+    def close(self, ip):
+        with self.lock:
+            count = self.ip_counts.get(ip, 0) - 1
+            if count > 0:
+                self.ip_counts[ip] = count
+            else:
+                self.ip_counts.pop(ip, None)
@@ -0,0 +1,81 @@
+import logging
+import sqlite3
+import threading
+import time
+
+from databases.DB import get_pool
+
+logger = logging.getLogger(__name__)
+
+# 修改后需要重启才能生效的配置项
+RESTART_REQUIRED = ('tcpMode', 'tcpWorkers', 'tcpMaxDeviceId', 'tcpSplice', 'offlineSpoolDir', 'presenceFlushInterval',
+                    'logFile', 'logMaxBytes', 'logBackupCount', 'logRateLimit', 'logLevel', 'webPort',
+                    'configPollInterval', 'handoffSocket')
+
+
+class ConfigStore(object):
+    """
+    config表在内存中的副本,name -> value
+    web管理页面修改配置后调用reload,其他程序直接修改数据库时由watch启动的线程发现:
+    轮询SQLite的data_version,其他连接提交过修改时才重新读取config表,只把值有变化的配置项通知给监听者
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        self.values = {}
+        # 修改后的回调函数,参数为值有变化的配置项名称集合
+        self.listeners = []
+        self.watching = False
+        self.reload()
+
+    # 读取配置项,不存在时返回默认值
+    def get(self, name, default=None):
+        return self.values.get(name, default)
+
+    # 从数据库重新加载config表,返回值有变化的配置项名称集合
+    def reload(self):
+        # 读取和替换在同一个锁中,web页面和轮询线程同时reload时先读到的旧数据不会覆盖后读到的新数据;
+        # 监听者在锁外调用,可以在回调中读取配置或调用watch
+        with self.lock:
+            with get_pool(self.db_file).connection() as conn:
+                values = dict(conn.execute('SELECT name, value FROM config').fetchall())
+            changed = {name for name in values.keys() | self.values.keys()
+                       if values.get(name) != self.values.get(name)}
+            self.values = values
+        if changed and self.listeners:
+            restart = sorted(changed.intersection(RESTART_REQUIRED))
+            if restart:
+                logger.warning('配置项 %s 已修改,需要重启才能生效', ', '.join(restart))
+            for listener in self.listeners:
+                try:
+                    listener(changed)
+                except Exception as e:
+                    logger.exception('应用配置修改失败:%s', e)
+        return changed
+
+    # 注册修改后的回调函数
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    # 启动轮询线程,interval为轮询间隔(秒),0为不轮询;多次调用只启动一个线程
+    def watch(self, interval=1.0):
+        with self.lock:
+            if self.watching or interval <= 0:
+                return
+            self.watching = True
+        threading.Thread(target=self.run, args=(interval,), daemon=True).start()
+
+    def run(self, interval):
+        # data_version只在其他连接提交修改后变化,所以使用独立的连接
+        conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        data_version = None
+        while True:
+            try:
+                version = conn.execute('PRAGMA data_version').fetchone()[0]
+                if version != data_version:
+                    data_version = version
+                    self.reload()
+            except sqlite3.Error as e:
+                logger.warning('读取配置失败:%s', e)
+            time.sleep(interval)
@@ -0,0 +1,114 @@
+import hashlib
+import hmac
+import threading
+
+from databases.DB import get_pool
+
+
+class CredentialIndex(object):
+    """
+    设备登录信息索引,(protocol, username) -> (device_id, 密码哈希),
+    以及登录后要用到的设备选项 device_id -> (合并发送字节数, 合并发送等待微秒数, TCP选项)
+    和设备限速 device_id -> (每秒字节数, 每秒消息数)
+    启动时从devices表加载一次,web管理页面修改设备后同步更新,
+    设备登录时只查一次内存中的字典,不再扫描整张devices表
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        # 写操作加锁,读操作直接读字典
+        self.lock = threading.Lock()
+        self.index = {}
+        # device_id -> (protocol, username),修改/删除设备时找到旧的索引项
+        self.keys = {}
+        self.options = {}
+        # 只保存有限速的设备
+        self.limits = {}
+        # 修改后的回调函数,参数为新版本号
+        self.version = 0
+        self.listeners = []
+        self.reload()
+
+    # 从数据库重新加载全部设备;读取和替换都在锁内,读取期间set_device()等修改不会被旧数据覆盖
+    def reload(self):
+        with self.lock:
+            with get_pool(self.db_file).connection() as conn:
+                rows = conn.execute('SELECT id, protocol, username, password, coalesce_bytes, coalesce_delay, '
+                                    'tcp_mode, rate_bytes, rate_messages FROM devices').fetchall()
+            index = {}
+            keys = {}
+            options = {}
+            limits = {}
+            for device_id, protocol, username, password, coalesce_bytes, coalesce_delay, tcp_mode, rate_bytes, \
+                    rate_messages in rows:
+                index[(protocol, username)] = (device_id, self.hash_password(password))
+                keys[device_id] = (protocol, username)
+                options[device_id] = (coalesce_bytes or 0, coalesce_delay or 0, tcp_mode or '')
+                if rate_bytes or rate_messages:
+                    limits[device_id] = (rate_bytes or 0, rate_messages or 0)
+            self.index = index
+            self.keys = keys
+            self.options = options
+            self.limits = limits
+            self.changed()
+
+    # 新增或修改设备
+    def set_device(self, device_id, protocol, username, password, coalesce_bytes=0, coalesce_delay=0, tcp_mode='',
+                   rate_bytes=0, rate_messages=0):
+        with self.lock:
+            key = self.keys.pop(device_id, None)
+            if key is not None:
+                self.index.pop(key, None)
+            self.index[(protocol, username)] = (device_id, self.hash_password(password))
+            self.keys[device_id] = (protocol, username)
+            self.options[device_id] = (coalesce_bytes, coalesce_delay, tcp_mode)
+            if rate_bytes or rate_messages:
+                self.limits[device_id] = (rate_bytes, rate_messages)
+            else:
+                self.limits.pop(device_id, None)
+            self.changed()
+
+    # 删除设备
+    def remove_device(self, device_id):
+        with self.lock:
+            key = self.keys.pop(device_id, None)
+            if key is not None:
+                self.index.pop(key, None)
+            self.options.pop(device_id, None)
+            self.limits.pop(device_id, None)
+            self.changed()
+
+    def changed(self):
+        self.version += 1
+        for listener in self.listeners:
+            listener(self.version)
+
+    # 注册修改后的回调函数
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    # 获取设备选项 (合并发送字节数, 合并发送等待微秒数, TCP选项)
+    def get_options(self, device_id):
+        return self.options.get(device_id, (0, 0, ''))
+
+    # 获取设备限速 (每秒字节数, 每秒消息数),0为不限制
+    def get_limits(self, device_id):
+        return self.limits.get(device_id, (0, 0))
+
+    @staticmethod
+    def hash_password(password):
+        return hashlib.sha256((password or '').encode()).digest()
+
+    # 查找设备,返回(设备ID, 密码哈希),不存在时返回None
+    def lookup(self, protocol, username):
+        return self.index.get((protocol, username))
+
+    # 验证用户名和密码,成功返回设备ID,失败返回None
+    def verify(self, protocol, username, password):
+        entry = self.index.get((protocol, username))
+        if entry is None:
+            return None
+        device_id, password_hash = entry
+        if not hmac.compare_digest(password_hash, self.hash_password(password)):
+            return None
+        return device_id
@@ -1,89 +1,205 @@
+import contextlib
 import hashlib
+import os
+import queue
 import sqlite3
+import threading
+
+# 默认数据库文件,与本文件在同一目录,不受启动时工作目录的影响
+DEFAULT_DB_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cfg.sqlite3')
+
+
+class ConnectionPool(object):
+    """
+    SQLite连接池,web管理页面和TCP/UDP服务器共用
+    连接数量有上限,连接重复使用,sqlite3模块在每个连接上缓存预编译的SQL语句,
+    使用WAL日志模式,读数据库不会阻塞写数据库
+    """
+
+    def __init__(self, db_file, size=8):
+        self.db_file = db_file
+        # 空闲连接,后放回的先取出
+        self.idle = queue.LifoQueue()
+        self.semaphore = threading.BoundedSemaphore(size)
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_file, check_same_thread=False, cached_statements=256)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    # 从连接池取出一个连接,正常结束时提交,发生异常时回滚,用完放回连接池
+    @contextlib.contextmanager
+    def connection(self):
+        self.semaphore.acquire()
+        try:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                conn = self.connect()
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                self.idle.put(conn)
+        finally:
+            self.semaphore.release()
+
+
+# 数据库文件路径 -> 连接池,同一个进程中访问同一个数据库的地方共用一个连接池
+pools = {}
+pools_lock = threading.Lock()
+
+
+def get_pool(db_file=DEFAULT_DB_FILE):
+    db_file = os.path.abspath(db_file)
+    with pools_lock:
+        pool = pools.get(db_file)
+        if pool is None:
+            pool = pools[db_file] = ConnectionPool(db_file)
+        return pool
+
+
+# 多进程模式下子进程不能使用父进程的连接
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=pools.clear)
 
 
 class DB:
-    def __init__(self, db_file):
-        self.conn = sqlite3.connect(db_file, check_same_thread=False)
-        self.cursor = self.conn.cursor()
+    def __init__(self, db_file=DEFAULT_DB_FILE):
+        self.pool = get_pool(db_file)
 
     def initConfigTable(self):
-        # 创建设备表
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS devices (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                note TEXT,  -- 新增备注字段
-                protocol TEXT,
-                username TEXT,
-                password TEXT,
-                online INTEGER DEFAULT 0
-            )
-        ''')
-
-        # 创建透传列表表
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS passthrough (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                device_a_id INTEGER,
-                device_b_id INTEGER,
-                FOREIGN KEY (device_a_id) REFERENCES devices (id),
-                FOREIGN KEY (device_b_id) REFERENCES devices (id)
-            )
-        ''')
-
-        # 创建配置表
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS config (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT,
-                value TEXT
-            )
-        ''')
+        with self.pool.connection() as conn:
+            # 创建设备表
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS devices (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    note TEXT,  -- 新增备注字段
+                    protocol TEXT,
+                    username TEXT,
+                    password TEXT,
+                    online INTEGER DEFAULT 0,
+                    coalesce_bytes INTEGER DEFAULT 0,  -- 合并发送:攒够多少字节立即发送
+                    coalesce_delay INTEGER DEFAULT 0,  -- 合并发送:最多等待多少微秒,0为不合并
+                    tcp_mode TEXT DEFAULT '',  -- nodelay/cork
+                    rate_bytes INTEGER DEFAULT 0,  -- 限速:设备每秒最多发送多少字节,0为不限制
+                    rate_messages INTEGER DEFAULT 0  -- 限速:设备每秒最多发送多少条消息,0为不限制
+                )
+            ''')
+
+            # 创建透传列表表
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS passthrough (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    device_a_id INTEGER,
+                    device_b_id INTEGER,
+                    source_prefix INTEGER DEFAULT 0,  -- 转发时是否添加来源设备ID帧头
+                    offline_buffer INTEGER DEFAULT 0,  -- 目标设备不在线时是否缓存数据,上线后补发
+                    rate_bytes INTEGER DEFAULT 0,  -- 限速:透传组每秒最多转发多少字节,0为不限制
+                    rate_messages INTEGER DEFAULT 0,  -- 限速:透传组每秒最多转发多少条消息,0为不限制
+                    FOREIGN KEY (device_a_id) REFERENCES devices (id),
+                    FOREIGN KEY (device_b_id) REFERENCES devices (id)
+                )
+            ''')
+
+            # 创建配置表
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS config (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT,
+                    value TEXT
+                )
+            ''')
+
+        # 升级旧版本数据库,补上新增的字段
+        self.add_column('passthrough', 'source_prefix', 'INTEGER DEFAULT 0')
+        self.add_column('passthrough', 'offline_buffer', 'INTEGER DEFAULT 0')
+        self.add_column('devices', 'coalesce_bytes', 'INTEGER DEFAULT 0')
+        self.add_column('devices', 'coalesce_delay', 'INTEGER DEFAULT 0')
+        self.add_column('devices', 'tcp_mode', "TEXT DEFAULT ''")
+        self.add_column('devices', 'rate_bytes', 'INTEGER DEFAULT 0')
+        self.add_column('devices', 'rate_messages', 'INTEGER DEFAULT 0')
+        self.add_column('passthrough', 'rate_bytes', 'INTEGER DEFAULT 0')
+        self.add_column('passthrough', 'rate_messages', 'INTEGER DEFAULT 0')
+
+        with self.pool.connection() as conn:
+            # 按用户名查找设备时使用索引
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_devices_username ON devices (username)')
+            # 按在线状态/协议筛选设备并按ID分页时使用索引
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_devices_online ON devices (online, id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_devices_protocol ON devices (protocol, id)')
+            # 按设备查找透传组时使用索引
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_passthrough_device_a ON passthrough (device_a_id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_passthrough_device_b ON passthrough (device_b_id)')
+
+    # 表中没有该字段时新增字段
+    def add_column(self, table, column, definition):
+        with self.pool.connection() as conn:
+            if column not in [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]:
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
 
     # 插入默认配置项
     def insert_default_config(self, name, default_value):
-        self.cursor.execute('SELECT value FROM config WHERE name=?', (name,))
-        value = self.cursor.fetchone()
-        if value:
-            return value[0]
-        else:
-            self.cursor.execute('INSERT INTO config (name, value) VALUES (?, ?)', (name, default_value))
-            self.conn.commit()
+        with self.pool.connection() as conn:
+            value = conn.execute('SELECT value FROM config WHERE name=?', (name,)).fetchone()
+            if value:
+                return value[0]
+            conn.execute('INSERT INTO config (name, value) VALUES (?, ?)', (name, default_value))
             return default_value
 
     def insert(self, table, data):
         cols = ','.join(data.keys())
         vals = ','.join(['?'] * len(data))
         sql = f'INSERT INTO {table} ({cols}) VALUES ({vals})'
-        self.cursor.execute(sql, tuple(data.values()))
-        self.conn.commit()
+        with self.pool.connection() as conn:
+            # 返回新插入行的ID
+            return conn.execute(sql, tuple(data.values())).lastrowid
 
-    def delete(self, table, condition):
+    # condition中可以使用?占位符,参数放在params中,相同的SQL语句可以重复使用
+    def delete(self, table, condition, params=()):
         sql = f'DELETE FROM {table} WHERE {condition}'
-        self.cursor.execute(sql)
-        self.conn.commit()
+        with self.pool.connection() as conn:
+            conn.execute(sql, params)
 
-    def update(self, table, data, condition):
+    def update(self, table, data, condition, params=()):
         sql = f'UPDATE {table} SET {",".join([f"{k}=?" for k in data])} WHERE {condition}'
-        values = tuple(data.values())
-        self.cursor.execute(sql, values)
-        self.conn.commit()
+        values = tuple(data.values()) + tuple(params)
+        with self.pool.connection() as conn:
+            conn.execute(sql, values)
 
-    def select(self, table, fields='*', condition=None):
+    def select(self, table, fields='*', condition=None, params=()):
         if condition is None:
             sql = f'SELECT {fields} FROM {table}'
         else:
             sql = f'SELECT {fields} FROM {table} WHERE {condition}'
-        self.cursor.execute(sql)
-        return self.cursor.fetchall()
-
-    def executeSql(self, sql):
-        self.cursor.execute(sql)
-        return self.cursor.fetchall()
-
-    def close(self):
-        self.cursor.close()
-        self.conn.close()
+        with self.pool.connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def executeSql(self, sql, params=()):
+        with self.pool.connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    # 键集分页:sql以"id > ? ORDER BY id LIMIT ?"结尾且第一列为id,从after之后开始每次读batch_size行,
+    # 逐批返回,下一批从上一批最后一行的id继续;每批单独从连接池取连接,不会一次读出整张表,
+    # 也不会在调用方处理数据期间一直占用连接;limit为0时读到最后
+    def iterateSql(self, sql, params=(), after=0, limit=0, batch_size=500):
+        remaining = limit
+        while True:
+            size = min(batch_size, remaining) if limit else batch_size
+            rows = self.executeSql(sql, tuple(params) + (after, size))
+            if rows:
+                yield rows
+            if len(rows) < size:
+                return
+            after = rows[-1][0]
+            if limit:
+                remaining -= len(rows)
+                if not remaining:
+                    return
 
 
 def test():
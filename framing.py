@@ -0,0 +1,129 @@
+import struct
+
+# 帧头:魔数(1字节) + 帧类型(1字节) + 数据长度(4字节),网络字节序
+FRAME_HEADER = struct.Struct('!BBI')
+# 帧协议第一个字节固定为魔数,文本登录包以"username:"开头,据此区分两种协议
+FRAME_MAGIC = 0xA5
+
+# 帧类型
+# 登录帧,数据为 username:xxx.password:xxx
+LOGIN = 1
+# 透传数据帧,一帧对应目标设备收到的一帧
+DATA = 2
+# 心跳帧,没有数据
+HEARTBEAT = 3
+# 应答帧,登录成功后服务器发送 loginSuccess
+ACK = 4
+# 加密模式的挑战帧,服务器收到 username:xxx.cipher:设备随机数 的登录帧后发送,数据为服务器随机数
+CHALLENGE = 5
+# 加密模式的认证帧,设备用会话密钥计算的应答
+AUTH = 6
+
+# 单帧数据的最大长度
+MAX_FRAME_SIZE = 16777216
+
+# 接收缓冲区的初始大小
+INITIAL_BUFFER_SIZE = 4096
+
+
+class FrameError(ValueError):
+    pass
+
+
+def pack_frame(frame_type, payload=b''):
+    return FRAME_HEADER.pack(FRAME_MAGIC, frame_type, len(payload)) + payload
+
+
+class FrameReader(object):
+    """
+    帧协议的接收缓冲区,socket直接recv_into到空闲部分,每次收到数据后取出所有完整的帧,
+    一次接收可以包含多个帧,一个帧也可以分多次接收;
+    已处理的数据不立即移动,空闲部分用完时才把剩下的半帧移到开头,帧比缓冲区大时扩大缓冲区;
+    缓冲区从INITIAL_BUFFER_SIZE开始,连续收满时逐步扩大到size,为大帧扩大或数据变少后,
+    缓冲区中的数据处理完时缩回初始大小,空闲的连接只占用很小的缓冲区
+    """
+
+    def __init__(self, size=65536):
+        # 连续接收时缓冲区的最大大小
+        self.size = max(size, FRAME_HEADER.size)
+        self.initial_size = min(INITIAL_BUFFER_SIZE, self.size)
+        self.buffer = bytearray(self.initial_size)
+        self.view = memoryview(self.buffer)
+        # 未处理数据的起止位置
+        self.start = 0
+        self.end = 0
+        # 最近一次写入的字节数,以及这次写入是否填满了缓冲区
+        self.last_written = 0
+        self.filled = False
+
+    # 返回可以写入数据的缓冲区
+    def get_buffer(self):
+        size = len(self.buffer)
+        # 上次接收填满了缓冲区,数据较多时扩大缓冲区,减少接收次数
+        if self.filled and size < self.size:
+            self.filled = False
+            self.reserve(min(size * 2, self.size))
+        elif self.end == size:
+            self.reserve(size)
+        return self.view[self.end:]
+
+    # 已经写入nbytes字节
+    def written(self, nbytes):
+        self.end += nbytes
+        self.last_written = nbytes
+        self.filled = self.end == len(self.buffer)
+
+    # 复制数据到缓冲区
+    def feed(self, data):
+        size = len(data)
+        if self.end + size > len(self.buffer):
+            self.reserve(self.end - self.start + size)
+        self.view[self.end:self.end + size] = data
+        self.end += size
+        self.last_written = size
+
+    # 把未处理的数据移到开头,保证缓冲区至少能放下size字节;不超过size时扩大到正好size字节,否则至少扩大一倍
+    def reserve(self, size):
+        pending = self.end - self.start
+        if size > len(self.buffer):
+            buffer = bytearray(size if size <= self.size else max(size, len(self.buffer) * 2))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        elif self.start:
+            self.view[:pending] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+    # 数据处理完后,缓冲区为大帧扩大过或最近一次接收不到四分之一时缩回初始大小
+    def shrink(self):
+        size = len(self.buffer)
+        if size > self.initial_size and (size > self.size or self.last_written < size // 4):
+            self.buffer = bytearray(self.initial_size)
+            self.view = memoryview(self.buffer)
+
+    # 还没有处理的数据
+    def get_pending(self):
+        return bytes(self.view[self.start:self.end])
+
+    # 取出一个完整的帧(帧类型, 数据),数据不完整时返回None
+    def next_frame(self):
+        if self.end - self.start < FRAME_HEADER.size:
+            return None
+        magic, frame_type, length = FRAME_HEADER.unpack_from(self.buffer, self.start)
+        if magic != FRAME_MAGIC:
+            raise FrameError(f'帧头错误 {magic:#x}')
+        if length > MAX_FRAME_SIZE:
+            raise FrameError(f'帧长度 {length} 超过上限')
+        frame_end = self.start + FRAME_HEADER.size + length
+        if frame_end > self.end:
+            # 缓冲区放不下这一帧时提前扩大
+            if FRAME_HEADER.size + length > len(self.buffer):
+                self.reserve(FRAME_HEADER.size + length)
+            return None
+        payload = bytes(self.view[self.start + FRAME_HEADER.size:frame_end])
+        self.start = frame_end
+        if self.start == self.end:
+            self.start = self.end = 0
+            self.shrink()
+        return frame_type, payload
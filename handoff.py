@@ -0,0 +1,191 @@
+import logging
+import os
+import pickle
+import socket
+import struct
+import threading
+
+from log import stop_logging
+
+logger = logging.getLogger(__name__)
+
+# 消息头:消息长度(4字节),消息为pickle序列化的字典,文件描述符随消息头一起发送(SCM_RIGHTS)
+HEADER = struct.Struct('!I')
+# 每条消息最多携带的文件描述符个数,内核限制为253
+MAX_FDS = 200
+# 新进程等待旧进程退出的最长时间(秒),旧进程退出后才能监听web管理端口
+EXIT_TIMEOUT = 30
+
+
+# 当前系统是否支持平滑重启:需要Unix域socket和socket.send_fds(Python 3.9+,Windows不支持)
+def is_supported():
+    return hasattr(socket, 'AF_UNIX') and hasattr(socket, 'send_fds')
+
+
+# 发送一条消息,fds中的文件描述符在新进程中得到副本
+def send_message(sock, message, fds=()):
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    data = HEADER.pack(len(data)) + data
+    sent = socket.send_fds(sock, [data], list(fds))
+    if sent < len(data):
+        sock.sendall(memoryview(data)[sent:])
+
+
+# 接收一条消息,返回(消息, 文件描述符列表),对方断开时返回(None, [])
+def recv_message(sock):
+    header, fds, _, _ = socket.recv_fds(sock, HEADER.size, MAX_FDS)
+    if not header:
+        return None, []
+    header += recv_exactly(sock, HEADER.size - len(header))
+    # 按长度读取,不会读到下一条消息,下一条消息的文件描述符不会丢失
+    return pickle.loads(recv_exactly(sock, HEADER.unpack(header)[0])), fds
+
+
+def recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError('对方已断开')
+        data += chunk
+    return bytes(data)
+
+
+class HandoffServer(object):
+    """
+    运行中的进程:在Unix域socket上等待新启动的进程,依次交出监听socket、设备连接、离线缓存和UDP会话,
+    交接完成后退出;新进程先接受连接,旧进程再停止接受,部署时设备不需要重新登录
+    """
+
+    def __init__(self, path, tcp_server, udp_server):
+        self.path = path
+        self.tcp_server = tcp_server
+        self.udp_server = udp_server
+        self.sock = None
+
+    def start(self):
+        if not is_supported():
+            logger.warning('当前系统不支持平滑重启')
+            return
+        # 没有进程在监听的socket文件是上次运行留下的
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # 只有运行服务器的用户可以连接
+        umask = os.umask(0o177)
+        try:
+            self.sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        self.sock.listen(1)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            conn, _ = self.sock.accept()
+            try:
+                hello, _ = recv_message(conn)
+            except (OSError, EOFError, pickle.UnpicklingError) as e:
+                logger.warning('平滑重启连接错误:%s', e)
+                hello = None
+            if hello is None:
+                conn.close()
+                continue
+            # 开始交接后不再恢复服务,出错时新进程已经在接受连接
+            try:
+                self.hand_off(conn, hello)
+            except (OSError, EOFError) as e:
+                logger.error('平滑重启交接失败:%s', e)
+            logger.info('已交给新进程 %s,退出', hello['pid'])
+            # 在线状态已由新进程负责,不再执行退出时写入数据库等清理
+            stop_logging()
+            os._exit(0)
+
+    def hand_off(self, conn, hello):
+        logger.info('新进程 %s 开始接管', hello['pid'])
+        # UDP先停止接收,会话表不再变化
+        udp_sessions = self.udp_server.stop_serving()
+        listeners = self.tcp_server.get_listeners() + [('udp', self.udp_server.server_socket)]
+        send_message(conn, {'names': [name for name, _ in listeners], 'udp_sessions': udp_sessions},
+                     [server_socket.fileno() for _, server_socket in listeners])
+        # 新进程已经在接受连接,旧进程停止接受
+        self.tcp_server.stop_accepting()
+        devices = self.tcp_server.detach_devices(hello['adopt_devices'])
+        try:
+            for start in range(0, len(devices), MAX_FDS):
+                batch = devices[start:start + MAX_FDS]
+                send_message(conn, {'devices': [state for _, state in batch]}, [fd for fd, _ in batch])
+        finally:
+            for fd, _ in devices:
+                os.close(fd)
+        logger.info('已交出 %s 个设备连接', len(devices))
+        for device_id, messages in self.tcp_server.take_offline().items():
+            send_message(conn, {'offline': device_id, 'messages': messages})
+        send_message(conn, {'done': True})
+
+
+class HandoffClient(object):
+    """
+    新启动的进程:从旧进程接管监听socket后启动服务器,再接管设备连接、离线缓存和UDP会话
+    """
+
+    def __init__(self, sock, tcp_server, udp_server):
+        self.sock = sock
+        self.tcp_server = tcp_server
+        self.udp_server = udp_server
+
+    # 在服务器启动前调用:接管监听socket和UDP会话,服务器启动时使用接管的socket,不重新绑定端口
+    def receive_listeners(self):
+        send_message(self.sock, {'pid': os.getpid(), 'adopt_devices': self.tcp_server.can_adopt_devices})
+        message, fds = recv_message(self.sock)
+        if message is None:
+            raise EOFError('旧进程已断开')
+        for name, fd in zip(message['names'], fds):
+            server_socket = socket.socket(fileno=fd)
+            server = self.udp_server if name == 'udp' else self.tcp_server
+            server.inherited[server_socket.getsockname()[1]] = server_socket
+        self.udp_server.adopt_sessions(message['udp_sessions'])
+        self.tcp_server.takeover = self.udp_server.takeover = True
+
+    # 在服务器启动后调用:接管设备连接和离线缓存,等待旧进程退出
+    def receive_state(self):
+        # 端口已经修改时,接管的旧端口不再使用
+        for server in (self.tcp_server, self.udp_server):
+            for server_socket in server.inherited.values():
+                server_socket.close()
+            server.inherited.clear()
+        adopted = 0
+        try:
+            while True:
+                message, fds = recv_message(self.sock)
+                if message is None or 'done' in message:
+                    break
+                if 'offline' in message:
+                    self.tcp_server.adopt_offline(message['offline'], message['messages'])
+                    continue
+                for fd, state in zip(fds, message['devices']):
+                    self.tcp_server.adopt_device(socket.socket(fileno=fd), state)
+                adopted += len(fds)
+        except (OSError, EOFError) as e:
+            logger.error('接管设备连接失败:%s', e)
+        self.tcp_server.finish_takeover()
+        logger.info('已从旧进程接管 %s 个设备连接', adopted)
+        self.sock.settimeout(EXIT_TIMEOUT)
+        try:
+            self.sock.recv(1)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+# 连接正在运行的旧进程,没有旧进程时返回None
+def connect_handoff(path, tcp_server, udp_server):
+    if not path or not is_supported():
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return HandoffClient(sock, tcp_server, udp_server)
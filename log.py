@@ -0,0 +1,135 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+from tools import Tools
+
+# 日志文件默认放在程序目录下的logs目录中,相对路径以程序目录为准
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_LOG_FILE = 'logs/translucent.log'
+
+# 当前的日志设置,多进程模式下工作进程按这个设置重新启动写日志线程
+settings = {}
+listener = None
+
+
+class TimeFormatter(logging.Formatter):
+    """
+    日志时间格式与原来print的一致,同一秒内的日期时间只格式化一次
+    """
+
+    def __init__(self, fmt):
+        super().__init__(fmt)
+        self.tools = Tools()
+
+    def formatTime(self, record, datefmt=None):
+        return self.tools.format_time(record.created)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    只把日志记录放入队列,格式化和写文件都在写日志线程中进行,转发线程不做字符串格式化
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class ThrottledLogger(object):
+    """
+    按key限制输出频率,同一个key每interval秒最多输出一条,
+    期间被抑制的条数附在下一条日志后面,用于每包数据都可能触发的日志(如目标设备不在线)
+    """
+
+    # 默认间隔,由setup_logging按logRateLimit配置项设置
+    interval = 1.0
+
+    def __init__(self, logger):
+        self.logger = logger
+        # 多个线程同时输出日志,检查和更新状态时加锁
+        self.lock = threading.Lock()
+        # key -> [上次输出时间, 被抑制的条数]
+        self.states = {}
+        # 下次清理过期状态的时间
+        self.prune_time = 0
+
+    def log(self, key, level, msg, *args):
+        if not self.logger.isEnabledFor(level):
+            return
+        now = time.monotonic()
+        with self.lock:
+            if now >= self.prune_time:
+                self.prune(now)
+            state = self.states.get(key)
+            if state is not None and now - state[0] < self.interval:
+                state[1] += 1
+                return
+            if state is not None and state[1]:
+                msg += '(期间抑制了 %d 条相同日志)'
+                args += (state[1],)
+            self.states[key] = [now, 0]
+        self.logger.log(level, msg, *args)
+
+    # 每interval秒删除一次已经超过间隔的状态,key中有设备地址等不断变化的值,不清理会越来越多;调用前需持有锁
+    def prune(self, now):
+        self.states = {key: state for key, state in self.states.items() if now - state[0] < self.interval}
+        self.prune_time = now + self.interval
+
+    def info(self, key, msg, *args):
+        self.log(key, logging.INFO, msg, *args)
+
+    def warning(self, key, msg, *args):
+        self.log(key, logging.WARNING, msg, *args)
+
+
+# 配置日志:记录只在调用线程入队,由一个写日志线程输出到控制台和按大小轮转的日志文件
+def setup_logging(level='INFO', path=DEFAULT_LOG_FILE, max_bytes=10485760, backup_count=5, rate_limit=1.0):
+    global listener
+    settings.update(level=level, path=path, max_bytes=max_bytes, backup_count=backup_count, rate_limit=rate_limit)
+    ThrottledLogger.interval = rate_limit
+
+    formatter = TimeFormatter('%(asctime)s:%(message)s')
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if path:
+        path = os.path.join(BASE_DIR, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handlers.append(logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count,
+                                                             encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, DeferredQueueHandler):
+            root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    root.setLevel(level.upper())
+
+    # fork出来的子进程中原来的写日志线程已经不存在,不需要停止
+    if listener is None:
+        atexit.register(stop_logging)
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+
+
+# 多进程模式的工作进程按主进程的设置写自己的日志文件,避免多个进程轮转同一个文件
+def setup_worker_logging(worker, options):
+    if not options:
+        return
+    options = dict(options)
+    if options['path']:
+        root, ext = os.path.splitext(options['path'])
+        options['path'] = f'{root}-worker{worker}{ext}'
+    setup_logging(**options)
+
+
+# 进程退出前写完队列中的日志
+def stop_logging():
+    if listener is not None and listener._thread is not None:
+        listener.stop()
@@ -1,21 +1,96 @@
-from flask import Flask, request, Response
+from flask import Flask, request, Response, jsonify
 import hashlib
+import json
+import os
+import socket
 from functools import wraps
-from tcp.tcp_server import TCPServer
+from tcpModule import TCPServer
+from tcpAsyncModule import AsyncTCPServer
+from tcpClusterModule import TCPCluster
+from udpModule import UDPServer
 from flask import render_template
-from databases.DB import DB
+from databases.DB import DB, DEFAULT_DB_FILE
+from routing import RoutingTable
+from config_store import ConfigStore
+from credentials import CredentialIndex
+from handoff import HandoffServer, connect_handoff
+from log import BASE_DIR, setup_logging
+from metrics import MetricsRegistry, build_status, render_prometheus
+from provisioning import ValidationError, parse_records, import_devices, import_passthrough, export_rows
 
 app = Flask(__name__, template_folder='templates')
 # 设置数据库位置
-db_file = "./databases/cfg.sqlite3"
+db_file = DEFAULT_DB_FILE
 # 数据处理对象
 db = DB(db_file)
 # 初始化配置表，存在会自动掠过
 db.initConfigTable()
 # 从config表中读取tcpPort配置项，默认为12346
 tcp_port = db.insert_default_config('tcpPort', '12346')
+# 从config表中读取tcpMode配置项,thread为线程模式,async为异步事件循环模式,默认为thread
+tcp_mode = db.insert_default_config('tcpMode', 'thread')
+# 从config表中读取tcpWorkers配置项,大于1时启动多个进程共同监听tcpPort(需要系统支持SO_REUSEPORT),默认为1
+tcp_workers = int(db.insert_default_config('tcpWorkers', '1'))
+# 从config表中读取tcpMaxDeviceId配置项,多进程模式共享注册表能容纳的最大设备ID,默认为1048576
+tcp_max_device_id = db.insert_default_config('tcpMaxDeviceId', '1048576')
+# 从config表中读取tcpBufferSize配置项,一对一透传组每次接收的最大字节数,默认为65536
+tcp_buffer_size = db.insert_default_config('tcpBufferSize', '65536')
+# 从config表中读取tcpSplice配置项,1为一对一透传组使用splice转发(仅Linux线程模式),默认为0
+tcp_splice = db.insert_default_config('tcpSplice', '0')
+# 从config表中读取tcpBacklog配置项,TCP监听队列长度(受系统somaxconn限制),默认为1024
+tcp_backlog = db.insert_default_config('tcpBacklog', '1024')
+# 从config表中读取loginRate配置项,每秒最多开始登录的连接数,0为不限制,默认为1000
+login_rate = db.insert_default_config('loginRate', '1000')
+# 从config表中读取loginBurst配置项,短时间内最多连续开始登录的连接数,默认为2000
+login_burst = db.insert_default_config('loginBurst', '2000')
+# 从config表中读取loginMaxPending配置项,同时正在登录的最大连接数,0为不限制,默认为1024
+login_max_pending = db.insert_default_config('loginMaxPending', '1024')
+# 从config表中读取loginMaxPerIp配置项,同一IP未登录的最大连接数,0为不限制,默认为0
+login_max_per_ip = db.insert_default_config('loginMaxPerIp', '0')
+# 从config表中读取loginTimeout配置项,连接后超过该秒数没有登录就断开,0为不限制,默认为10
+login_timeout = db.insert_default_config('loginTimeout', '10')
+# 从config表中读取sendQueueSize配置项,每个目标设备发送队列的最大字节数,默认为1048576
+send_queue_size = db.insert_default_config('sendQueueSize', '1048576')
+# 从config表中读取sendQueuePolicy配置项,发送队列满时的策略:drop_oldest/drop_newest/pause/disconnect,默认为pause
+send_queue_policy = db.insert_default_config('sendQueuePolicy', 'pause')
+# 从config表中读取heartbeatInterval配置项,心跳包间隔(秒),0为不发送,默认为0.5
+heartbeat_interval = db.insert_default_config('heartbeatInterval', '0.5')
+# 从config表中读取idleTimeout配置项,设备空闲超时(秒),0为不限制,默认为0
+idle_timeout = db.insert_default_config('idleTimeout', '0')
+# 从config表中读取presenceFlushInterval配置项,设备在线状态批量写入数据库的间隔(秒),默认为1
+presence_flush_interval = db.insert_default_config('presenceFlushInterval', '1')
+# 从config表中读取tlsPort配置项,TLS监听端口(仅异步模式和多进程模式),0为不启用,默认为0
+tls_port = db.insert_default_config('tlsPort', '0')
+# 从config表中读取tlsCertFile配置项,TLS证书文件(PEM),默认为空
+tls_cert_file = db.insert_default_config('tlsCertFile', '')
+# 从config表中读取tlsKeyFile配置项,TLS私钥文件(PEM),为空时从证书文件中读取,默认为空
+tls_key_file = db.insert_default_config('tlsKeyFile', '')
+# 从config表中读取offlineSpoolDir配置项,离线缓存落盘文件的目录(相对路径以程序目录为准),默认为spool
+offline_spool_dir = db.insert_default_config('offlineSpoolDir', 'spool')
+# 从config表中读取offlineMemorySize配置项,每个离线设备在内存中缓存的字节数,超过后写入落盘文件,默认为65536
+offline_memory_size = db.insert_default_config('offlineMemorySize', '65536')
+# 从config表中读取offlineMaxBytes配置项,每个离线设备最多缓存的字节数,默认为16777216
+offline_max_bytes = db.insert_default_config('offlineMaxBytes', '16777216')
+# 从config表中读取offlineMaxMessages配置项,每个离线设备最多缓存的数据包数,默认为10000
+offline_max_messages = db.insert_default_config('offlineMaxMessages', '10000')
+# 从config表中读取offlineTTL配置项,离线缓存数据的有效期(秒),默认为60
+offline_ttl = db.insert_default_config('offlineTTL', '60')
 # 从config表中读取udpPort配置项，默认为12347
 udp_port = db.insert_default_config('udpPort', '12347')
+# 从config表中读取udpSessionTimeout配置项,UDP设备超过该秒数没有数据视为离线,默认为60
+udp_session_timeout = db.insert_default_config('udpSessionTimeout', '60')
+# 从config表中读取udpBatchSize配置项,UDP每次可读时最多连续接收的数据包数,默认为64
+udp_batch_size = db.insert_default_config('udpBatchSize', '64')
+# 从config表中读取logLevel配置项,日志级别DEBUG/INFO/WARNING/ERROR,默认为INFO
+log_level = db.insert_default_config('logLevel', 'INFO')
+# 从config表中读取logFile配置项,日志文件位置(相对路径以程序目录为准),为空时只输出到控制台,默认为logs/translucent.log
+log_file = db.insert_default_config('logFile', 'logs/translucent.log')
+# 从config表中读取logMaxBytes配置项,日志文件超过该字节数后轮转,默认为10485760
+log_max_bytes = db.insert_default_config('logMaxBytes', '10485760')
+# 从config表中读取logBackupCount配置项,保留的旧日志文件个数,默认为5
+log_backup_count = db.insert_default_config('logBackupCount', '5')
+# 从config表中读取logRateLimit配置项,同一设备的同一种日志(如目标设备不在线)最少间隔秒数,默认为1
+log_rate_limit = db.insert_default_config('logRateLimit', '1')
 # 从config表中读取webPort配置项，默认为12345
 web_port = db.insert_default_config('webPort', '12345')
 # 从config表中读取webUser配置项，默认为admin
@@ -24,6 +99,68 @@ web_user = db.insert_default_config('webUser', 'admin')
 web_password = db.insert_default_config('webPassword', 'admin')
 # 计算webPassword的哈希值
 password_hash = hashlib.sha256(web_password.encode()).hexdigest()
+# 从config表中读取configPollInterval配置项,检查数据库中配置修改的间隔(秒),0为只在web管理页面修改时生效,默认为1
+config_poll_interval = db.insert_default_config('configPollInterval', '1')
+# 从config表中读取handoffSocket配置项,平滑重启使用的Unix域socket文件,相对路径以程序目录为准,为空时不启用,默认为handoff.sock
+handoff_socket = db.insert_default_config('handoffSocket', 'handoff.sock')
+# 配置项,与TCP/UDP服务器共用,修改配置后不用重启
+config_store = ConfigStore(db_file)
+# 透传路由表,与TCP服务器共用,修改透传组后同步更新
+routing_table = RoutingTable(db_file)
+# 设备登录信息索引,与TCP/UDP服务器共用,修改设备后同步更新
+credential_index = CredentialIndex(db_file)
+# 转发统计,与TCP/UDP服务器共用,通过/metrics和/api/status查看
+metrics_registry = MetricsRegistry()
+
+
+# 列表每页默认的条数
+PAGE_SIZE = 100
+# 设备列表接口返回的字段,不返回密码
+DEVICE_FIELDS = ('id', 'note', 'protocol', 'username', 'online', 'coalesce_bytes', 'coalesce_delay', 'tcp_mode',
+                 'rate_bytes', 'rate_messages')
+# 透传组列表接口返回的字段
+PASSTHROUGH_FIELDS = ('id', 'device_a_id', 'device_b_id', 'source_prefix', 'offline_buffer', 'rate_bytes',
+                      'rate_messages', 'device_a_note', 'device_b_note')
+
+
+# 读取键集分页参数:after为上一页最后一条的ID,limit为每页条数,0为全部
+def get_page_args():
+    after = request.args.get('after', 0, type=int)
+    limit = request.args.get('limit', PAGE_SIZE, type=int)
+    return max(after, 0), max(limit, 0)
+
+
+# 下一页的after参数,没有下一页时为None
+def get_next_after(rows, limit):
+    if limit and len(rows) == limit:
+        return rows[-1][0]
+    return None
+
+
+# 以JSON格式逐批输出列表,不在内存中拼出整个响应;next为下一页的after参数,没有下一页时为null
+def stream_json(name, fields, batches, limit):
+    def generate():
+        yield f'{{"{name}": ['
+        count = 0
+        last_id = None
+        for rows in batches:
+            yield (',' if count else '') + ','.join(json.dumps(dict(zip(fields, row)), ensure_ascii=False)
+                                                    for row in rows)
+            count += len(rows)
+            last_id = rows[-1][0]
+        yield f'], "next": {json.dumps(last_id if limit and count == limit else None)}}}'
+    return Response(generate(), mimetype='application/json')
+
+
+# 修改web账号密码后立即生效,webPort需要重启
+def on_config_change(names):
+    global web_user, password_hash
+    if names & {'webUser', 'webPassword'}:
+        web_user = config_store.get('webUser', 'admin')
+        password_hash = hashlib.sha256(config_store.get('webPassword', 'admin').encode()).hexdigest()
+
+
+config_store.add_listener(on_config_change)
 
 
 # 身份验证装饰器
@@ -49,8 +186,10 @@ def index():
 @app.route('/devices')
 @authenticate
 def devices():
-    devices = db.select('devices')
-    return render_template('devices.html', devices=devices)
+    after, limit = get_page_args()
+    devices = [row for rows in db.iterateSql('SELECT * FROM devices WHERE id > ? ORDER BY id LIMIT ?',
+                                             after=after, limit=limit) for row in rows]
+    return render_template('devices.html', devices=devices, next_after=get_next_after(devices, limit), limit=limit)
 
 
 # 创建设备页面
@@ -62,8 +201,17 @@ def create_device():
         protocol = request.form['protocol']
         username = request.form['username']
         password = request.form['password']
-        data = {'note': note, 'protocol': protocol, 'username': username, 'password': password}
-        db.insert('devices', data)
+        coalesce_bytes = int(request.form.get('coalesce_bytes') or 0)
+        coalesce_delay = int(request.form.get('coalesce_delay') or 0)
+        tcp_mode = request.form.get('tcp_mode', '')
+        rate_bytes = int(request.form.get('rate_bytes') or 0)
+        rate_messages = int(request.form.get('rate_messages') or 0)
+        data = {'note': note, 'protocol': protocol, 'username': username, 'password': password,
+                'coalesce_bytes': coalesce_bytes, 'coalesce_delay': coalesce_delay, 'tcp_mode': tcp_mode,
+                'rate_bytes': rate_bytes, 'rate_messages': rate_messages}
+        device_id = db.insert('devices', data)
+        credential_index.set_device(device_id, protocol, username, password, coalesce_bytes, coalesce_delay, tcp_mode,
+                                    rate_bytes, rate_messages)
         return '设备创建成功！'
     return render_template('create_device.html')
 
@@ -77,13 +225,22 @@ def edit_device(device_id):
         protocol = request.form['protocol']
         username = request.form['username']
         password = request.form['password']
-        data = {'note': note, 'protocol': protocol, 'username': username, 'password': password}
-        condition = f"id={device_id}"
-        db.update('devices', data, condition)
+        coalesce_bytes = int(request.form.get('coalesce_bytes') or 0)
+        coalesce_delay = int(request.form.get('coalesce_delay') or 0)
+        tcp_mode = request.form.get('tcp_mode', '')
+        rate_bytes = int(request.form.get('rate_bytes') or 0)
+        rate_messages = int(request.form.get('rate_messages') or 0)
+        data = {'note': note, 'protocol': protocol, 'username': username, 'password': password,
+                'coalesce_bytes': coalesce_bytes, 'coalesce_delay': coalesce_delay, 'tcp_mode': tcp_mode,
+                'rate_bytes': rate_bytes, 'rate_messages': rate_messages}
+        condition = "id=?"
+        db.update('devices', data, condition, (device_id,))
+        credential_index.set_device(device_id, protocol, username, password, coalesce_bytes, coalesce_delay, tcp_mode,
+                                    rate_bytes, rate_messages)
         return f'设备 {device_id} 修改成功！'
     # 获取设备信息
-    condition = f"id={device_id}"
-    device = db.select('devices', '*', condition)[0]
+    condition = "id=?"
+    device = db.select('devices', '*', condition, (device_id,))[0]
     if not device:
         return '设备不存在！'
     return render_template('edit_device.html', device=device)
@@ -95,15 +252,17 @@ def edit_device(device_id):
 def delete_device(device_id):
     if request.method == 'POST':
         # 删除设备相关的透传组
-        condition = f"device_a_id={device_id} OR device_b_id={device_id}"
-        db.delete('passthrough', condition)
+        condition = "device_a_id=? OR device_b_id=?"
+        db.delete('passthrough', condition, (device_id, device_id))
         # 删除设备
-        condition = f"id={device_id}"
-        db.delete('devices', condition)
+        condition = "id=?"
+        db.delete('devices', condition, (device_id,))
+        routing_table.remove_device(device_id)
+        credential_index.remove_device(device_id)
         return f'设备 {device_id} 删除成功！'
     # 获取设备信息
-    condition = f"id={device_id}"
-    device = db.select('devices', '*', condition)[0]
+    condition = "id=?"
+    device = db.select('devices', '*', condition, (device_id,))[0]
     if not device:
         return '设备不存在！'
     return render_template('delete_device.html', device=device)
@@ -117,9 +276,12 @@ def view_passthrough():
           'd2.note || " (" || d2.username || "—" || d2.password || "—" || d2.protocol || "—" || CASE WHEN d2.online = 1 THEN "在线" ELSE "离线" END || ")" AS device_b_info ' \
           'FROM passthrough p ' \
           'JOIN devices d1 ON p.device_a_id = d1.id ' \
-          'JOIN devices d2 ON p.device_b_id = d2.id'
-    passthrough_list = db.executeSql(sql)
-    return render_template('passthrough.html', passthrough_list=passthrough_list)
+          'JOIN devices d2 ON p.device_b_id = d2.id ' \
+          'WHERE p.id > ? ORDER BY p.id LIMIT ?'
+    after, limit = get_page_args()
+    passthrough_list = [row for rows in db.iterateSql(sql, after=after, limit=limit) for row in rows]
+    return render_template('passthrough.html', passthrough_list=passthrough_list,
+                           next_after=get_next_after(passthrough_list, limit), limit=limit)
 
 
 # 创建透传列表页面
@@ -128,8 +290,14 @@ def create_passthrough():
     if request.method == 'POST':
         device_a_id = request.form['device_a_id']
         device_b_id = request.form['device_b_id']
-        data = {'device_a_id': device_a_id, 'device_b_id': device_b_id}
+        source_prefix = 1 if request.form.get('source_prefix') else 0
+        offline_buffer = 1 if request.form.get('offline_buffer') else 0
+        rate_bytes = int(request.form.get('rate_bytes') or 0)
+        rate_messages = int(request.form.get('rate_messages') or 0)
+        data = {'device_a_id': device_a_id, 'device_b_id': device_b_id, 'source_prefix': source_prefix,
+                'offline_buffer': offline_buffer, 'rate_bytes': rate_bytes, 'rate_messages': rate_messages}
         db.insert('passthrough', data)
+        routing_table.add(int(device_a_id), int(device_b_id), source_prefix, offline_buffer, rate_bytes, rate_messages)
         return '透传列表创建成功！'
     devices = db.select('devices')
     return render_template('create_passthrough.html', devices=devices)
@@ -141,12 +309,18 @@ def edit_passthrough(passthrough_id):
     if request.method == 'POST':
         device_a_id = request.form['device_a_id']
         device_b_id = request.form['device_b_id']
-        data = {'device_a_id': device_a_id, 'device_b_id': device_b_id}
-        condition = f"id={passthrough_id}"
-        db.update('passthrough', data, condition)
+        source_prefix = 1 if request.form.get('source_prefix') else 0
+        offline_buffer = 1 if request.form.get('offline_buffer') else 0
+        rate_bytes = int(request.form.get('rate_bytes') or 0)
+        rate_messages = int(request.form.get('rate_messages') or 0)
+        data = {'device_a_id': device_a_id, 'device_b_id': device_b_id, 'source_prefix': source_prefix,
+                'offline_buffer': offline_buffer, 'rate_bytes': rate_bytes, 'rate_messages': rate_messages}
+        condition = "id=?"
+        db.update('passthrough', data, condition, (passthrough_id,))
+        routing_table.reload()
         return '透传列表修改成功！'
-    condition = f"id={passthrough_id}"
-    passthrough = db.select('passthrough', '*', condition)[0]
+    condition = "id=?"
+    passthrough = db.select('passthrough', '*', condition, (passthrough_id,))[0]
     devices = db.select('devices')
     return render_template('edit_passthrough.html', passthrough_id=passthrough_id, passthrough=passthrough, devices=devices)
 
@@ -154,8 +328,9 @@ def edit_passthrough(passthrough_id):
 # 删除透传列表页面
 @app.route('/passthrough/delete/<int:passthrough_id>')
 def delete_passthrough(passthrough_id):
-    condition = f"id={passthrough_id}"
-    db.delete('passthrough', condition)
+    condition = "id=?"
+    db.delete('passthrough', condition, (passthrough_id,))
+    routing_table.reload()
     return '透传列表删除成功！'
 
 
@@ -176,6 +351,7 @@ def create_config():
         value = request.form['value']
         data = {'name': name, 'value': value}
         db.insert('config', data)
+        config_store.reload()
         return '配置项创建成功！'
     return render_template('create_config.html')
 
@@ -190,12 +366,13 @@ def edit_config(config_id):
         # data = {'value': '12346'}
         # condition = "name='webPort'"
         data = {'name': name, 'value': value}
-        condition = f"id='{config_id}'"
-        db.update('config', data, condition)
+        condition = "id=?"
+        db.update('config', data, condition, (config_id,))
+        config_store.reload()
         return f'配置项 {config_id} 修改成功！'
     # 获取配置项信息
-    condition = f"id={config_id}"
-    config_item = db.select('config', '*', condition)[0]
+    condition = "id=?"
+    config_item = db.select('config', '*', condition, (config_id,))[0]
     if not config_item:
         return '配置项不存在！'
     return render_template('edit_config.html', config_id=config_id, config_item=config_item)
@@ -206,19 +383,172 @@ def edit_config(config_id):
 @authenticate
 def delete_config(config_id):
     if request.method == 'POST':
-        condition = f"id={config_id}"
-        db.delete('config', condition)
+        condition = "id=?"
+        db.delete('config', condition, (config_id,))
+        config_store.reload()
         return f'配置项 {config_id} 删除成功！'
     # 获取配置项信息
-    condition = f"id={config_id}"
-    config_item = db.select('config', '*', condition)[0]
+    condition = "id=?"
+    config_item = db.select('config', '*', condition, (config_id,))[0]
     if not config_item:
         return '配置项不存在！'
     return render_template('delete_config.html', config_id=config_id)
 
 
+# 重新加载配置:直接修改了数据库中的配置后立即生效,不用等待configPollInterval,返回值有变化的配置项
+@app.route('/api/config/reload', methods=['POST'])
+@authenticate
+def api_config_reload():
+    return jsonify({'changed': sorted(config_store.reload())})
+
+
+# Prometheus格式的转发统计
+@app.route('/metrics')
+@authenticate
+def metrics():
+    return Response(render_prometheus(metrics_registry.snapshot()), mimetype='text/plain; version=0.0.4')
+
+
+# JSON格式的运行状态
+@app.route('/api/status')
+@authenticate
+def api_status():
+    return jsonify(build_status(metrics_registry.snapshot(), metrics_registry.start_time))
+
+
+# 设备列表接口:按ID键集分页,可按在线状态(online=0/1)、协议(protocol)筛选,按备注搜索(q)
+@app.route('/api/devices')
+@authenticate
+def api_devices():
+    after, limit = get_page_args()
+    conditions = []
+    params = []
+    if request.args.get('online') in ('0', '1'):
+        conditions.append('online=?')
+        params.append(int(request.args['online']))
+    if request.args.get('protocol'):
+        conditions.append('protocol=?')
+        params.append(request.args['protocol'])
+    if request.args.get('q'):
+        conditions.append("note LIKE ? ESCAPE '\\'")
+        params.append('%' + request.args['q'].replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+    sql = f'SELECT {",".join(DEVICE_FIELDS)} FROM devices WHERE {" AND ".join(conditions + ["id > ?"])} ' \
+          'ORDER BY id LIMIT ?'
+    return stream_json('devices', DEVICE_FIELDS, db.iterateSql(sql, params, after, limit), limit)
+
+
+# 透传组列表接口:按ID键集分页,可按设备ID(device_id,设备A或设备B)筛选
+@app.route('/api/passthrough')
+@authenticate
+def api_passthrough():
+    after, limit = get_page_args()
+    condition = ''
+    params = ()
+    device_id = request.args.get('device_id', type=int)
+    if device_id is not None:
+        condition = '(p.device_a_id=? OR p.device_b_id=?) AND '
+        params = (device_id, device_id)
+    sql = 'SELECT p.id, p.device_a_id, p.device_b_id, p.source_prefix, p.offline_buffer, p.rate_bytes, ' \
+          'p.rate_messages, d1.note, d2.note ' \
+          'FROM passthrough p ' \
+          'LEFT JOIN devices d1 ON p.device_a_id = d1.id ' \
+          'LEFT JOIN devices d2 ON p.device_b_id = d2.id ' \
+          f'WHERE {condition}p.id > ? ORDER BY p.id LIMIT ?'
+    return stream_json('passthrough', PASSTHROUGH_FIELDS, db.iterateSql(sql, params, after, limit), limit)
+
+
+# 导入导出的文件格式:优先用format参数,其次按上传文件的扩展名或Content-Type判断,默认为csv
+def get_import_format(upload=None):
+    fmt = request.args.get('format')
+    if fmt in ('csv', 'json'):
+        return fmt
+    if upload is not None and upload.filename and upload.filename.lower().endswith('.json'):
+        return 'json'
+    if upload is None and request.mimetype == 'application/json':
+        return 'json'
+    return 'csv'
+
+
+# 导入上传的文件(file字段)或请求体,整批在一个事务中写入后调用一次reload刷新缓存,有错误时返回400和每行的错误信息
+def import_upload(import_func, reload):
+    upload = request.files.get('file')
+    data = upload.read() if upload is not None else request.get_data()
+    try:
+        records = parse_records(data, get_import_format(upload))
+        inserted, updated = import_func(db, records)
+    except ValidationError as e:
+        return jsonify({'errors': [{'line': line, 'message': message} for line, message in e.errors]}), 400
+    except ValueError as e:
+        return jsonify({'errors': [{'line': 0, 'message': f'数据格式错误:{e}'}]}), 400
+    reload()
+    return jsonify({'inserted': inserted, 'updated': updated})
+
+
+# 导出为文件下载,逐批读取数据库
+def export_download(table):
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'json'):
+        fmt = 'csv'
+    mimetype = 'application/json' if fmt == 'json' else 'text/csv'
+    return Response(export_rows(db, table, fmt), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={table}.{fmt}'})
+
+
+# 批量导入设备:CSV或JSON,已有设备按ID或(协议, 账号)更新,导入后重新加载一次设备登录信息
+@app.route('/api/devices/import', methods=['POST'])
+@authenticate
+def api_import_devices():
+    return import_upload(import_devices, credential_index.reload)
+
+
+# 批量导入透传组:CSV或JSON,已有透传组按ID或(设备A, 设备B)更新,导入后重新加载一次透传路由表
+@app.route('/api/passthrough/import', methods=['POST'])
+@authenticate
+def api_import_passthrough():
+    return import_upload(import_passthrough, routing_table.reload)
+
+
+# 导出设备(format=csv/json)
+@app.route('/api/devices/export')
+@authenticate
+def api_export_devices():
+    return export_download('devices')
+
+
+# 导出透传组(format=csv/json)
+@app.route('/api/passthrough/export')
+@authenticate
+def api_export_passthrough():
+    return export_download('passthrough')
+
+
 # 运行Flask应用
 if __name__ == '__main__':
-    tcp_server = TCPServer(db_file).start()
+    setup_logging(log_level, log_file, int(log_max_bytes), int(log_backup_count), float(log_rate_limit))
+    if tcp_workers > 1 and hasattr(socket, 'SO_REUSEPORT'):
+        tcp_server = TCPCluster(db_file, routing_table, tcp_workers, credential_index, metrics_registry,
+                                config_store)
+    elif tcp_mode == 'async':
+        tcp_server = AsyncTCPServer(db_file, routing_table, credential_index, metrics_registry, config_store)
+    else:
+        tcp_server = TCPServer(db_file, routing_table, credential_index, metrics_registry, config_store)
+    udp_server = UDPServer(db_file, routing_table, credential_index, metrics_registry, config_store)
+    # 平滑重启:已经有进程在运行时接管它的监听socket、设备连接和在线状态,设备不需要重新登录;
+    # 多进程模式的工作进程可以逐个重启,不使用平滑重启
+    handoff_path = os.path.join(BASE_DIR, handoff_socket) if handoff_socket else ''
+    if isinstance(tcp_server, TCPCluster):
+        handoff_path = ''
+    handoff_client = connect_handoff(handoff_path, tcp_server, udp_server)
+    if handoff_client is not None:
+        handoff_client.receive_listeners()
+    tcp_server.start()
+    udp_server.start()
+    if handoff_client is not None:
+        # 旧进程退出后才能监听web管理端口
+        handoff_client.receive_state()
+    if handoff_path:
+        HandoffServer(handoff_path, tcp_server, udp_server).start()
+    # 其他程序直接修改数据库中的配置后web账号密码也能生效;服务器和多进程模式的工作进程各自检查配置修改
+    config_store.watch(float(config_poll_interval))
     # app.debug = True
     app.run(host='0.0.0.0', port=web_port)
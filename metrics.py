@@ -0,0 +1,245 @@
+import bisect
+import threading
+import time
+
+# 转发延迟直方图各个桶的上限(秒),最后还有一个+Inf桶
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+
+# 每个设备的计数器在列表中的位置,LATENCY_COUNTS之后是直方图每个桶的次数
+BYTES_IN = 0
+MESSAGES_IN = 1
+BYTES_OUT = 2
+MESSAGES_OUT = 3
+DROPPED_MESSAGES = 4
+DROPPED_BYTES = 5
+LOGINS = 6
+LATENCY_SUM = 7
+LATENCY_COUNTS = 8
+DEVICE_FIELDS = ('bytes_in', 'messages_in', 'bytes_out', 'messages_out', 'dropped_messages', 'dropped_bytes',
+                 'logins', 'latency_sum')
+
+# Prometheus指标:(名称, 说明, 类型, 设备统计中的字段)
+DEVICE_METRICS = (
+    ('translucent_device_received_bytes_total', '收到设备的字节数', 'counter', 'bytes_in'),
+    ('translucent_device_received_messages_total', '收到设备的数据包数', 'counter', 'messages_in'),
+    ('translucent_device_sent_bytes_total', '转发给设备的字节数', 'counter', 'bytes_out'),
+    ('translucent_device_sent_messages_total', '转发给设备的数据包数', 'counter', 'messages_out'),
+    ('translucent_device_dropped_messages_total', '发送队列满时丢弃的数据包数', 'counter', 'dropped_messages'),
+    ('translucent_device_dropped_bytes_total', '发送队列满时丢弃的字节数', 'counter', 'dropped_bytes'),
+    ('translucent_device_logins_total', '设备登录次数', 'counter', 'logins'),
+    ('translucent_device_reconnects_total', '设备重新登录次数', 'counter', 'reconnects'),
+    ('translucent_device_queued_bytes', '发送队列中的字节数', 'gauge', 'queued_bytes'),
+    ('translucent_device_queued_messages', '发送队列中的数据包数', 'gauge', 'queued_messages'),
+    ('translucent_device_online', '设备是否在线', 'gauge', 'online'),
+    ('translucent_device_offline_messages', '设备不在线时缓存的数据包数', 'gauge', 'offline_messages'),
+    ('translucent_device_offline_bytes', '设备不在线时缓存的字节数', 'gauge', 'offline_bytes'),
+    ('translucent_device_offline_dropped_messages_total', '离线缓存过期或超过上限丢弃的数据包数', 'counter',
+     'offline_dropped_messages'),
+    ('translucent_device_offline_dropped_bytes_total', '离线缓存过期或超过上限丢弃的字节数', 'counter',
+     'offline_dropped_bytes'),
+    ('translucent_device_offline_replayed_messages_total', '设备上线后补发的数据包数', 'counter',
+     'offline_replayed_messages'),
+)
+
+# 离线缓存的统计字段
+OFFLINE_FIELDS = ('offline_messages', 'offline_bytes', 'offline_dropped_messages', 'offline_dropped_bytes',
+                  'offline_replayed_messages')
+
+
+class MetricsShard(object):
+    """
+    一个线程的计数器,只有这个线程写入,记录时不需要加锁
+    """
+
+    def __init__(self):
+        # device_id -> 计数器列表
+        self.devices = {}
+        # (来源设备ID, 目标设备ID) -> [字节数, 数据包数]
+        self.groups = {}
+
+    def device(self, device_id):
+        counters = self.devices.get(device_id)
+        if counters is None:
+            counters = self.devices[device_id] = [0] * (LATENCY_COUNTS + len(LATENCY_BUCKETS) + 1)
+        return counters
+
+
+class MetricsRegistry(object):
+    """
+    每个设备和透传组的转发统计,每个线程只写自己的分片,转发时不加锁;
+    读取时汇总所有分片,发送队列长度等实时数据由服务器注册的收集函数提供
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        # 注册分片时加锁
+        self.lock = threading.Lock()
+        self.shards = []
+        # 收集函数,返回值与snapshot格式相同
+        self.collectors = []
+        self.start_time = time.time()
+
+    # 当前线程的分片
+    def get_shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.local.shard = MetricsShard()
+            with self.lock:
+                self.shards.append(shard)
+        return shard
+
+    # 收到设备的数据:messages包共size字节,转发耗时seconds秒
+    def record_received(self, device_id, messages, size, seconds):
+        counters = self.get_shard().device(device_id)
+        counters[BYTES_IN] += size
+        counters[MESSAGES_IN] += messages
+        counters[LATENCY_SUM] += seconds
+        counters[LATENCY_COUNTS + bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    # 数据已交给目标设备的发送队列
+    def record_forward(self, device_id, target_device_id, messages, size):
+        shard = self.get_shard()
+        counters = shard.device(target_device_id)
+        counters[BYTES_OUT] += size
+        counters[MESSAGES_OUT] += messages
+        group = shard.groups.get((device_id, target_device_id))
+        if group is None:
+            group = shard.groups[(device_id, target_device_id)] = [0, 0]
+        group[0] += size
+        group[1] += messages
+
+    # 设备断开时记录其发送队列丢弃的数据
+    def record_drops(self, device_id, messages, size):
+        if messages:
+            counters = self.get_shard().device(device_id)
+            counters[DROPPED_MESSAGES] += messages
+            counters[DROPPED_BYTES] += size
+
+    def record_login(self, device_id):
+        self.get_shard().device(device_id)[LOGINS] += 1
+
+    # 添加收集函数
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    # 汇总所有分片和收集函数的数据
+    def snapshot(self):
+        devices = {}
+        groups = {}
+        with self.lock:
+            shards = list(self.shards)
+        for shard in shards:
+            for device_id, counters in list(shard.devices.items()):
+                total = devices.get(device_id)
+                if total is None:
+                    devices[device_id] = list(counters)
+                else:
+                    for index, value in enumerate(counters):
+                        total[index] += value
+            for key, counters in list(shard.groups.items()):
+                total = groups.setdefault(key, [0, 0])
+                total[0] += counters[0]
+                total[1] += counters[1]
+        snapshot = {
+            'devices': {device_id: dict(zip(DEVICE_FIELDS, counters), latency=counters[LATENCY_COUNTS:])
+                        for device_id, counters in devices.items()},
+            'groups': {key: {'bytes': counters[0], 'messages': counters[1]} for key, counters in groups.items()},
+        }
+        for collector in self.collectors:
+            merge_snapshot(snapshot, collector())
+        return snapshot
+
+
+# 把other中的统计加到snapshot中,同一个设备的数值相加
+def merge_snapshot(snapshot, other):
+    for section in ('devices', 'groups'):
+        items = snapshot.setdefault(section, {})
+        for key, values in other.get(section, {}).items():
+            item = items.setdefault(key, {})
+            for name, value in values.items():
+                if isinstance(value, list):
+                    item[name] = [a + b for a, b in zip(item.get(name, [0] * len(value)), value)]
+                else:
+                    item[name] = item.get(name, 0) + value
+    return snapshot
+
+
+# 根据直方图估算分位数,返回所在桶的上限(秒),没有数据或超过最大的桶时返回None
+def latency_quantile(counts, quantile):
+    total = sum(counts)
+    if not total:
+        return None
+    rank = total * quantile
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS, counts):
+        seen += count
+        if seen >= rank:
+            return bound
+    return None
+
+
+# 按Prometheus文本格式输出
+def render_prometheus(snapshot):
+    devices = sorted(snapshot['devices'].items())
+    lines = []
+    for name, help_text, metric_type, field in DEVICE_METRICS:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for device_id, values in devices:
+            if field == 'reconnects':
+                value = max(values.get('logins', 0) - 1, 0)
+            else:
+                value = values.get(field, 0)
+            lines.append(f'{name}{{device="{device_id}"}} {value}')
+
+    name = 'translucent_forward_latency_seconds'
+    lines.append(f'# HELP {name} 收到设备数据到交给所有目标设备发送队列的耗时')
+    lines.append(f'# TYPE {name} histogram')
+    for device_id, values in devices:
+        counts = values.get('latency')
+        if not counts:
+            continue
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{device="{device_id}",le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_sum{{device="{device_id}"}} {values.get("latency_sum", 0)}')
+        lines.append(f'{name}_count{{device="{device_id}"}} {cumulative}')
+
+    groups = sorted(snapshot['groups'].items())
+    for name, help_text, field in (('translucent_group_forwarded_bytes_total', '透传组转发的字节数', 'bytes'),
+                                   ('translucent_group_forwarded_messages_total', '透传组转发的数据包数', 'messages')):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} counter')
+        for (device_id, target_device_id), values in groups:
+            lines.append(f'{name}{{source="{device_id}",target="{target_device_id}"}} {values[field]}')
+
+    lines.append('# HELP translucent_devices_online 在线设备数')
+    lines.append('# TYPE translucent_devices_online gauge')
+    lines.append(f'translucent_devices_online {sum(values.get("online", 0) for _, values in devices)}')
+    return '\n'.join(lines) + '\n'
+
+
+# JSON状态接口的数据
+def build_status(snapshot, start_time):
+    devices = []
+    for device_id, values in sorted(snapshot['devices'].items()):
+        counts = values.get('latency', [])
+        device = {'id': device_id}
+        for field in DEVICE_FIELDS[:-1] + ('queued_bytes', 'queued_messages', 'online') + OFFLINE_FIELDS:
+            device[field] = values.get(field, 0)
+        device['reconnects'] = max(device['logins'] - 1, 0)
+        device['latency_count'] = sum(counts)
+        device['latency_sum'] = values.get('latency_sum', 0)
+        device['latency_p50'] = latency_quantile(counts, 0.5)
+        device['latency_p99'] = latency_quantile(counts, 0.99)
+        devices.append(device)
+    groups = [{'source': device_id, 'target': target_device_id, 'bytes': values['bytes'],
+               'messages': values['messages']}
+              for (device_id, target_device_id), values in sorted(snapshot['groups'].items())]
+    return {
+        'uptime': time.time() - start_time,
+        'devices_online': sum(device['online'] for device in devices),
+        'devices': devices,
+        'groups': groups,
+    }
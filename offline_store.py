@@ -0,0 +1,251 @@
+import collections
+import logging
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# 落盘文件中每条数据的记录头:过期时间(8字节浮点数) + 来源设备ID(4字节) + 数据长度(4字节)
+RECORD_HEADER = struct.Struct('!dII')
+
+# 落盘文件的扩展名,启动时删除上次运行留下的文件
+SPOOL_SUFFIX = '.spool'
+
+
+class OfflineBuffer(object):
+    """
+    一个离线目标设备的缓存:数据先放在内存中,内存部分满了之后,后到的数据交给写盘线程追加写入落盘文件,
+    补发时按内存、落盘文件的顺序取出,与到达顺序一致;超过条数/字节数上限时丢弃最早的数据
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        # 保护下面的缓存状态,入队和丢弃只改内存中的索引,不做磁盘IO
+        self.lock = threading.Lock()
+        # 读写落盘文件时持有,写盘线程和补发不会同时操作文件
+        self.io_lock = threading.Lock()
+        # 内存中的数据 (过期时间, 来源设备ID, 数据)
+        self.memory = collections.deque()
+        self.memory_bytes = 0
+        # 落盘数据的索引 (过期时间, 数据长度),前面的已写入文件,最后len(pending)条还在等待写盘
+        self.spool = collections.deque()
+        self.spool_bytes = 0
+        self.pending = collections.deque()
+        # 文件中第一条未读记录的位置,以及已交给写盘线程的数据写完后的文件长度
+        self.head = 0
+        self.tail = 0
+        # 已经放入写盘队列
+        self.scheduled = False
+        # 统计信息
+        self.dropped_messages = 0
+        self.dropped_bytes = 0
+        self.replayed_messages = 0
+
+    def __len__(self):
+        return len(self.memory) + len(self.spool)
+
+    # 数据入队,返回是否需要通知写盘线程
+    def push(self, device_id, data, expire, store):
+        size = len(data)
+        with self.lock:
+            if self.spool or self.memory_bytes + size > store.memory_size:
+                self.spool.append((expire, size))
+                self.spool_bytes += size
+                self.pending.append((expire, device_id, data))
+                schedule = not self.scheduled
+                self.scheduled = True
+            else:
+                self.memory.append((expire, device_id, data))
+                self.memory_bytes += size
+                schedule = False
+            self.trim(time.monotonic(), store)
+        return schedule
+
+    # 丢弃过期的数据,超过上限时丢弃最早的数据,调用前需持有锁
+    def trim(self, now, store):
+        while self.memory or self.spool:
+            expire = self.memory[0][0] if self.memory else self.spool[0][0]
+            if expire > now and len(self) <= store.max_messages and \
+                    self.memory_bytes + self.spool_bytes <= store.max_bytes:
+                break
+            self.drop_oldest()
+
+    def drop_oldest(self):
+        if self.memory:
+            size = len(self.memory.popleft()[2])
+            self.memory_bytes -= size
+        else:
+            size = self.spool.popleft()[1]
+            self.spool_bytes -= size
+            if len(self.spool) < len(self.pending):
+                # 最早的一条还没有写入文件
+                self.pending.popleft()
+            else:
+                self.head += RECORD_HEADER.size + size
+        self.dropped_messages += 1
+        self.dropped_bytes += size
+
+    # 写盘线程:把等待写盘的数据一次追加写入文件
+    def write(self):
+        with self.io_lock:
+            with self.lock:
+                self.scheduled = False
+                records = self.pending
+                self.pending = collections.deque()
+                # 文件中的记录都已读走或丢弃,从头开始写
+                reset = len(self.spool) == len(records) and self.tail != 0
+                if reset:
+                    self.head = self.tail = 0
+                self.tail += sum(RECORD_HEADER.size + len(data) for _, _, data in records)
+            try:
+                if reset and self.file is not None:
+                    self.file.truncate(0)
+                if not records:
+                    return
+                if self.file is None:
+                    self.file = open(self.path, 'w+b')
+                self.file.seek(0, os.SEEK_END)
+                self.file.writelines([RECORD_HEADER.pack(expire, device_id, len(data)) + data
+                                      for expire, device_id, data in records])
+                self.file.flush()
+            except OSError as e:
+                logger.warning('离线缓存写入 %s 失败:%s,丢弃已落盘的数据', self.path, e)
+                with self.lock:
+                    self.dropped_messages += len(self.spool)
+                    self.dropped_bytes += self.spool_bytes
+                    self.spool.clear()
+                    self.pending.clear()
+                    self.spool_bytes = self.head = self.tail = 0
+
+    # 取出所有未过期的数据 [(来源设备ID, 数据), ...],落盘部分用mmap顺序读取
+    def take(self, now):
+        with self.io_lock:
+            with self.lock:
+                memory, spool, pending, head = self.memory, self.spool, self.pending, self.head
+                self.memory = collections.deque()
+                self.spool = collections.deque()
+                self.pending = collections.deque()
+                self.memory_bytes = self.spool_bytes = self.head = self.tail = 0
+            messages = [(device_id, data) for expire, device_id, data in memory if expire > now]
+            written = len(spool) - len(pending)
+            if written:
+                with mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) as spool_map:
+                    offset = head
+                    for _ in range(written):
+                        expire, device_id, size = RECORD_HEADER.unpack_from(spool_map, offset)
+                        offset += RECORD_HEADER.size
+                        if expire > now:
+                            messages.append((device_id, spool_map[offset:offset + size]))
+                        offset += size
+            if self.file is not None:
+                # 关闭文件,离线设备很多时不占用文件描述符
+                self.file.close()
+                self.file = None
+                os.remove(self.path)
+            messages.extend((device_id, data) for expire, device_id, data in pending if expire > now)
+        with self.lock:
+            self.dropped_messages += len(memory) + len(spool) - len(messages)
+            self.replayed_messages += len(messages)
+        return messages
+
+    def get_stats(self):
+        return {
+            'offline_messages': len(self),
+            'offline_bytes': self.memory_bytes + self.spool_bytes,
+            'offline_dropped_messages': self.dropped_messages,
+            'offline_dropped_bytes': self.dropped_bytes,
+            'offline_replayed_messages': self.replayed_messages,
+        }
+
+
+class OfflineStore(object):
+    """
+    离线缓存:开启了离线缓存的透传组,目标设备不在线时数据按目标设备缓存,设备重新登录后按顺序补发
+    转发线程只把数据放入内存,读写文件由独立的写盘线程完成,不阻塞转发;数据只在本次运行期间有效
+    """
+
+    def __init__(self, directory, memory_size=65536, max_bytes=16777216, max_messages=10000, ttl=60):
+        self.directory = directory
+        # 每个目标设备内存中缓存的字节数,超过后写入落盘文件
+        self.memory_size = memory_size
+        # 每个目标设备最多缓存的字节数和条数,以及数据的有效期(秒)
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # 目标设备ID -> OfflineBuffer
+        self.buffers = {}
+        # 写盘线程要执行的任务:写入等待写盘的数据,或读取落盘的数据
+        self.queue = queue.Queue()
+
+    # 创建目录,删除上次运行留下的落盘文件,启动写盘线程
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        for name in os.listdir(self.directory):
+            if name.endswith(SPOOL_SUFFIX):
+                os.remove(os.path.join(self.directory, name))
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            try:
+                self.queue.get()()
+            except Exception as e:
+                logger.exception('离线缓存读写失败:%s', e)
+
+    def get_buffer(self, device_id):
+        buffer = self.buffers.get(device_id)
+        if buffer is None:
+            with self.lock:
+                buffer = self.buffers.get(device_id)
+                if buffer is None:
+                    path = os.path.join(self.directory, f'{device_id}{SPOOL_SUFFIX}')
+                    buffer = self.buffers[device_id] = OfflineBuffer(path)
+        return buffer
+
+    # 缓存发给离线设备target_device_id的数据
+    def push(self, device_id, target_device_id, data):
+        buffer = self.get_buffer(target_device_id)
+        if buffer.push(device_id, data, time.monotonic() + self.ttl, self):
+            self.queue.put(buffer.write)
+
+    # 取出发给设备的所有未过期数据 [(来源设备ID, 数据), ...]
+    def take(self, target_device_id):
+        buffer = self.buffers.get(target_device_id)
+        if buffer is None or not len(buffer):
+            return []
+        return buffer.take(time.monotonic())
+
+    # 在写盘线程中取出发给设备的缓存数据,然后在写盘线程中调用callback(messages)
+    def take_later(self, target_device_id, callback):
+        self.queue.put(lambda: callback(self.take(target_device_id)))
+
+    # 是否有落盘的数据,有时take要读文件,还可能要等写盘线程写完
+    def is_spooled(self, target_device_id):
+        buffer = self.buffers.get(target_device_id)
+        return buffer is not None and len(buffer.spool) != 0
+
+    # 是否有发给设备的缓存数据
+    def has_messages(self, target_device_id):
+        buffer = self.buffers.get(target_device_id)
+        return buffer is not None and len(buffer) != 0
+
+    # 有缓存数据的目标设备ID
+    def get_buffered_devices(self):
+        return [device_id for device_id, buffer in list(self.buffers.items()) if len(buffer)]
+
+    # 丢弃所有过期的数据
+    def expire(self):
+        now = time.monotonic()
+        for buffer in list(self.buffers.values()):
+            if len(buffer):
+                with buffer.lock:
+                    buffer.trim(now, self)
+
+    def get_stats(self):
+        return {device_id: buffer.get_stats() for device_id, buffer in list(self.buffers.items())}
@@ -0,0 +1,85 @@
+import atexit
+import logging
+import sqlite3
+import threading
+import time
+
+from databases.DB import get_pool
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceRegistry(object):
+    """
+    设备在线状态表,以内存为准,登录/断开不再每次都写数据库,
+    修改过的状态每隔interval秒在一个事务中批量写入devices.online,进程退出时再写一次
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        # 在线设备ID
+        self.online = set()
+        # 还没有写入数据库的状态 device_id -> 0/1
+        self.dirty = {}
+
+    # 启动定时写入线程
+    def start(self, interval=1.0):
+        self.interval = interval
+        threading.Thread(target=self.run, daemon=True).start()
+        atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                logger.warning('在线状态写入数据库失败:%s', e)
+
+    # 将所有协议类型为protocol的设备设置为离线状态
+    def reset(self, protocol):
+        with self.lock:
+            self.online.clear()
+            self.dirty.clear()
+        with get_pool(self.db_file).connection() as conn:
+            conn.execute('UPDATE devices SET online=0 WHERE protocol=?', (protocol,))
+
+    # 平滑重启接管完成后写入数据库:协议类型为protocol的设备中只有本进程中在线的设为在线,
+    # 写完之前其他线程的状态修改等待,不会被这次写入覆盖
+    def sync(self, protocol):
+        with self.lock:
+            self.dirty.clear()
+            with get_pool(self.db_file).connection() as conn:
+                conn.execute('UPDATE devices SET online=0 WHERE protocol=?', (protocol,))
+                conn.executemany('UPDATE devices SET online=1 WHERE id=?', [(device_id,) for device_id in self.online])
+
+    # 更新设备在线状态,1为在线,0为离线
+    def update(self, device_id, status):
+        with self.lock:
+            if status:
+                self.online.add(device_id)
+            else:
+                self.online.discard(device_id)
+            self.dirty[device_id] = status
+
+    def is_online(self, device_id):
+        return device_id in self.online
+
+    # 把修改过的状态写入数据库
+    def flush(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            dirty = self.dirty
+            self.dirty = {}
+        try:
+            with get_pool(self.db_file).connection() as conn:
+                conn.executemany('UPDATE devices SET online=? WHERE id=?',
+                                 [(status, device_id) for device_id, status in dirty.items()])
+        except sqlite3.Error:
+            # 写入失败时放回去,下次再写,期间更新的状态优先
+            with self.lock:
+                for device_id, status in dirty.items():
+                    self.dirty.setdefault(device_id, status)
+            raise
@@ -0,0 +1,284 @@
+import argparse
+import csv
+import io
+import json
+import sys
+
+from databases.DB import DB, DEFAULT_DB_FILE
+
+# 导入导出的字段,id为空时按(protocol, username)匹配已有设备
+DEVICE_COLUMNS = ('id', 'note', 'protocol', 'username', 'password', 'coalesce_bytes', 'coalesce_delay', 'tcp_mode',
+                  'rate_bytes', 'rate_messages')
+# 透传组可以用设备ID或设备账号(device_a_username/device_b_username)指定设备,按(设备A, 设备B)匹配已有透传组
+PASSTHROUGH_COLUMNS = ('id', 'device_a_id', 'device_b_id', 'source_prefix', 'offline_buffer', 'rate_bytes',
+                       'rate_messages')
+
+PROTOCOLS = ('tcpServer', 'udpServer')
+TCP_MODES = ('', 'nodelay', 'cork')
+
+# 分批查询已有设备和透传组时每次查询的个数(SQLite参数个数有上限)
+LOOKUP_BATCH = 500
+
+
+class ValidationError(ValueError):
+    """
+    导入的数据有错误,errors为[(行号, 错误信息), ...],整批数据都不会写入
+    """
+
+    def __init__(self, errors):
+        super().__init__('; '.join(f'第{line}行:{message}' for line, message in errors[:10]))
+        self.errors = errors
+
+
+# 解析上传的数据,返回[dict, ...];fmt为csv或json,json为对象数组
+def parse_records(data, fmt='csv'):
+    if isinstance(data, bytes):
+        data = data.decode('utf-8-sig')
+    if fmt == 'json':
+        records = json.loads(data)
+        if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
+            raise ValidationError([(0, 'JSON应为对象数组')])
+        return records
+    return list(csv.DictReader(io.StringIO(data)))
+
+
+def get_int(record, name, errors, line, default=0):
+    value = record.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        errors.append((line, f'{name}不是整数'))
+        return default
+    if value < 0:
+        errors.append((line, f'{name}不能为负数'))
+    return value
+
+
+def get_text(record, name):
+    value = record.get(name)
+    return '' if value is None else str(value).strip()
+
+
+# 检查设备数据,返回[(id或None, note, protocol, username, password, coalesce_bytes, coalesce_delay, tcp_mode,
+#                   rate_bytes, rate_messages)]
+def validate_devices(records):
+    errors = []
+    rows = []
+    seen = set()
+    for line, record in enumerate(records, 1):
+        device_id = get_int(record, 'id', errors, line, None)
+        protocol = get_text(record, 'protocol') or 'tcpServer'
+        username = get_text(record, 'username')
+        password = get_text(record, 'password')
+        tcp_mode = get_text(record, 'tcp_mode')
+        if protocol not in PROTOCOLS:
+            errors.append((line, f'协议 {protocol} 不支持'))
+        if not username or not password:
+            errors.append((line, '账号和密码不能为空'))
+        elif '.password:' in username or '.cipher:' in username:
+            errors.append((line, '账号中不能包含.password:或.cipher:'))
+        if tcp_mode not in TCP_MODES:
+            errors.append((line, f'TCP选项 {tcp_mode} 不支持'))
+        if (protocol, username) in seen:
+            errors.append((line, f'账号 {username} 重复'))
+        seen.add((protocol, username))
+        rows.append((device_id, get_text(record, 'note'), protocol, username, password,
+                     get_int(record, 'coalesce_bytes', errors, line), get_int(record, 'coalesce_delay', errors, line),
+                     tcp_mode, get_int(record, 'rate_bytes', errors, line),
+                     get_int(record, 'rate_messages', errors, line)))
+    if errors:
+        raise ValidationError(errors)
+    return rows
+
+
+# 分批执行WHERE ... IN (...)查询,返回所有结果
+def select_in(conn, sql, values):
+    values = list(values)
+    rows = []
+    for start in range(0, len(values), LOOKUP_BATCH):
+        batch = values[start:start + LOOKUP_BATCH]
+        rows.extend(conn.execute(sql % ','.join('?' * len(batch)), batch))
+    return rows
+
+
+# 批量导入设备:检查全部数据后在一个事务中用executemany写入,已有的设备(相同ID,或没有ID时相同协议和账号)更新,
+# 其他新增;返回(新增数, 修改数),数据有错误时抛出ValidationError,不写入任何数据
+def import_devices(db, records):
+    rows = validate_devices(records)
+    errors = []
+    inserts = []
+    updates = []
+    with db.pool.connection() as conn:
+        existing = {(protocol, username): device_id for device_id, protocol, username in select_in(
+            conn, 'SELECT id, protocol, username FROM devices WHERE username IN (%s)', {row[3] for row in rows})}
+        known_ids = {device_id for device_id, in select_in(
+            conn, 'SELECT id FROM devices WHERE id IN (%s)', {row[0] for row in rows if row[0] is not None})}
+        for line, (device_id, *values) in enumerate(rows, 1):
+            match = existing.get((values[1], values[2]))
+            if device_id is None:
+                device_id = match
+            elif match is not None and match != device_id:
+                errors.append((line, f'账号 {values[2]} 已被设备 {match} 使用'))
+                continue
+            if device_id is None:
+                inserts.append((None, *values))
+            elif device_id in known_ids or device_id == match:
+                updates.append((*values, device_id))
+            else:
+                # 指定了ID但设备不存在时按这个ID新增
+                inserts.append((device_id, *values))
+        if errors:
+            raise ValidationError(errors)
+        conn.executemany('INSERT INTO devices (id, note, protocol, username, password, coalesce_bytes, '
+                         'coalesce_delay, tcp_mode, rate_bytes, rate_messages) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         inserts)
+        conn.executemany('UPDATE devices SET note=?, protocol=?, username=?, password=?, coalesce_bytes=?, '
+                         'coalesce_delay=?, tcp_mode=?, rate_bytes=?, rate_messages=? WHERE id=?', updates)
+    return len(inserts), len(updates)
+
+
+# 批量导入透传组:设备A/B用ID或账号指定,已有的透传组(相同ID,或相同的设备A和设备B)更新选项,其他新增;
+# 先解析全部数据,再分批查询用到的设备账号、设备ID和已有的透传组
+def import_passthrough(db, records):
+    errors = []
+    inserts = []
+    updates = []
+    parsed = []
+    for line, record in enumerate(records, 1):
+        sides = [(get_int(record, f'device_{side}_id', errors, line, None), get_text(record, f'device_{side}_username'))
+                 for side in ('a', 'b')]
+        options = (1 if get_int(record, 'source_prefix', errors, line) else 0,
+                   1 if get_int(record, 'offline_buffer', errors, line) else 0,
+                   get_int(record, 'rate_bytes', errors, line), get_int(record, 'rate_messages', errors, line))
+        parsed.append((line, get_int(record, 'id', errors, line, None), sides, options))
+    # 本批数据中已经出现的(设备A, 设备B)
+    seen = set()
+    with db.pool.connection() as conn:
+        # 账号 -> [设备ID, ...]
+        usernames = {}
+        for device_id, username in select_in(conn, 'SELECT id, username FROM devices WHERE username IN (%s)',
+                                             {username for _, _, sides, _ in parsed
+                                              for device_id, username in sides if device_id is None and username}):
+            usernames.setdefault(username, []).append(device_id)
+        known_devices = {device_id for device_id, in select_in(
+            conn, 'SELECT id FROM devices WHERE id IN (%s)',
+            {device_id for _, _, sides, _ in parsed for device_id, _ in sides if device_id is not None})}
+        rows = []
+        for line, passthrough_id, sides, options in parsed:
+            device_ids = []
+            for side, (device_id, username) in zip('AB', sides):
+                if device_id is None and username:
+                    found = usernames.get(username, [])
+                    if len(found) != 1:
+                        errors.append((line, f'账号 {username} 对应 {len(found)} 个设备'))
+                    else:
+                        device_id = found[0]
+                elif device_id is None:
+                    errors.append((line, f'没有指定设备{side}'))
+                elif device_id not in known_devices:
+                    errors.append((line, f'设备 {device_id} 不存在'))
+                device_ids.append(device_id)
+            pair = tuple(device_ids)
+            if pair in seen:
+                errors.append((line, f'透传组 {pair[0]} -> {pair[1]} 重复'))
+            seen.add(pair)
+            rows.append((passthrough_id, pair, options))
+        # (设备A, 设备B) -> 透传组ID
+        existing = {(device_a_id, device_b_id): passthrough_id
+                    for passthrough_id, device_a_id, device_b_id in select_in(
+                        conn, 'SELECT id, device_a_id, device_b_id FROM passthrough WHERE device_a_id IN (%s)',
+                        {pair[0] for passthrough_id, pair, _ in rows if passthrough_id is None})}
+        known_ids = {passthrough_id for passthrough_id, in select_in(
+            conn, 'SELECT id FROM passthrough WHERE id IN (%s)',
+            {passthrough_id for passthrough_id, _, _ in rows if passthrough_id is not None})}
+        for passthrough_id, (device_a_id, device_b_id), options in rows:
+            if passthrough_id is None:
+                passthrough_id = existing.get((device_a_id, device_b_id))
+            elif passthrough_id not in known_ids:
+                # 指定了ID但透传组不存在时按这个ID新增
+                inserts.append((passthrough_id, device_a_id, device_b_id, *options))
+                continue
+            if passthrough_id is None:
+                inserts.append((None, device_a_id, device_b_id, *options))
+            else:
+                updates.append((device_a_id, device_b_id, *options, passthrough_id))
+        if errors:
+            raise ValidationError(sorted(errors, key=lambda error: error[0]))
+        conn.executemany('INSERT INTO passthrough (id, device_a_id, device_b_id, source_prefix, offline_buffer, '
+                         'rate_bytes, rate_messages) VALUES (?, ?, ?, ?, ?, ?, ?)', inserts)
+        conn.executemany('UPDATE passthrough SET device_a_id=?, device_b_id=?, source_prefix=?, offline_buffer=?, '
+                         'rate_bytes=?, rate_messages=? WHERE id=?', updates)
+    return len(inserts), len(updates)
+
+
+# 逐批导出表中的数据,返回字符串片段的生成器,fmt为csv或json;数据库每次只读一批
+def export_rows(db, table, fmt='csv'):
+    columns = DEVICE_COLUMNS if table == 'devices' else PASSTHROUGH_COLUMNS
+    batches = db.iterateSql(f'SELECT {",".join(columns)} FROM {table} WHERE id > ? ORDER BY id LIMIT ?')
+    if fmt == 'json':
+        yield '['
+        first = True
+        for rows in batches:
+            yield (',' if not first else '') + ','.join(json.dumps(dict(zip(columns, row)), ensure_ascii=False)
+                                                        for row in rows)
+            first = False
+        yield ']'
+        return
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(columns)
+    for rows in batches:
+        writer.writerows(rows)
+        yield output.getvalue()
+        output.seek(0)
+        output.truncate()
+    yield output.getvalue()
+
+
+# 命令行:python provisioning.py import devices devices.csv / python provisioning.py export passthrough -o pt.json
+# 直接读写数据库,服务器运行时请使用web管理页面的导入接口,服务器才会重新加载设备和透传组
+def main():
+    parser = argparse.ArgumentParser(description='批量导入导出设备和透传组')
+    parser.add_argument('action', choices=('import', 'export'))
+    parser.add_argument('table', choices=('devices', 'passthrough'))
+    parser.add_argument('file', nargs='?', help='导入的文件,不指定时从标准输入读取')
+    parser.add_argument('-o', '--output', help='导出的文件,不指定时输出到标准输出')
+    parser.add_argument('--format', choices=('csv', 'json'), help='文件格式,默认按扩展名判断,其他为csv')
+    parser.add_argument('--db', default=DEFAULT_DB_FILE, help='数据库文件')
+    args = parser.parse_args()
+    path = args.file if args.action == 'import' else args.output
+    fmt = args.format or ('json' if path and path.endswith('.json') else 'csv')
+
+    db = DB(args.db)
+    db.initConfigTable()
+    if args.action == 'export':
+        output = open(path, 'w', encoding='utf-8', newline='') if path else sys.stdout
+        with output:
+            output.writelines(export_rows(db, args.table, fmt))
+        return
+
+    if path:
+        with open(path, encoding='utf-8-sig', newline='') as f:
+            data = f.read()
+    else:
+        data = sys.stdin.read()
+    try:
+        records = parse_records(data, fmt)
+        if args.table == 'devices':
+            inserted, updated = import_devices(db, records)
+        else:
+            inserted, updated = import_passthrough(db, records)
+    except ValidationError as e:
+        for line, message in e.errors:
+            print(f'第{line}行:{message}', file=sys.stderr)
+        sys.exit(1)
+    except ValueError as e:
+        print(f'数据格式错误:{e}', file=sys.stderr)
+        sys.exit(1)
+    print(f'新增 {inserted} 条,修改 {updated} 条')
+
+
+if __name__ == '__main__':
+    main()
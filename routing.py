@@ -0,0 +1,146 @@
+import struct
+import threading
+
+from databases.DB import get_pool
+
+# 来源设备ID帧头:来源设备ID(4字节) + 数据长度(4字节),网络字节序
+SOURCE_HEADER = struct.Struct('!II')
+
+
+class RoutingTable(object):
+    """
+    透传路由表,device_a_id -> (device_b_id, ...)
+    启动时从passthrough表加载一次,web管理页面修改透传组后同步更新,
+    转发数据时只查内存中的字典,不再访问数据库
+    一个设备A可以对应多个设备B(一对多),多个设备A也可以对应同一个设备B(多对一)
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        # 写操作加锁,读操作直接读字典(每次修改都整体替换字典,读到的总是完整的一份)
+        self.lock = threading.Lock()
+        self.routes = {}
+        # 需要添加来源设备ID帧头的目标设备 device_a_id -> frozenset(device_b_id, ...)
+        self.prefixed = {}
+        # 开启了离线缓存的目标设备 device_a_id -> frozenset(device_b_id, ...)
+        self.buffered = {}
+        # 有限速的透传组 device_a_id -> {device_b_id: (每秒字节数, 每秒消息数)}
+        self.limits = {}
+        # 一对一透传组 device_a_id -> device_b_id (A只转发给B,B只接收A,且不是回显)
+        self.pairs = {}
+        # 路由表版本号,每次修改加1
+        self.version = 0
+        # 路由表修改后的回调函数,参数为新版本号
+        self.listeners = []
+        self.reload()
+
+    # 从数据库重新加载整张路由表;读取和替换都在锁内,读取期间add()的修改不会被旧数据覆盖
+    def reload(self):
+        with self.lock:
+            with get_pool(self.db_file).connection() as conn:
+                rows = conn.execute('SELECT device_a_id, device_b_id, source_prefix, offline_buffer, rate_bytes, '
+                                    'rate_messages FROM passthrough ORDER BY id').fetchall()
+            routes = {}
+            prefixed = {}
+            buffered = {}
+            limits = {}
+            for device_a_id, device_b_id, source_prefix, offline_buffer, rate_bytes, rate_messages in rows:
+                routes.setdefault(device_a_id, []).append(device_b_id)
+                if source_prefix:
+                    prefixed.setdefault(device_a_id, set()).add(device_b_id)
+                if offline_buffer:
+                    buffered.setdefault(device_a_id, set()).add(device_b_id)
+                if rate_bytes or rate_messages:
+                    limits.setdefault(device_a_id, {})[device_b_id] = (rate_bytes or 0, rate_messages or 0)
+            self.set_routes({device_a_id: tuple(device_b_ids) for device_a_id, device_b_ids in routes.items()},
+                            {device_a_id: frozenset(device_b_ids) for device_a_id, device_b_ids in prefixed.items()},
+                            {device_a_id: frozenset(device_b_ids) for device_a_id, device_b_ids in buffered.items()},
+                            limits)
+
+    # 新增透传组
+    def add(self, device_a_id, device_b_id, source_prefix=0, offline_buffer=0, rate_bytes=0, rate_messages=0):
+        with self.lock:
+            routes = dict(self.routes)
+            routes[device_a_id] = routes.get(device_a_id, ()) + (device_b_id,)
+            prefixed = dict(self.prefixed)
+            if source_prefix:
+                prefixed[device_a_id] = prefixed.get(device_a_id, frozenset()) | {device_b_id}
+            buffered = dict(self.buffered)
+            if offline_buffer:
+                buffered[device_a_id] = buffered.get(device_a_id, frozenset()) | {device_b_id}
+            limits = dict(self.limits)
+            if rate_bytes or rate_messages:
+                groups = dict(limits.get(device_a_id, {}))
+                groups[device_b_id] = (rate_bytes, rate_messages)
+                limits[device_a_id] = groups
+            self.set_routes(routes, prefixed, buffered, limits)
+
+    # 删除设备相关的所有透传组
+    def remove_device(self, device_id):
+        with self.lock:
+            routes = {}
+            for device_a_id, device_b_ids in self.routes.items():
+                if device_a_id == device_id:
+                    continue
+                device_b_ids = tuple(device_b_id for device_b_id in device_b_ids if device_b_id != device_id)
+                if device_b_ids:
+                    routes[device_a_id] = device_b_ids
+            limits = {}
+            for device_a_id, groups in self.limits.items():
+                groups = {device_b_id: group for device_b_id, group in groups.items() if device_b_id != device_id}
+                if device_a_id != device_id and groups:
+                    limits[device_a_id] = groups
+            self.set_routes(routes, self.without_device(self.prefixed, device_id),
+                            self.without_device(self.buffered, device_id), limits)
+
+    # 从device_a_id -> frozenset(device_b_id, ...)中去掉设备
+    def without_device(self, targets, device_id):
+        result = {}
+        for device_a_id, device_b_ids in targets.items():
+            if device_a_id != device_id and device_b_ids - {device_id}:
+                result[device_a_id] = device_b_ids - {device_id}
+        return result
+
+    # 替换路由表并重新计算一对一透传组,调用前需持有锁
+    def set_routes(self, routes, prefixed, buffered, limits):
+        source_counts = {}
+        for device_b_ids in routes.values():
+            for device_b_id in device_b_ids:
+                source_counts[device_b_id] = source_counts.get(device_b_id, 0) + 1
+        pairs = {}
+        for device_a_id, device_b_ids in routes.items():
+            if len(device_b_ids) == 1 and device_b_ids[0] != device_a_id and source_counts[device_b_ids[0]] == 1 \
+                    and device_a_id not in prefixed:
+                pairs[device_a_id] = device_b_ids[0]
+        self.routes = routes
+        self.prefixed = prefixed
+        self.buffered = buffered
+        self.limits = limits
+        self.pairs = pairs
+        self.version += 1
+        for listener in self.listeners:
+            listener(self.version)
+
+    # 注册路由表修改后的回调函数
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    # 获取目标设备ID,没有目标设备返回空元组
+    def get_targets(self, device_id):
+        return self.routes.get(device_id, ())
+
+    # 获取需要添加来源设备ID帧头的目标设备ID
+    def get_prefixed_targets(self, device_id):
+        return self.prefixed.get(device_id, frozenset())
+
+    # 获取开启了离线缓存的目标设备ID
+    def get_buffered_targets(self, device_id):
+        return self.buffered.get(device_id, frozenset())
+
+    # 获取设备作为设备A的透传组的限速 [(每秒字节数, 每秒消息数), ...]
+    def get_group_limits(self, device_id):
+        return self.limits.get(device_id, {}).values()
+
+    # 获取一对一透传组的目标设备ID,不是一对一透传组返回None
+    def get_pair_target(self, device_id):
+        return self.pairs.get(device_id)
@@ -0,0 +1,127 @@
+import hashlib
+import hmac
+import itertools
+import ssl
+import struct
+
+from framing import FrameError
+
+# TLS握手超时(秒)
+TLS_HANDSHAKE_TIMEOUT = 10
+
+# 加密模式登录时设备和服务器各自生成的随机数长度
+NONCE_SIZE = 16
+# 加密帧:序号(8字节) + 密文 + 校验码(16字节)
+COUNTER = struct.Struct('!Q')
+TAG_SIZE = 16
+# 防重放窗口:线程模式下多个发送方同时加密,到达顺序可能与序号不一致,窗口内的旧序号只能出现一次
+REPLAY_WINDOW = 64
+
+
+# 创建TLS服务端上下文,TLS1.3会话票据默认开启,设备重连时用票据恢复会话,不需要完整握手
+def create_server_context(cert_file, key_file):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(cert_file, key_file or None)
+    # 每次握手发给设备的会话票据数
+    context.num_tickets = 2
+    return context
+
+
+# 登录帧是否为加密模式
+def is_cipher_login(data):
+    return b'.cipher:' in data
+
+
+# 解析加密模式的登录帧 username:xxx.cipher:设备随机数(十六进制),返回(用户名, 设备随机数)
+def parse_cipher_login(data):
+    username_start = data.find("username:") + len("username:")
+    username_end = data.find(".cipher:")
+    client_nonce = bytes.fromhex(data[username_end + len(".cipher:"):])
+    if len(client_nonce) != NONCE_SIZE:
+        raise ValueError('随机数长度错误')
+    return data[username_start:username_end], client_nonce
+
+
+# 会话主密钥,由密码的SHA-256和双方随机数计算,密码不在网络上传输
+def derive_master(password_hash, client_nonce, server_nonce):
+    return hmac.new(password_hash, b'translucent-cipher' + client_nonce + server_nonce, hashlib.sha256).digest()
+
+
+# 设备证明自己知道密码的应答
+def auth_proof(master):
+    return hmac.new(master, b'auth', hashlib.sha256).digest()
+
+
+class SessionCipher(object):
+    """
+    加密模式的会话加密,只用标准库,适合跑不动TLS的设备
+    设备到服务器、服务器到设备各用一组密钥:密文为数据与SHAKE-256(密钥+序号)生成的密钥流异或,
+    校验码为BLAKE2s(序号+密文);收到的每个序号只接受一次,防止重放
+    """
+
+    def __init__(self, master, server_side=True):
+        keys = {name: hmac.new(master, name, hashlib.sha256).digest()
+                for name in (b'device encrypt', b'device mac', b'server encrypt', b'server mac')}
+        send, recv = (b'server', b'device') if server_side else (b'device', b'server')
+        self.send_key = keys[send + b' encrypt']
+        self.send_mac_key = keys[send + b' mac']
+        self.recv_key = keys[recv + b' encrypt']
+        self.recv_mac_key = keys[recv + b' mac']
+        # 发送序号,多个线程同时发送时next也不会重复
+        self.send_counter = itertools.count(1)
+        # 收到的最大序号,以及它之前REPLAY_WINDOW个序号是否已收到
+        self.recv_counter = 0
+        self.recv_window = 0
+
+    def encrypt(self, data):
+        counter = COUNTER.pack(next(self.send_counter))
+        ciphertext = xor_keystream(data, self.send_key, counter)
+        tag = hashlib.blake2s(counter + ciphertext, key=self.send_mac_key, digest_size=TAG_SIZE).digest()
+        return counter + ciphertext + tag
+
+    def decrypt(self, payload):
+        if len(payload) < COUNTER.size + TAG_SIZE:
+            raise FrameError('加密帧长度错误')
+        counter = payload[:COUNTER.size]
+        ciphertext = payload[COUNTER.size:-TAG_SIZE]
+        tag = hashlib.blake2s(counter + ciphertext, key=self.recv_mac_key, digest_size=TAG_SIZE).digest()
+        if not hmac.compare_digest(tag, payload[-TAG_SIZE:]):
+            raise FrameError('加密帧校验失败')
+        value = COUNTER.unpack(counter)[0]
+        if value > self.recv_counter:
+            self.recv_window = ((self.recv_window << (value - self.recv_counter)) | 1) & ((1 << REPLAY_WINDOW) - 1)
+            self.recv_counter = value
+        else:
+            offset = self.recv_counter - value
+            if offset >= REPLAY_WINDOW or self.recv_window >> offset & 1:
+                raise FrameError('加密帧序号重复')
+            self.recv_window |= 1 << offset
+        return xor_keystream(ciphertext, self.recv_key, counter)
+
+    # 平滑重启时交给新进程的会话状态,之后本对象不能再发送
+    def get_state(self):
+        return {
+            'keys': (self.send_key, self.send_mac_key, self.recv_key, self.recv_mac_key),
+            'send_counter': next(self.send_counter),
+            'recv_counter': self.recv_counter,
+            'recv_window': self.recv_window,
+        }
+
+    # 用get_state的结果恢复会话,序号和防重放窗口接着旧进程继续
+    @classmethod
+    def from_state(cls, state):
+        cipher = cls.__new__(cls)
+        cipher.send_key, cipher.send_mac_key, cipher.recv_key, cipher.recv_mac_key = state['keys']
+        cipher.send_counter = itertools.count(state['send_counter'])
+        cipher.recv_counter = state['recv_counter']
+        cipher.recv_window = state['recv_window']
+        return cipher
+
+
+# 数据与密钥流异或,整块转成整数一次异或,不逐字节循环
+def xor_keystream(data, key, counter):
+    if not data:
+        return b''
+    keystream = hashlib.shake_256(key + counter).digest(len(data))
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(keystream, 'big')).to_bytes(len(data), 'big')
@@ -0,0 +1,261 @@
+import collections
+import socket
+import threading
+import time
+
+# 队列满时的处理策略
+# 丢弃队列中最早的数据
+DROP_OLDEST = 'drop_oldest'
+# 丢弃新到的数据
+DROP_NEWEST = 'drop_newest'
+# 暂停读取发送方的数据,直到队列有空间
+PAUSE = 'pause'
+# 断开目标设备
+DISCONNECT = 'disconnect'
+
+POLICIES = (DROP_OLDEST, DROP_NEWEST, PAUSE, DISCONNECT)
+
+# push的返回值
+# 已入队(或按策略丢弃)
+QUEUED = 0
+# 已入队,但队列已满,发送方需要暂停读取
+FULL = 1
+# 队列已满,需要断开目标设备
+CLOSE = 2
+
+# 一次sendmsg最多发送的缓冲区个数
+MAX_BATCH = 512
+
+
+class SendQueue(object):
+    """
+    每个目标设备连接一个有界发送队列,只负责按策略入队和统计,不负责发送
+    """
+
+    def __init__(self, max_bytes=1048576, policy=PAUSE):
+        self.max_bytes = max_bytes
+        self.policy = policy if policy in POLICIES else PAUSE
+        self.buffers = collections.deque()
+        self.queued_bytes = 0
+        # 统计信息
+        self.dropped_messages = 0
+        self.dropped_bytes = 0
+        self.pauses = 0
+
+    # 数据入队,返回QUEUED/FULL/CLOSE
+    def push(self, data):
+        size = len(data)
+        if self.buffers and self.queued_bytes + size > self.max_bytes:
+            if self.policy == DROP_OLDEST:
+                while self.buffers and self.queued_bytes + size > self.max_bytes:
+                    self.drop(self.buffers.popleft())
+            elif self.policy == DROP_NEWEST:
+                self.dropped_messages += 1
+                self.dropped_bytes += size
+                return QUEUED
+            elif self.policy == DISCONNECT:
+                self.dropped_messages += 1
+                self.dropped_bytes += size
+                return CLOSE
+            else:
+                # 暂停策略下这一包仍然入队,由发送方暂停后续读取
+                self.pauses += 1
+                self.append(data)
+                return FULL
+        self.append(data)
+        return QUEUED
+
+    def append(self, data):
+        self.buffers.append(data)
+        self.queued_bytes += len(data)
+
+    def popleft(self):
+        data = self.buffers.popleft()
+        self.queued_bytes -= len(data)
+        return data
+
+    def drop(self, data):
+        self.queued_bytes -= len(data)
+        self.dropped_messages += 1
+        self.dropped_bytes += len(data)
+
+    # 修改队列大小和策略,已在队列中的数据不受影响
+    def set_limits(self, max_bytes, policy):
+        self.max_bytes = max_bytes
+        self.policy = policy if policy in POLICIES else PAUSE
+
+    # 队列是否还有空间
+    def writable(self):
+        return self.queued_bytes < self.max_bytes
+
+    def get_stats(self):
+        return {
+            'queued_bytes': self.queued_bytes,
+            'queued_messages': len(self.buffers),
+            'dropped_messages': self.dropped_messages,
+            'dropped_bytes': self.dropped_bytes,
+            'pauses': self.pauses,
+        }
+
+
+class ThreadedSendQueue(SendQueue):
+    """
+    线程模式的发送队列,每个目标设备一个写线程,发送方线程只负责入队,
+    目标设备发送慢不会阻塞发送方的接收循环
+    """
+
+    def __init__(self, sock, max_bytes=1048576, policy=PAUSE):
+        super().__init__(max_bytes, policy)
+        self.sock = sock
+        self.cond = threading.Condition()
+        # 写线程或快速通道正在发送
+        self.sending = False
+        self.closed = False
+        # 心跳包/空闲超时定时任务,最后一次收到和发送数据的时间
+        self.timer = None
+        self.last_recv_time = 0
+        self.last_send_time = 0
+        # 设备是否使用帧协议,加密模式的会话加密对象
+        self.framed = False
+        self.cipher = None
+        # 合并发送:最早的数据最多等待coalesce_delay秒,攒够coalesce_bytes字节立即发送,0为不合并
+        self.coalesce_bytes = 0
+        self.coalesce_delay = 0
+        # 合并发送后取消TCP_CORK把数据推出去
+        self.cork = False
+        # 队列中最早的数据入队时间
+        self.first_queued_time = 0
+        # 本设备作为发送方的限速令牌桶
+        self.limiter = None
+
+    def start(self):
+        threading.Thread(target=self.run).start()
+
+    # 写线程,从队列中取出所有数据,一次系统调用发送给目标设备
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.closed and (self.sending or not self.buffers):
+                    self.cond.wait()
+                # 合并发送:数据不够coalesce_bytes时等到最早的数据满coalesce_delay秒
+                while self.coalesce_delay and not self.closed and self.buffers and \
+                        self.queued_bytes < self.coalesce_bytes:
+                    remaining = self.first_queued_time + self.coalesce_delay - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                if self.closed:
+                    return
+                if self.sending or not self.buffers:
+                    continue
+                batch = []
+                while self.buffers and len(batch) < MAX_BATCH:
+                    batch.append(self.popleft())
+                self.first_queued_time = time.monotonic()
+                self.sending = True
+                # 唤醒等待队列空间的发送方
+                self.cond.notify_all()
+            try:
+                self.send_batch(batch)
+            except OSError:
+                self.close()
+                return
+            finally:
+                with self.cond:
+                    self.sending = False
+                    self.cond.notify_all()
+
+    # 发送一批数据,多个缓冲区用sendmsg一次发送,不需要先拼接
+    def send_batch(self, batch):
+        if len(batch) == 1 or not hasattr(self.sock, 'sendmsg'):
+            self.sock.sendall(batch[0] if len(batch) == 1 else b''.join(batch))
+        else:
+            while batch:
+                sent = self.sock.sendmsg(batch)
+                # 跳过已经发完的缓冲区,没发完的缓冲区保留剩下的部分
+                index = 0
+                while index < len(batch) and sent >= len(batch[index]):
+                    sent -= len(batch[index])
+                    index += 1
+                batch = batch[index:]
+                if batch and sent:
+                    batch[0] = memoryview(batch[0])[sent:]
+        if self.cork:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+
+    # 数据入队,返回QUEUED/FULL/CLOSE
+    def send(self, data):
+        with self.cond:
+            if self.closed:
+                return QUEUED
+            if not self.buffers:
+                self.first_queued_time = time.monotonic()
+            result = self.push(data)
+            self.cond.notify_all()
+        if result == CLOSE:
+            self.shutdown()
+        return result
+
+    # 修改队列大小后唤醒等待队列空间的发送方
+    def set_limits(self, max_bytes, policy):
+        with self.cond:
+            super().set_limits(max_bytes, policy)
+            self.cond.notify_all()
+
+    # 暂停策略:队列满时等待写线程发送出空间
+    def wait_writable(self):
+        with self.cond:
+            while not self.closed and not self.writable():
+                self.cond.wait()
+
+    # 占用连接直接发送(一对一透传组快速通道),队列不为空或需要合并发送时返回False
+    def acquire_direct(self):
+        with self.cond:
+            if self.closed or self.sending or self.buffers or self.coalesce_delay:
+                return False
+            self.sending = True
+            return True
+
+    # 释放直接发送,没发完的数据放到队首
+    def release_direct(self, remainder=None):
+        with self.cond:
+            self.sending = False
+            if remainder:
+                if not self.buffers:
+                    self.first_queued_time = time.monotonic()
+                self.buffers.appendleft(remainder)
+                self.queued_bytes += len(remainder)
+            self.cond.notify_all()
+
+    # 快速通道:队列为空时直接用接收缓冲区发送,发不完的部分才复制入队
+    def send_direct(self, view):
+        if not hasattr(socket, 'MSG_DONTWAIT') or not self.acquire_direct():
+            return self.send(bytes(view))
+        sent = 0
+        try:
+            sent = self.sock.send(view, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.release_direct()
+            self.close()
+            return QUEUED
+        self.release_direct(bytes(view[sent:]) if sent < len(view) else None)
+        if self.policy == PAUSE and not self.writable():
+            return FULL
+        return QUEUED
+
+    # 关闭目标设备连接,设备的接收线程会收到断开并清理
+    def shutdown(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.buffers.clear()
+            self.queued_bytes = 0
+            self.cond.notify_all()
@@ -0,0 +1,62 @@
+import time
+
+# 令牌桶最多攒下几秒的令牌,空闲后可以按这么多秒的额度突发
+BURST_SECONDS = 1
+
+
+class TokenBucket(object):
+    """
+    令牌桶:每秒补充rate个令牌,最多攒burst个
+    令牌不够时不拒绝,记为欠账(令牌为负),返回还清欠账需要等待的秒数,由调用方暂停读取
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'last_time')
+
+    def __init__(self, rate, now):
+        self.rate = rate
+        self.burst = rate * BURST_SECONDS
+        self.tokens = self.burst
+        self.last_time = now
+
+    # 消耗amount个令牌,返回需要等待的秒数,0为不用等待
+    def consume(self, amount, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last_time) * self.rate) - amount
+        self.last_time = now
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+
+class RateLimiter(object):
+    """
+    一个来源设备的限速:设备自己的每秒字节数/消息数,以及它作为设备A的每个透传组的每秒字节数/消息数
+    每转发一批数据消耗一次所有令牌桶,代价与数据大小无关;超出限制的数据照常转发,之后暂停读取本设备直到还清欠账
+    只由来源设备的接收线程(线程模式)或事件循环(异步模式)调用,不需要加锁
+    """
+
+    def __init__(self, device_limits, group_limits, version=None):
+        now = time.monotonic()
+        # [(令牌桶, 是否按字节计数), ...]
+        self.buckets = []
+        # 每次最多接收的字节数和每批最多转发的消息数,为最严格的令牌桶容量,0为不限制;
+        # 暂停期间内核中积压的数据不会一次全部转发,每次欠账不超过BURST_SECONDS秒的额度
+        self.max_bytes = 0
+        self.max_messages = 0
+        for rate_bytes, rate_messages in [device_limits] + list(group_limits):
+            if rate_bytes:
+                self.buckets.append((TokenBucket(rate_bytes, now), True))
+                burst = max(int(rate_bytes * BURST_SECONDS), 1)
+                self.max_bytes = min(self.max_bytes, burst) if self.max_bytes else burst
+            if rate_messages:
+                self.buckets.append((TokenBucket(rate_messages, now), False))
+                burst = max(int(rate_messages * BURST_SECONDS), 1)
+                self.max_messages = min(self.max_messages, burst) if self.max_messages else burst
+        # 创建时设备选项和路由表的版本号,版本变化后重新创建
+        self.version = version
+
+    # 收到nbytes字节、nmessages条消息,返回需要暂停读取的秒数
+    def consume(self, nbytes, nmessages):
+        now = time.monotonic()
+        wait = 0
+        for bucket, by_bytes in self.buckets:
+            wait = max(wait, bucket.consume(nbytes if by_bytes else nmessages, now))
+        return wait
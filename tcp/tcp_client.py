@@ -1,8 +1,21 @@
+import asyncio
 import datetime
+import logging
+import os
+import random
 import socket
+import sys
 import threading
 import time
 
+# 直接运行python tcp/tcp_client.py时也能导入项目根目录下的模块
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from framing import ACK, DATA, HEARTBEAT, LOGIN, FrameError, FrameReader, pack_frame
+from send_queue import DROP_OLDEST, SendQueue
+
+logger = logging.getLogger(__name__)
+
 
 class TCPClient:
 
@@ -59,7 +72,7 @@ class TCPClient:
 
     def send_data(self, data):
         try:
-            self.client_socket.send(data)
+            self.client_socket.sendall(data)
             return True
         except Exception as e:
             # 10057: An established connection was aborted by the software in your host machine
@@ -73,7 +86,7 @@ class TCPClient:
 
     def send_data_utf8(self, data):
         try:
-            self.client_socket.send(data.encode("utf8"))
+            self.client_socket.sendall(data.encode("utf8"))
             return True
         except Exception as e:
             # 10057: An established connection was aborted by the software in your host machine
@@ -86,6 +99,266 @@ class TCPClient:
                 return False
 
 
+class ClientProtocol(asyncio.Protocol):
+    """
+    AsyncTCPClient的一次连接,只负责收数据和发送缓冲区的流控,断开后由客户端重新连接
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.transport = None
+        self.reader = FrameReader(client.read_size) if client.framed else None
+        # 帧协议登录时等待服务器的应答帧
+        self.logged_in = client.loop.create_future()
+        # 连接断开时完成
+        self.lost = client.loop.create_future()
+        self.writing_paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=self.client.write_buffer_size)
+
+    def data_received(self, data):
+        if self.reader is None:
+            self.client.dispatch(data)
+            return
+        self.reader.feed(data)
+        try:
+            while True:
+                frame = self.reader.next_frame()
+                if frame is None:
+                    return
+                frame_type, payload = frame
+                if frame_type == DATA:
+                    self.client.dispatch(payload)
+                elif frame_type == ACK and not self.logged_in.done():
+                    self.logged_in.set_result(payload == b'loginSuccess')
+        except FrameError as e:
+            logger.warning('%s 收到错误的帧:%s,断开重连', self.client.name, e)
+            self.transport.abort()
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+        self.client.flush()
+
+    def connection_lost(self, exc):
+        if not self.logged_in.done():
+            self.logged_in.set_result(False)
+        if not self.lost.done():
+            self.lost.set_result(exc)
+
+
+class AsyncTCPClient(object):
+    """
+    asyncio版本的客户端,连接、登录、收发都不阻塞,一个事件循环可以同时运行成千上万个客户端
+    断开后按指数退避(带随机抖动)重新连接并登录;要发送的数据先进入有界的发送缓冲区,
+    同一轮事件循环中的多次send合并为一次写入,断开期间的数据留在缓冲区中,重连登录后继续发送,
+    已交给系统发送的数据在断开时可能丢失
+    """
+
+    def __init__(self, server_ip, server_port, username=None, password=None, framed=False, on_message=None,
+                 buffer_size=1048576, policy=DROP_OLDEST, flush_delay=0, flush_bytes=65536, min_backoff=0.5,
+                 max_backoff=30, connect_timeout=10, heartbeat_interval=0, ssl=None, login_delay=0.5):
+        self.server_ip = server_ip
+        self.server_port = server_port
+        self.username = username
+        self.password = password
+        # 使用帧协议,登录后等待服务器的应答帧,每次send为一帧
+        self.framed = framed
+        # 收到数据的回调 on_message(data),在事件循环线程中调用
+        self.on_message = on_message
+        # 发送缓冲区,满了之后按策略处理:drop_oldest丢弃最早的数据,drop_newest丢弃新数据,
+        # pause也入队,由调用方await drain()等待缓冲区有空间
+        self.queue = SendQueue(buffer_size, policy)
+        # 合并发送:缓冲区的数据最多等待flush_delay秒,攒够flush_bytes字节立即发送,0为每轮事件循环发送一次
+        self.flush_delay = flush_delay
+        self.flush_bytes = flush_bytes
+        # 重连的退避时间(秒):第n次失败后等待0到min_backoff*2^n之间的随机时间,不超过max_backoff
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.connect_timeout = connect_timeout
+        # 帧协议心跳包间隔(秒),空闲超过这个时间发送一次,防止服务器空闲超时断开,0为不发送
+        self.heartbeat_interval = heartbeat_interval
+        self.ssl = ssl
+        # 文本协议服务器不应答登录包,发出登录包后等待login_delay秒再发送数据,避免数据和登录包被服务器一起收到
+        self.login_delay = login_delay
+        self.name = f'{username or ""}@{server_ip}:{server_port}'
+        # transport发送缓冲区的上限,超过后数据留在发送缓冲区中
+        self.write_buffer_size = 65536
+        # 帧协议接收缓冲区的初始大小,收到更大的帧时自动扩大;客户端很多时不要设置太大
+        self.read_size = 4096
+        self.loop = None
+        self.task = None
+        self.protocol = None
+        self.flush_handle = None
+        self.last_send_time = 0
+        self.closed = False
+        # 等待发送缓冲区有空间的drain()
+        self.drain_waiters = []
+        # 统计信息
+        self.connects = 0
+        self.failures = 0
+        self.sent_bytes = 0
+        self.received_bytes = 0
+
+    # 在当前事件循环中启动,立即返回,连接在后台建立
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.task = self.loop.create_task(self.run())
+        return self
+
+    # 停止重连并断开连接,flush为True时先等待缓冲区中的数据发送完(最多timeout秒)
+    async def close(self, flush=False, timeout=10):
+        if flush and self.task is not None:
+            deadline = self.loop.time() + timeout
+            while (self.queue.buffers or self.is_sending()) and self.loop.time() < deadline:
+                await asyncio.sleep(0.01)
+        self.closed = True
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.wake_drain_waiters()
+
+    # 是否已连接并登录
+    def is_connected(self):
+        return self.protocol is not None
+
+    # transport中还有没发出去的数据
+    def is_sending(self):
+        protocol = self.protocol
+        return protocol is not None and protocol.transport.get_write_buffer_size() > 0
+
+    # 退避时间
+    def get_backoff(self):
+        ceiling = min(self.max_backoff, self.min_backoff * 2 ** min(self.failures, 30))
+        return random.uniform(0, ceiling)
+
+    async def run(self):
+        while not self.closed:
+            protocol = None
+            try:
+                _, protocol = await asyncio.wait_for(self.loop.create_connection(
+                    lambda: ClientProtocol(self), self.server_ip, self.server_port, ssl=self.ssl),
+                    self.connect_timeout)
+                await asyncio.wait_for(self.login(protocol), self.connect_timeout)
+                self.connects += 1
+                self.failures = 0
+                logger.info('%s 连接并登录成功', self.name)
+                self.protocol = protocol
+                self.last_send_time = self.loop.time()
+                # 发送断开期间缓冲的数据
+                self.flush()
+                heartbeat = None
+                if self.framed and self.heartbeat_interval:
+                    heartbeat = self.loop.create_task(self.heartbeat(protocol))
+                try:
+                    exc = await asyncio.shield(protocol.lost)
+                finally:
+                    self.protocol = None
+                    if heartbeat is not None:
+                        heartbeat.cancel()
+                logger.info('%s 连接断开:%s', self.name, exc)
+            except (OSError, asyncio.TimeoutError) as e:
+                self.failures += 1
+                logger.info('%s 第%s次连接失败:%s', self.name, self.failures, e)
+            finally:
+                if protocol is not None and protocol.transport is not None:
+                    protocol.transport.abort()
+            if self.closed:
+                break
+            await asyncio.sleep(self.get_backoff())
+
+    # 发送登录包,帧协议等待服务器的应答帧;文本协议服务器不应答,发送后等待login_delay秒认为已登录
+    async def login(self, protocol):
+        if self.username is None:
+            return
+        login = f'username:{self.username}.password:{self.password}'.encode()
+        if not self.framed:
+            protocol.transport.write(login)
+            await asyncio.sleep(self.login_delay)
+            if protocol.lost.done():
+                raise ConnectionError('登录失败')
+            return
+        protocol.transport.write(pack_frame(LOGIN, login))
+        if not await protocol.logged_in:
+            raise ConnectionError('登录失败')
+
+    async def heartbeat(self, protocol):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            if self.loop.time() - self.last_send_time >= self.heartbeat_interval:
+                protocol.transport.write(pack_frame(HEARTBEAT))
+                self.last_send_time = self.loop.time()
+
+    def dispatch(self, data):
+        self.received_bytes += len(data)
+        if self.on_message is not None:
+            self.on_message(data)
+
+    # 数据放入发送缓冲区,返回SendQueue.push的结果;只能在事件循环线程中调用,其他线程请用send_threadsafe
+    def send(self, data):
+        if self.framed:
+            data = pack_frame(DATA, data)
+        result = self.queue.push(data)
+        if self.protocol is not None and self.flush_handle is None:
+            if self.flush_delay and self.queue.queued_bytes < self.flush_bytes:
+                self.flush_handle = self.loop.call_later(self.flush_delay, self.flush)
+            else:
+                self.flush_handle = self.loop.call_soon(self.flush)
+        return result
+
+    def send_threadsafe(self, data):
+        self.loop.call_soon_threadsafe(self.send, data)
+
+    # 把发送缓冲区中的数据一次写入transport,transport发送缓冲区满时等待resume_writing
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        protocol = self.protocol
+        if protocol is None or protocol.writing_paused or not self.queue.buffers:
+            return
+        buffers = self.queue.buffers
+        size = self.queue.queued_bytes
+        self.queue.buffers = type(buffers)()
+        self.queue.queued_bytes = 0
+        protocol.transport.writelines(buffers)
+        self.sent_bytes += size
+        self.last_send_time = self.loop.time()
+        self.wake_drain_waiters()
+
+    # 等待发送缓冲区有空间,配合pause策略控制发送速度
+    async def drain(self):
+        while not self.closed and not self.queue.writable():
+            waiter = self.loop.create_future()
+            self.drain_waiters.append(waiter)
+            await waiter
+
+    def wake_drain_waiters(self):
+        waiters = self.drain_waiters
+        self.drain_waiters = []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def get_stats(self):
+        stats = self.queue.get_stats()
+        stats.update({
+            'connected': 1 if self.protocol is not None else 0,
+            'connects': self.connects,
+            'failures': self.failures,
+            'sent_bytes': self.sent_bytes,
+            'received_bytes': self.received_bytes,
+        })
+        return stats
+
+
 if __name__ == "__main__":
     def read_input(client):
         input_text = input()
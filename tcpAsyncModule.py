@@ -0,0 +1,660 @@
+import asyncio
+import collections
+import logging
+import os
+import socket
+import threading
+import time
+
+from databases.DB import DEFAULT_DB_FILE
+from framing import ACK, CHALLENGE, FRAME_MAGIC, LOGIN, FrameError, FrameReader, pack_frame
+from log import ThrottledLogger
+from security import TLS_HANDSHAKE_TIMEOUT, SessionCipher, create_server_context, is_cipher_login
+from send_queue import CLOSE, FULL, QUEUED, SendQueue
+from tcpModule import HANDOFF_DRAIN_TIMEOUT, LISTENER_DRAIN_TIME, TCPServer
+
+logger = logging.getLogger(__name__)
+# 每个连接都可能触发的日志按来源限制输出频率
+throttled = ThrottledLogger(logger)
+
+
+class DeviceProtocol(asyncio.BufferedProtocol):
+    """
+    单个设备连接,运行在事件循环线程中,不再占用独立线程
+    所有连接共用事件循环的接收缓冲区,数据直接读入缓冲区(recv_into)
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.remote_addr = None
+        self.device_id = None
+        self.username = None
+        self.password = None
+        # 心跳包/空闲超时定时任务,最后一次收到和发送数据的时间
+        self.timer = None
+        self.last_recv_time = 0
+        self.last_send_time = 0
+        # 发送队列,transport的发送缓冲区满了之后数据先进入这里
+        self.queue = SendQueue(server.send_queue_size, server.send_queue_policy)
+        self.writing_paused = False
+        # 因本设备发送队列满而暂停读取的发送方
+        self.paused_sources = set()
+        # 使用帧协议时的接收缓冲区
+        self.reader = None
+        self.framed = False
+        # 加密模式:等待认证帧时为(用户名, 设备ID, 会话主密钥),登录后为会话加密对象
+        self.challenge = None
+        self.cipher = None
+        # 合并发送:最早的数据最多等待coalesce_delay秒,攒够coalesce_bytes字节立即发送,0为不合并
+        self.coalesce_bytes = 0
+        self.coalesce_delay = 0
+        self.cork = False
+        # 等待合并发送的数据和定时器
+        self.pending = []
+        self.pending_bytes = 0
+        self.flush_handle = None
+        # 平滑重启:连接正在交给新进程,之后要发送的数据留在发送队列中一起交出
+        self.handed_off = False
+        # 登录准入:计入同一IP未登录连接数的来源IP,是否计入正在登录的连接数,登录超时定时任务
+        self.client_ip = None
+        self.admitted = False
+        self.login_timer = None
+        # 限速:本设备作为发送方的令牌桶,超出限速暂停读取后恢复读取的定时器
+        self.limiter = None
+        self.shaping_handle = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.remote_addr = transport.get_extra_info('peername')
+        # transport只保留少量待发送数据,其余进入受策略控制的发送队列
+        transport.set_write_buffer_limits(high=65536)
+        if self.device_id is None:
+            logger.info('设备 %s 建立连接,等待身份验证', self.remote_addr)
+            self.server.admit(self)
+        else:
+            # 从旧进程接管的连接已经登录,等所有连接都接管后再读取,转发时目标设备已经在本进程中
+            transport.pause_reading()
+
+    def get_buffer(self, sizehint):
+        # 限速时每次最多读入max_bytes字节
+        max_bytes = self.limiter.max_bytes if self.limiter is not None else 0
+        # 使用帧协议的连接直接读入自己的缓冲区,半帧数据留到下次拼接
+        if self.reader is not None:
+            buffer = self.reader.get_buffer()
+        else:
+            buffer = self.server.recv_view
+        return buffer[:max_bytes] if max_bytes else buffer
+
+    def buffer_updated(self, nbytes):
+        if self.reader is not None:
+            self.reader.written(nbytes)
+            self.receive_frames()
+            return
+        view = self.server.recv_view[:nbytes]
+        # 第一个字节为帧协议魔数时使用帧协议
+        if self.device_id is None and view[0] == FRAME_MAGIC:
+            self.reader = FrameReader(self.server.buffer_size)
+            self.reader.feed(view)
+            self.receive_frames()
+            return
+        # 未登录时第一包数据为账号密码
+        if self.device_id is None:
+            self.server.login(self, bytes(view))
+            return
+        self.last_recv_time = time.monotonic()
+        start = time.perf_counter()
+
+        # 一对一透传组直接发送接收缓冲区中的数据
+        target_device_id = self.server.routing.get_pair_target(self.device_id)
+        if self.server.is_raw_target(target_device_id):
+            self.server.forward_to_pair(self.device_id, target_device_id, view, self.remote_addr)
+        else:
+            # 获取目标设备ID
+            target_device_ids = self.server.get_target_device_id(self.device_id)
+            self.server.forward_message(self.device_id, self.username, self.password, bytes(view), self.remote_addr,
+                                        target_device_ids)
+        self.server.metrics.record_received(self.device_id, 1, nbytes, time.perf_counter() - start)
+        self.server.shape(self, nbytes, 1)
+
+    # 帧协议:第一帧为登录帧(加密模式第二帧为认证帧),登录后转发所有完整的数据帧;
+    # 限速时每批最多转发max_messages帧,超出限速暂停读取后剩下的帧留在缓冲区中,恢复读取前再转发
+    def receive_frames(self):
+        try:
+            while self.device_id is None:
+                frame = self.reader.next_frame()
+                if frame is None or self.transport.is_closing():
+                    return
+                if self.challenge is not None:
+                    self.server.finish_login(self, frame)
+                    continue
+                frame_type, payload = frame
+                if frame_type != LOGIN:
+                    raise FrameError('第一帧不是登录帧')
+                self.server.login(self, payload)
+            self.last_recv_time = time.monotonic()
+            max_messages = self.server.get_limiter(self.device_id, self).max_messages
+            while True:
+                messages, nbytes = self.server.handle_frames(self.device_id, self.reader, self.remote_addr,
+                                                             self.cipher, max_messages)
+                if self.server.shape(self, nbytes, messages) or not max_messages or messages < max_messages:
+                    return
+        except FrameError as e:
+            logger.warning('设备 %s 发生错误:%s,与其断开连接', self.remote_addr, e)
+            self.transport.abort()
+
+    def connection_lost(self, exc):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+        if self.shaping_handle is not None:
+            self.shaping_handle.cancel()
+        self.server.logout(self)
+        self.queue.buffers.clear()
+        self.queue.queued_bytes = 0
+        self.resume_sources()
+
+    # 发送数据,transport发送缓冲区未满且队列为空时直接写入,否则按策略入队,返回QUEUED/FULL/CLOSE
+    def send(self, data):
+        if self.coalesce_delay and not self.writing_paused and not self.queue.buffers:
+            # 合并发送:攒够coalesce_bytes字节或等待coalesce_delay秒后一次写入
+            self.pending.append(data)
+            self.pending_bytes += len(data)
+            if self.pending_bytes >= self.coalesce_bytes:
+                self.flush_pending()
+            elif self.flush_handle is None:
+                self.flush_handle = self.server.loop.call_later(self.coalesce_delay, self.flush_pending)
+            return QUEUED
+        # 先发送等待合并的数据,保证顺序
+        if self.pending:
+            self.flush_pending()
+        if not self.writing_paused and not self.queue.buffers:
+            self.transport.write(data)
+            return QUEUED
+        result = self.queue.push(data)
+        if result == CLOSE:
+            self.transport.abort()
+        return result
+
+    # 一次写入等待合并发送的数据,transport不能写入时放入发送队列
+    def flush_pending(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        pending = self.pending
+        self.pending = []
+        self.pending_bytes = 0
+        if self.writing_paused or self.queue.buffers:
+            for data in pending:
+                self.queue.append(data)
+            return
+        self.transport.writelines(pending)
+        self.uncork()
+
+    # cork模式下写入后取消TCP_CORK再重新设置,推出内核中不满一个报文段的剩余数据
+    def uncork(self):
+        if self.cork:
+            sock = self.transport.get_extra_info('socket')
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+
+    # 发送缓冲区超过上限
+    def pause_writing(self):
+        self.writing_paused = True
+
+    # 发送缓冲区降到下限以下,继续发送队列中的数据
+    def resume_writing(self):
+        if self.handed_off:
+            return
+        self.writing_paused = False
+        written = False
+        while self.queue.buffers and not self.writing_paused:
+            self.transport.write(self.queue.popleft())
+            written = True
+        # 发送队列中的数据与合并发送一样需要推出,否则cork模式下最后不满一个报文段的数据要等内核超时才发出
+        if written:
+            self.uncork()
+        if self.queue.writable():
+            self.resume_sources()
+
+    # 恢复因本设备发送队列满而暂停读取的发送方
+    # 修改发送队列大小和策略,队列有空间后恢复读取暂停的发送方
+    def set_limits(self, max_bytes, policy):
+        self.queue.set_limits(max_bytes, policy)
+        if self.queue.writable():
+            self.resume_sources()
+
+    def resume_sources(self):
+        for source in self.paused_sources:
+            # 超出限速暂停读取的发送方等定时器到时再恢复
+            if source.shaping_handle is None:
+                source.transport.resume_reading()
+        self.paused_sources.clear()
+
+    # 还清限速欠账,先转发缓冲区中剩下的帧,没有再次超出限速时恢复读取
+    def resume_shaped(self):
+        self.shaping_handle = None
+        if self.handed_off or self.transport.is_closing():
+            return
+        if self.reader is not None:
+            self.receive_frames()
+            if self.shaping_handle is not None:
+                return
+        self.transport.resume_reading()
+
+    # 平滑重启:交给新进程的连接状态,包括还没有处理的半帧数据和发送队列中的数据
+    def get_state(self):
+        return {
+            'device_id': self.device_id,
+            'username': self.username,
+            'password': self.password,
+            'framed': self.framed,
+            'received': self.reader.get_pending() if self.reader is not None else b'',
+            'queued': list(self.queue.buffers),
+            'cipher': self.cipher.get_state() if self.cipher is not None else None,
+        }
+
+    # 平滑重启:恢复旧进程交出的连接状态
+    def set_state(self, state):
+        self.device_id = state['device_id']
+        self.username = state['username']
+        self.password = state['password']
+        self.framed = state['framed']
+        if self.framed:
+            self.reader = FrameReader(self.server.buffer_size)
+            self.reader.feed(state['received'])
+        if state['cipher'] is not None:
+            self.cipher = SessionCipher.from_state(state['cipher'])
+
+    def get_stats(self):
+        stats = self.queue.get_stats()
+        stats['write_buffer_bytes'] = self.transport.get_write_buffer_size()
+        return stats
+
+    def close(self):
+        self.transport.close()
+
+    # 空闲超时断开设备
+    def shutdown(self):
+        self.transport.close()
+
+    # 登录超时断开设备
+    def check_login(self):
+        if self.device_id is None and not self.transport.is_closing():
+            logger.info('设备 %s 超过 %s 秒没有登录,与其断开连接', self.remote_addr, self.server.login_timeout)
+            self.transport.abort()
+
+
+class AsyncTCPServer(TCPServer):
+    """
+    异步模式:单线程事件循环处理所有设备连接,线程数与设备数量无关
+    登录 → get_target_device_id → forward_message 流程与线程模式相同
+    """
+    can_adopt_devices = True
+
+    def __init__(self, db_file=DEFAULT_DB_FILE, routing=None, credentials=None, metrics=None, config=None):
+        super().__init__(db_file, routing, credentials, metrics, config)
+        self.loop = None
+        self.recv_view = None
+        # 正在监听的asyncio服务器 'tcp'/'tls' -> Server
+        self.servers = {}
+        # 平滑重启:从旧进程接管、还没有开始读取的连接
+        self.adopted = []
+        # 等待开始登录的连接(暂停读取),以及到时继续处理它们的定时器
+        self.waiting = collections.deque()
+        self.admit_handle = None
+
+    # 分配新的接收缓冲区
+    def new_recv_buffer(self):
+        self.recv_view = memoryview(bytearray(self.buffer_size))
+
+    # TLS连接与普通连接在同一个事件循环中处理
+    def start_tls(self, tls_port):
+        try:
+            self.ssl_context = create_server_context(self.get_config('tlsCertFile', ''),
+                                                     self.get_config('tlsKeyFile', ''))
+        except (OSError, ValueError) as e:
+            logger.error('加载TLS证书失败:%s,不启用TLS', e)
+            return
+        self.tls_socket = self.create_server_socket(tls_port)
+        logger.info('TLS服务器正在监听端口 %s...', tls_port)
+
+    def start_accepting(self):
+        if self.use_splice:
+            logger.warning('异步模式不支持splice,使用普通转发')
+            self.use_splice = False
+        self.new_recv_buffer()
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.run_loop).start()
+
+    # 一对一透传组转发,目标设备可以直接发送时写入接收缓冲区中的数据,不复制
+    def forward_to_pair(self, device_id, target_device_id, view, remote_addr):
+        target = self.device_connections[target_device_id]
+        self.metrics.record_forward(device_id, target_device_id, 1, len(view))
+        if target.writing_paused or target.queue.buffers or target.coalesce_delay:
+            self.send_to_device(device_id, target, bytes(view))
+            return
+        target.last_send_time = time.monotonic()
+        target.transport.write(view)
+        # 没有一次发完时目标连接的发送缓冲区会引用这块内存,换一块新的接收缓冲区
+        if target.transport.get_write_buffer_size():
+            self.new_recv_buffer()
+
+    # 发送数据给目标设备,队列满且策略为暂停时暂停读取发送方的数据
+    def send_to_device(self, device_id, target, message):
+        target.last_send_time = time.monotonic()
+        if target.send(message) == FULL:
+            source = self.device_connections.get(device_id)
+            if source is not None and source is not target:
+                source.transport.pause_reading()
+                target.paused_sources.add(source)
+
+    # 超出限速时暂停读取发送方,数据留在内核的接收缓冲区,还清欠账后再恢复读取;返回是否暂停
+    def shape(self, protocol, nbytes, nmessages):
+        delay = self.get_shaping_delay(protocol.device_id, protocol, nbytes, nmessages)
+        if not delay or protocol.transport.is_closing():
+            return False
+        protocol.transport.pause_reading()
+        if protocol.shaping_handle is not None:
+            protocol.shaping_handle.cancel()
+        protocol.shaping_handle = self.loop.call_later(delay, protocol.resume_shaped)
+        return True
+
+    def run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.start_serving())
+        # 事件循环中只用一个定时器推进时间轮
+        self.loop.call_later(self.timer_wheel.tick, self.advance_timer_wheel)
+        self.loop.run_forever()
+
+    async def start_serving(self):
+        await self.replace_server('tcp', self.server_socket)
+        if self.tls_socket is not None:
+            await self.replace_server('tls', self.tls_socket)
+
+    # 在监听socket上开始接受连接,替换掉的旧服务器继续接受连接LISTENER_DRAIN_TIME秒后关闭,已建立的连接不受影响
+    async def replace_server(self, name, server_socket):
+        server = None
+        if server_socket is not None:
+            if name == 'tls':
+                server = await self.loop.create_server(lambda: DeviceProtocol(self), sock=server_socket,
+                                                       backlog=self.backlog, ssl=self.ssl_context,
+                                                       ssl_handshake_timeout=TLS_HANDSHAKE_TIMEOUT)
+            else:
+                # backlog同时是每次可读时最多连续accept的连接数
+                server = await self.loop.create_server(lambda: DeviceProtocol(self), sock=server_socket,
+                                                       backlog=self.backlog)
+        old_server = self.servers.pop(name, None)
+        if server is not None:
+            self.servers[name] = server
+        if old_server is not None:
+            self.loop.call_later(LISTENER_DRAIN_TIME, old_server.close)
+
+    # 配置修改在事件循环线程中应用,与设备连接的处理不需要加锁
+    def on_config_change(self, names):
+        self.loop.call_soon_threadsafe(self.apply_config, names)
+
+    def apply_config(self, names):
+        super().apply_config(names)
+        if 'tcpBufferSize' in names:
+            self.new_recv_buffer()
+        # 证书修改后新的TLS握手使用新证书
+        if names & {'tlsCertFile', 'tlsKeyFile'} and 'tlsPort' not in names and 'tls' in self.servers:
+            try:
+                self.ssl_context.load_cert_chain(self.get_config('tlsCertFile', ''),
+                                                 self.get_config('tlsKeyFile', '') or None)
+                logger.info('已重新加载TLS证书')
+            except (OSError, ValueError) as e:
+                logger.error('加载TLS证书失败:%s,继续使用原来的证书', e)
+
+    def rebind(self, tcp_port):
+        server_socket = self.open_listener(tcp_port)
+        if server_socket is None:
+            return
+        self.server_socket = server_socket
+        self.loop.create_task(self.replace_server('tcp', server_socket))
+        logger.info('TCP服务器改为监听端口 %s,原来的端口 %s 秒后关闭', tcp_port, LISTENER_DRAIN_TIME)
+
+    # 修改TLS端口,改为0时关闭TLS监听
+    def rebind_tls(self, tls_port):
+        self.tls_socket = None
+        if tls_port:
+            try:
+                self.start_tls(tls_port)
+            except OSError as e:
+                logger.error('监听端口 %s 失败:%s,继续使用原来的端口', tls_port, e)
+                return
+            if self.tls_socket is None:
+                return
+        self.loop.create_task(self.replace_server('tls', self.tls_socket))
+
+    def advance_timer_wheel(self):
+        self.loop.call_later(self.timer_wheel.tick, self.advance_timer_wheel)
+        self.timer_wheel.advance()
+
+    # 新连接:同一IP未登录的连接太多时断开;令牌用完或正在登录的连接太多时暂停读取,排队等待开始登录
+    def admit(self, protocol):
+        ip = protocol.remote_addr[0]
+        if not self.admission.open(ip):
+            throttled.warning(ip, '%s 未登录的连接太多,断开新连接', ip)
+            protocol.transport.abort()
+            return
+        protocol.client_ip = ip
+        if not self.waiting and not self.admission.wait_time():
+            self.start_login(protocol)
+            return
+        # 排队的连接也占用文件描述符,超过监听队列长度时断开
+        if len(self.waiting) >= self.backlog:
+            throttled.warning('waiting', '等待登录的连接超过 %s 个,断开新连接', self.backlog)
+            protocol.transport.abort()
+            return
+        protocol.transport.pause_reading()
+        self.waiting.append(protocol)
+        if self.admit_handle is None:
+            self.admit_handle = self.loop.call_later(self.admission.wait_time(), self.admit_waiting)
+
+    # 按到达顺序开始处理排队的连接
+    def admit_waiting(self):
+        self.admit_handle = None
+        while self.waiting:
+            wait = self.admission.wait_time()
+            if wait:
+                self.admit_handle = self.loop.call_later(wait, self.admit_waiting)
+                return
+            protocol = self.waiting.popleft()
+            if protocol.transport.is_closing():
+                continue
+            self.start_login(protocol)
+            protocol.transport.resume_reading()
+
+    def start_login(self, protocol):
+        self.admission.start()
+        protocol.admitted = True
+        if self.login_timeout:
+            protocol.login_timer = self.timer_wheel.schedule(self.login_timeout, protocol.check_login)
+
+    # 登录成功或连接断开:取消登录超时,不再计入正在登录的连接数和同一IP未登录的连接数
+    def end_login(self, protocol):
+        if protocol.login_timer is not None:
+            protocol.login_timer.cancel()
+            protocol.login_timer = None
+        if protocol.admitted:
+            self.admission.finish()
+            protocol.admitted = False
+        if protocol.client_ip is not None:
+            self.admission.close(protocol.client_ip)
+            protocol.client_ip = None
+
+    def login(self, protocol, data):
+        remote_addr = protocol.remote_addr
+        try:
+            cipher_login = protocol.reader is not None and is_cipher_login(data)
+            data = data.decode()
+            if cipher_login:
+                # 加密模式:发送挑战帧,等待设备的认证帧
+                username, device_id, master, server_nonce = self.begin_cipher_login(data)
+                protocol.challenge = (username, device_id, master)
+                protocol.transport.write(pack_frame(CHALLENGE, server_nonce))
+                return
+        except Exception as e:
+            logger.warning('设备 %s 发生错误:%s,与其断开连接', remote_addr, e)
+            protocol.close()
+            return
+
+        # 解析用户名和密码
+        username, password = self.parse_credentials(data)
+
+        # 验证用户名和密码,成功时得到设备ID
+        device_id = self.verify_credentials(username, password)
+        if device_id is None:
+            logger.warning('设备 %s %s 账号或密码不对!与其断开连接', remote_addr, username)
+            protocol.close()
+            return
+        self.complete_login(protocol, device_id, username, password)
+
+    # 加密模式:检查认证帧
+    def finish_login(self, protocol, frame):
+        username, device_id, master = protocol.challenge
+        protocol.challenge = None
+        protocol.cipher = self.finish_cipher_login(master, frame)
+        if protocol.cipher is None:
+            logger.warning('设备 %s %s 加密登录认证失败!与其断开连接', protocol.remote_addr, username)
+            protocol.close()
+            return
+        self.complete_login(protocol, device_id, username, '')
+
+    # 先补发离线期间缓存的数据再关联连接,之后实时转发的数据排在后面;有落盘数据时在写盘线程中读取,
+    # 读完回到事件循环补发,读取期间发给本设备的数据继续进入离线缓存,补发完内存中的数据后才关联连接
+    def attach_device(self, device_id, protocol):
+        if self.offline.is_spooled(device_id):
+            self.take_offline_later(device_id, self.resume_attach, device_id, protocol)
+            return
+        self.replay_offline(device_id, protocol)
+        self.add_device_connection(device_id, protocol)
+
+    def resume_attach(self, device_id, protocol, messages):
+        if protocol.transport.is_closing():
+            self.adopt_offline(device_id, messages)
+            return
+        self.send_offline(device_id, protocol, messages)
+        self.attach_device(device_id, protocol)
+
+    # 读取的结果交回事件循环处理
+    def take_offline_later(self, device_id, callback, *args):
+        self.offline.take_later(device_id, lambda messages: self.loop.call_soon_threadsafe(callback, *args, messages))
+
+    # 设备不在线时占用设备ID并返回True,已在线返回False;单进程中登录都在事件循环里处理,检查在线状态即可
+    def claim_device(self, device_id):
+        return not self.is_device_online(device_id)
+
+    # 账号验证通过,检查重复登录并关联设备ID和连接
+    def complete_login(self, protocol, device_id, username, password):
+        remote_addr = protocol.remote_addr
+
+        # 检查设备是否已在线
+        if not self.claim_device(device_id):
+            logger.warning('设备 %s %s 已在线,重复登陆!与其断开连接', remote_addr, username)
+            protocol.close()
+            return
+
+        self.end_login(protocol)
+
+        # 更新在线状态为在线
+        self.update_device_online_status(device_id, 1)
+
+        # 关联设备ID和连接
+        protocol.device_id = device_id
+        protocol.username = username
+        protocol.password = password
+        protocol.framed = protocol.reader is not None
+        self.set_device_options(device_id, protocol, protocol.transport.get_extra_info('socket'))
+        if protocol.framed:
+            protocol.send(pack_frame(ACK, b'loginSuccess'))
+        self.attach_device(device_id, protocol)
+
+        logger.info('设备 %s %s %s 登录成功!', remote_addr, device_id, username)
+
+        # 心跳包和空闲超时交给时间轮处理
+        self.start_device_timer(device_id, protocol)
+
+    def logout(self, protocol):
+        self.end_login(protocol)
+        if protocol.timer is not None:
+            protocol.timer.cancel()
+        if protocol.device_id is None:
+            return
+        logger.info('%s 断开这个设备！', protocol.device_id)
+        self.update_device_online_status(protocol.device_id, 0)
+        # 移除设备连接
+        self.remove_device_connection(protocol.device_id)
+
+    # 平滑重启:关闭监听,已经建立的连接不受影响
+    def close_listeners(self):
+        self.loop.call_soon_threadsafe(self.close_servers)
+
+    def close_servers(self):
+        for server in self.servers.values():
+            server.close()
+        self.servers.clear()
+
+    def detach_devices(self, adopt):
+        return asyncio.run_coroutine_threadsafe(self.detach_connections(adopt), self.loop).result()
+
+    # 平滑重启:停止读取所有设备,等待transport的发送缓冲区清空(最多HANDOFF_DRAIN_TIMEOUT秒),
+    # 发送队列中剩下的数据和连接一起交给新进程;TLS连接和没有发完的连接关闭,设备重新连接到新进程
+    async def detach_connections(self, adopt):
+        protocols = list(self.device_connections.values())
+        for protocol in protocols:
+            protocol.transport.pause_reading()
+            protocol.flush_pending()
+            protocol.handed_off = protocol.writing_paused = True
+        deadline = self.loop.time() + HANDOFF_DRAIN_TIMEOUT
+        while self.loop.time() < deadline and any(protocol.transport.get_write_buffer_size()
+                                                  for protocol in protocols if not protocol.transport.is_closing()):
+            await asyncio.sleep(0.01)
+        devices = []
+        for protocol in protocols:
+            transport = protocol.transport
+            if not adopt or transport.is_closing() or transport.get_write_buffer_size() or \
+                    transport.get_extra_info('sslcontext') is not None:
+                transport.close()
+                continue
+            # 复制文件描述符后关闭transport,连接不会断开
+            devices.append((os.dup(transport.get_extra_info('socket').fileno()), protocol.get_state()))
+            transport.abort()
+        return devices
+
+    def adopt_device(self, sock, state):
+        asyncio.run_coroutine_threadsafe(self.adopt_connection(sock, state), self.loop).result()
+
+    # 平滑重启:接管旧进程交出的已登录连接,先发送旧进程发送队列中的数据
+    async def adopt_connection(self, sock, state):
+        device_id = state['device_id']
+        if self.is_device_online(device_id):
+            logger.warning('设备 %s 已重新登录,关闭旧进程交出的连接', device_id)
+            sock.close()
+            return
+        # 登录状态在建立transport之前恢复,之后收到的数据直接转发
+        protocol = DeviceProtocol(self)
+        protocol.set_state(state)
+        await self.loop.connect_accepted_socket(lambda: protocol, sock=sock)
+        self.update_device_online_status(device_id, 1)
+        self.set_device_options(device_id, protocol, sock)
+        for data in state['queued']:
+            protocol.send(data)
+        self.attach_device(device_id, protocol)
+        self.start_device_timer(device_id, protocol)
+        self.adopted.append(protocol)
+
+    def finish_takeover(self):
+        asyncio.run_coroutine_threadsafe(self.resume_adopted(), self.loop).result()
+        super().finish_takeover()
+
+    # 所有连接都接管后开始读取,先处理旧进程收到的半帧数据
+    async def resume_adopted(self):
+        for protocol in self.adopted:
+            if protocol.transport.is_closing():
+                continue
+            if protocol.framed:
+                protocol.receive_frames()
+            protocol.transport.resume_reading()
+        self.adopted.clear()
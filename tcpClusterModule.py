@@ -0,0 +1,437 @@
+import asyncio
+import atexit
+import logging
+import multiprocessing
+import os
+import pickle
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+
+from databases.DB import DEFAULT_DB_FILE, get_pool
+from log import ThrottledLogger, settings as log_settings, setup_worker_logging
+from metrics import merge_snapshot
+from security import create_server_context
+from send_queue import FULL
+from tcpAsyncModule import AsyncTCPServer, DeviceProtocol
+from tcpModule import set_reuse_address
+
+logger = logging.getLogger(__name__)
+throttled = ThrottledLogger(logger)
+
+# 进程间转发的帧头:目标设备ID(4字节) + 来源设备ID(4字节) + 数据长度(4字节)
+# 来源设备ID为0且没有数据时表示目标设备在对方进程上线,本进程补发缓存的数据
+PEER_HEADER = struct.Struct('!III')
+
+# 工作进程写入转发统计的间隔(秒)
+METRICS_INTERVAL = 1
+
+# 启动时等待连接其他工作进程的最长时间(秒),超时后照常接受设备连接,连接建立前转发的数据先放入离线缓存
+PEER_CONNECT_TIMEOUT = 10
+
+# 主进程退出时等待工作进程退出的最长时间(秒),超时后结束工作进程
+WORKER_STOP_TIMEOUT = 5
+
+# 工作进程意外退出后重新启动前等待的时间(秒),避免启动即崩溃时不停重启
+WORKER_RESTART_DELAY = 1
+
+
+# 工作进程的转发统计文件
+def get_metrics_path(socket_dir, worker):
+    return os.path.join(socket_dir, f'metrics-{worker}.pickle')
+
+
+class PeerProtocol(DeviceProtocol):
+    """
+    与其他工作进程之间的Unix域socket连接
+    主动连接出去的用于发送(worker为对方编号),对方连进来的用于接收(worker为None)
+    """
+
+    def __init__(self, server, worker=None):
+        super().__init__(server)
+        self.worker = worker
+        # 还没有收完整的帧
+        self.partial = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.remote_addr = f'worker-{self.worker}'
+        transport.set_write_buffer_limits(high=65536)
+
+    def buffer_updated(self, nbytes):
+        self.partial += self.server.recv_view[:nbytes]
+        offset = 0
+        while len(self.partial) - offset >= PEER_HEADER.size:
+            target_device_id, device_id, length = PEER_HEADER.unpack_from(self.partial, offset)
+            end = offset + PEER_HEADER.size + length
+            if end > len(self.partial):
+                break
+            self.server.deliver_from_peer(self, device_id, target_device_id,
+                                          bytes(self.partial[offset + PEER_HEADER.size:end]))
+            offset = end
+        del self.partial[:offset]
+
+    def connection_lost(self, exc):
+        self.resume_sources()
+        if self.worker is not None:
+            self.server.on_peer_lost(self.worker)
+
+
+class ShardedTCPServer(AsyncTCPServer):
+    """
+    多进程模式下的一个工作进程,多个进程用SO_REUSEPORT监听同一个端口,由内核分配设备连接
+    设备在哪个进程在线记录在共享内存中,目标设备在其他进程时通过Unix域socket转发
+    """
+
+    def __init__(self, db_file, worker, workers, registry_name, registry_lock, socket_dir, ssl_context=None):
+        super().__init__(db_file)
+        # 主进程创建的TLS上下文,为None时本进程自己创建
+        self.shared_ssl_context = ssl_context
+        # 本进程编号(从1开始)和进程总数
+        self.worker = worker
+        self.workers = workers
+        self.socket_dir = socket_dir
+        # 共享注册表,下标为设备ID,值为设备所在进程编号,0为离线;下标0存放路由表、登录信息和配置的版本号
+        self.registry_memory = shared_memory.SharedMemory(name=registry_name)
+        self.registry = self.registry_memory.buf.cast('i')
+        # 跨进程的注册表锁,登记和清除设备时先比较再修改,同一个设备同时登录到两个进程时只有一个成功
+        self.registry_lock = registry_lock
+        self.routing_version = self.registry[0]
+        # 发往其他进程的连接 worker -> PeerProtocol
+        self.peers = {}
+        # 正在写盘线程中读取缓存、准备转发给其他进程的目标设备ID,期间发给这些设备的数据也先缓存
+        self.replaying = set()
+
+    # 由主进程统一设置离线状态
+    def reset_online_status(self):
+        pass
+
+    # 每个工作进程使用自己的离线缓存目录
+    def get_spool_dir(self):
+        return os.path.join(super().get_spool_dir(), f'worker-{self.worker}')
+
+    def create_server_socket(self, tcp_port):
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        set_reuse_address(server_socket)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server_socket.bind(('0.0.0.0', tcp_port))
+        server_socket.listen(self.backlog)
+        return server_socket
+
+    def start_tls(self, tls_port):
+        if self.shared_ssl_context is None:
+            super().start_tls(tls_port)
+            return
+        self.ssl_context = self.shared_ssl_context
+        self.tls_socket = self.create_server_socket(tls_port)
+        logger.info('TLS服务器正在监听端口 %s...', tls_port)
+
+    # 先连接其他工作进程,再开始接受设备连接,避免转发时还没有到目标设备所在进程的连接
+    async def start_serving(self):
+        await self.loop.create_unix_server(lambda: PeerProtocol(self), path=self.get_socket_path(self.worker))
+        tasks = [self.loop.create_task(self.connect_peer(worker))
+                 for worker in range(1, self.workers + 1) if worker != self.worker]
+        if tasks:
+            await asyncio.wait(tasks, timeout=PEER_CONNECT_TIMEOUT)
+        await super().start_serving()
+        self.loop.call_later(METRICS_INTERVAL, self.write_metrics)
+
+    def get_socket_path(self, worker):
+        return os.path.join(self.socket_dir, f'worker-{worker}.sock')
+
+    # 连接其他工作进程,对方还没启动时重试
+    async def connect_peer(self, worker):
+        while True:
+            try:
+                transport, protocol = await self.loop.create_unix_connection(
+                    lambda: PeerProtocol(self, worker), self.get_socket_path(worker))
+                self.peers[worker] = protocol
+                # 补发连接建立前放入离线缓存的数据
+                for target_device_id in self.offline.get_buffered_devices():
+                    if self.get_device_worker(target_device_id) == worker:
+                        self.replay_to_peer(target_device_id, protocol)
+                return
+            except OSError:
+                await asyncio.sleep(0.1)
+
+    def on_peer_lost(self, worker):
+        self.peers.pop(worker, None)
+        self.loop.create_task(self.connect_peer(worker))
+
+    # 定时把本进程的转发统计写入文件,由主进程汇总
+    def write_metrics(self):
+        self.loop.call_later(METRICS_INTERVAL, self.write_metrics)
+        path = get_metrics_path(self.socket_dir, self.worker)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(self.metrics.snapshot(), f)
+        os.replace(path + '.tmp', path)
+
+    def advance_timer_wheel(self):
+        # 主进程修改透传组、设备或配置后会增加共享的版本号
+        if self.registry[0] != self.routing_version:
+            self.routing_version = self.registry[0]
+            self.routing.reload()
+            self.credentials.reload()
+            self.config.reload()
+        super().advance_timer_wheel()
+
+    # 获取设备所在的进程编号,0为离线
+    def get_device_worker(self, device_id):
+        if 0 < device_id < len(self.registry):
+            return self.registry[device_id]
+        return 0
+
+    def is_device_online(self, device_id):
+        return self.get_device_worker(device_id) != 0
+
+    def is_connected(self, device_id):
+        return self.get_device_worker(device_id) != 0
+
+    # 登录时在注册表中比较并登记,在回复登录应答之前完成,设备收到应答后对端立即发来的数据在其他进程也能找到它;
+    # 其他进程转发来的数据在这次登录处理完之后才会读取,那时连接已经关联
+    def claim_device(self, device_id):
+        if not 0 < device_id < len(self.registry):
+            return not self.is_device_online(device_id)
+        with self.registry_lock:
+            if self.registry[device_id]:
+                return False
+            self.registry[device_id] = self.worker
+            return True
+
+    def add_device_connection(self, device_id, connection):
+        super().add_device_connection(device_id, connection)
+        # 有开启离线缓存的透传组时通知其他进程,不用等定时任务就能补发它们缓存的数据
+        if self.routing.buffered:
+            for peer in list(self.peers.values()):
+                peer.send(PEER_HEADER.pack(device_id, 0, 0))
+
+    def remove_device_connection(self, device_id):
+        super().remove_device_connection(device_id)
+        if 0 < device_id < len(self.registry):
+            with self.registry_lock:
+                if self.registry[device_id] == self.worker:
+                    self.registry[device_id] = 0
+
+    # 目标设备在其他进程时通过Unix域socket转发
+    def forward_not_connected(self, device_id, target_device_id, message, remote_addr):
+        worker = self.get_device_worker(target_device_id)
+        peer = self.peers.get(worker)
+        if peer is None:
+            # 目标设备在其他进程,但到这个进程的连接还没有建立(启动中或对方进程重启),
+            # 先放入离线缓存,连接建立后按顺序补发
+            if worker and worker != self.worker:
+                self.offline.push(device_id, target_device_id, message)
+                return
+            super().forward_not_connected(device_id, target_device_id, message, remote_addr)
+            return
+        # 目标设备刚在其他进程上线,先转发本进程缓存的数据,保证顺序;缓存还要读文件时这条数据排在缓存后面
+        if target_device_id in self.replaying or self.offline.is_spooled(target_device_id):
+            self.offline.push(device_id, target_device_id, message)
+            self.replay_to_peer(target_device_id, peer)
+            return
+        if self.offline.has_messages(target_device_id):
+            self.replay_to_peer(target_device_id, peer)
+        self.send_to_device(device_id, peer, PEER_HEADER.pack(target_device_id, device_id, len(message)) + message)
+        self.metrics.record_forward(device_id, target_device_id, 1, len(message))
+
+    # 收到其他进程转发来的数据
+    def deliver_from_peer(self, peer, device_id, target_device_id, message):
+        if not device_id:
+            self.replay_buffered(target_device_id)
+            return
+        target = self.device_connections.get(target_device_id)
+        if target is None:
+            # 目标设备已经断开,透传组开启了离线缓存时由本进程缓存
+            if target_device_id in self.routing.get_buffered_targets(device_id):
+                self.offline.push(device_id, target_device_id, message)
+            else:
+                throttled.warning((device_id, target_device_id), '设备 %s 消息转发失败,设备 %s 不在线!',
+                                  device_id, target_device_id)
+            return
+        target.last_send_time = time.monotonic()
+        # 目标设备发送队列满时暂停接收这个进程转发来的数据
+        if target.send(self.encode_message(target, message)) == FULL:
+            peer.transport.pause_reading()
+            target.paused_sources.add(peer)
+
+    # 设备在本进程上线时直接补发,在其他进程上线时把缓存的数据转发过去
+    def replay_buffered(self, device_id):
+        worker = self.get_device_worker(device_id)
+        if worker == self.worker:
+            super().replay_buffered(device_id)
+        elif worker in self.peers:
+            self.replay_to_peer(device_id, self.peers[worker])
+
+    # 把发给target_device_id的缓存数据转发给设备所在的进程;有落盘数据时在写盘线程中读取,读完回到事件循环转发
+    def replay_to_peer(self, target_device_id, peer):
+        if target_device_id in self.replaying:
+            return
+        if self.offline.is_spooled(target_device_id):
+            self.replaying.add(target_device_id)
+            self.take_offline_later(target_device_id, self.resume_replay_to_peer, target_device_id, peer)
+            return
+        self.send_offline_to_peer(target_device_id, peer, self.offline.take(target_device_id))
+
+    def resume_replay_to_peer(self, target_device_id, peer, messages):
+        self.replaying.discard(target_device_id)
+        if peer.transport.is_closing():
+            # 到对方进程的连接已经断开,放回离线缓存,重新连接后补发
+            self.adopt_offline(target_device_id, messages)
+            return
+        self.send_offline_to_peer(target_device_id, peer, messages)
+        # 继续转发读取期间缓存的数据
+        self.replay_buffered(target_device_id)
+
+    def send_offline_to_peer(self, target_device_id, peer, messages):
+        if not messages:
+            return
+        peer.send(b''.join([PEER_HEADER.pack(target_device_id, device_id, len(message)) + message
+                            for device_id, message in messages]))
+        for device_id, message in messages:
+            self.metrics.record_forward(device_id, target_device_id, 1, len(message))
+
+
+# 工作进程入口
+def run_worker(db_file, worker, workers, registry_name, registry_lock, socket_dir, log_options, ssl_context=None):
+    setup_worker_logging(worker, log_options)
+    ShardedTCPServer(db_file, worker, workers, registry_name, registry_lock, socket_dir, ssl_context).start()
+    # 由主进程的监控线程重新启动时,子进程中创建的线程都继承了守护线程属性,主线程不能退出
+    threading.Event().wait()
+
+
+class TCPCluster(object):
+    """
+    多进程模式:启动多个工作进程共同监听tcpPort,吞吐量随CPU核数增加
+    主进程只负责初始化共享注册表、通知路由表修改和重新启动意外退出的工作进程,不处理设备连接
+    """
+
+    def __init__(self, db_file=DEFAULT_DB_FILE, routing=None, workers=2, credentials=None, metrics=None, config=None):
+        self.db_file = db_file
+        self.routing = routing
+        self.credentials = credentials
+        self.metrics = metrics
+        self.config = config
+        self.workers = workers
+        # 工作进程,下标为进程编号减1
+        self.processes = []
+        self.ssl_context = None
+        self.stopping = False
+
+    def start(self):
+        with get_pool(self.db_file).connection() as conn:
+            # 注册表能容纳的最大设备ID
+            result = conn.execute('SELECT value FROM config WHERE name="tcpMaxDeviceId"').fetchone()
+            max_device_id = int(result[0]) if result else 1048576
+            # 将所有协议类型为tcpServer的设备设置为离线状态
+            conn.execute('UPDATE devices SET online=0 WHERE protocol="tcpServer"')
+            tls = dict(conn.execute('SELECT name, value FROM config WHERE name IN '
+                                    '("tlsPort", "tlsCertFile", "tlsKeyFile")').fetchall())
+
+        self.registry_memory = shared_memory.SharedMemory(create=True, size=4 * (max_device_id + 1))
+        self.registry = self.registry_memory.buf.cast('i')
+        self.registry_lock = multiprocessing.Lock()
+        self.socket_dir = tempfile.mkdtemp(prefix='translucent-cloud-')
+        atexit.register(self.stop)
+
+        # web管理页面修改透传组或设备后通知工作进程重新加载路由表和登录信息
+        if self.routing is not None:
+            self.routing.add_listener(self.on_routing_change)
+        if self.credentials is not None:
+            self.credentials.add_listener(self.on_routing_change)
+        # web管理页面修改配置后通知工作进程立即重新读取,不用等configPollInterval
+        if self.config is not None:
+            self.config.add_listener(self.on_config_change)
+        # web管理页面读取统计时汇总所有工作进程的数据
+        if self.metrics is not None:
+            self.metrics.add_collector(self.collect_metrics)
+
+        # fork出来的工作进程共用主进程创建的TLS上下文(同一个会话票据密钥),设备重连到任何一个进程都能恢复会话;
+        # 其他启动方式不能传递TLS上下文,由工作进程各自创建
+        if int(tls.get('tlsPort', '0')) and multiprocessing.get_start_method() == 'fork':
+            try:
+                self.ssl_context = create_server_context(tls.get('tlsCertFile', ''), tls.get('tlsKeyFile', ''))
+            except (OSError, ValueError):
+                # 由工作进程输出错误
+                pass
+
+        logger.info('TCP多进程模式,启动 %s 个工作进程', self.workers)
+        self.processes = [self.start_worker(worker) for worker in range(1, self.workers + 1)]
+        threading.Thread(target=self.monitor_workers, daemon=True).start()
+
+    def start_worker(self, worker):
+        process = multiprocessing.Process(target=run_worker, args=(
+            self.db_file, worker, self.workers, self.registry_memory.name, self.registry_lock, self.socket_dir,
+            log_settings, self.ssl_context))
+        process.start()
+        return process
+
+    # 工作进程意外退出时清除它在注册表中登记的设备,设备可以重新登录到其他进程,然后重新启动这个工作进程
+    def monitor_workers(self):
+        while not self.stopping:
+            sentinels = {process.sentinel: worker for worker, process in enumerate(self.processes, 1)}
+            for sentinel in wait(list(sentinels)):
+                if self.stopping:
+                    return
+                worker = sentinels[sentinel]
+                self.processes[worker - 1].join()
+                logger.error('工作进程 %s 意外退出(退出码 %s),%s 秒后重新启动', worker,
+                             self.processes[worker - 1].exitcode, WORKER_RESTART_DELAY)
+                self.release_worker_devices(worker)
+                time.sleep(WORKER_RESTART_DELAY)
+                if self.stopping:
+                    return
+                self.processes[worker - 1] = self.start_worker(worker)
+
+    # 把注册表中登记在worker的设备设为离线,并通知其他工作进程
+    def release_worker_devices(self, worker):
+        registry = self.registry
+        # 退出的进程不会再登记设备,其他进程只登记为0的位置,可以不加锁查找
+        device_ids = [device_id for device_id in range(1, len(registry)) if registry[device_id] == worker]
+        with self.registry_lock:
+            for device_id in device_ids:
+                registry[device_id] = 0
+            registry[0] += 1
+        with get_pool(self.db_file).connection() as conn:
+            for i in range(0, len(device_ids), 500):
+                chunk = device_ids[i:i + 500]
+                conn.execute(f'UPDATE devices SET online=0 WHERE id IN ({",".join("?" * len(chunk))})', chunk)
+        logger.info('工作进程 %s 上的 %s 个设备设为离线', worker, len(device_ids))
+
+    def on_routing_change(self, version):
+        with self.registry_lock:
+            self.registry[0] += 1
+
+    def on_config_change(self, changed):
+        with self.registry_lock:
+            self.registry[0] += 1
+
+    # 主进程退出时等待工作进程退出,删除Unix域socket和转发统计所在的临时目录,释放共享注册表
+    def stop(self):
+        self.stopping = True
+        deadline = time.monotonic() + WORKER_STOP_TIMEOUT
+        for process in self.processes:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        shutil.rmtree(self.socket_dir, ignore_errors=True)
+        self.registry.release()
+        self.registry_memory.close()
+        self.registry_memory.unlink()
+
+    # 汇总工作进程最近一次写入的转发统计
+    def collect_metrics(self):
+        snapshot = {'devices': {}, 'groups': {}}
+        for worker in range(1, self.workers + 1):
+            try:
+                with open(get_metrics_path(self.socket_dir, worker), 'rb') as f:
+                    merge_snapshot(snapshot, pickle.load(f))
+            except (OSError, EOFError, pickle.UnpicklingError):
+                # 工作进程还没有写入
+                continue
+        return snapshot
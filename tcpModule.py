@@ -1,54 +1,140 @@
-import queue
+import hmac
+import logging
+import os
+import selectors
 import socket
-import sqlite3
 import threading
 import time
 from multiprocessing.pool import ThreadPool
 
-from tools import Tools
+from admission import AdmissionControl
+from config_store import ConfigStore
+from credentials import CredentialIndex
+from databases.DB import DEFAULT_DB_FILE, get_pool
+from framing import ACK, AUTH, CHALLENGE, DATA, FRAME_MAGIC, HEARTBEAT, LOGIN, FrameReader, pack_frame
+from log import BASE_DIR, ThrottledLogger
+from metrics import MetricsRegistry
+from offline_store import OfflineStore
+from presence import PresenceRegistry
+from routing import SOURCE_HEADER, RoutingTable
+from security import NONCE_SIZE, SessionCipher, auth_proof, derive_master, is_cipher_login, parse_cipher_login
+from send_queue import FULL, ThreadedSendQueue
+from shaping import RateLimiter
+from timer_wheel import TimerWheel
+
+try:
+    import fcntl
+except ImportError:
+    # Windows下没有fcntl,不能调整管道大小
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+# 每包数据都可能触发的日志按设备限制输出频率
+throttled = ThrottledLogger(logger)
+
+# 检查离线缓存的间隔(秒):丢弃过期数据,补发给已经上线的设备
+OFFLINE_SWEEP_INTERVAL = 1
+
+# 监听端口修改后,旧端口继续接受连接的秒数,之后关闭;已经建立的连接不受影响
+LISTENER_DRAIN_TIME = 5
+# 线程模式接受连接时检查监听socket是否已被替换的间隔(秒)
+ACCEPT_CHECK_INTERVAL = 0.5
+# 平滑重启时等待设备连接的待发送数据发完的最长时间(秒)
+HANDOFF_DRAIN_TIMEOUT = 5
+# 线程模式监听socket每次可读时最多连续accept的连接数
+ACCEPT_BATCH = 64
+
+
+# 允许监听还有TIME_WAIT连接的端口,修改端口后再改回来或重启服务器时不会绑定失败;
+# Windows下SO_REUSEADDR会允许多个程序监听同一个端口,不设置
+def set_reuse_address(sock):
+    if os.name != 'nt':
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
 
 class TCPServer(object):
+    # 平滑重启时能否接管旧进程交出的设备连接;线程模式的接收线程处理登录和转发的整个过程,不能接管已登录的连接
+    can_adopt_devices = False
 
-    def __init__(self):
-        # 列队存储要执行的数据库操作
-        self.db_queue = queue.Queue()
-        self.local_conn = threading.local()
+    def __init__(self, db_file=DEFAULT_DB_FILE, routing=None, credentials=None, metrics=None, config=None):
+        # 数据库文件位置
+        self.db_file = db_file
 
-        #
-        threading.Thread(target=self.run_db_task).start()
+        # 配置项,与web管理页面共用同一个对象时,修改配置会立即生效
+        self.config = config if config is not None else ConfigStore(db_file)
 
-        # 在初始化时连接SQLite数据库
-        # self.conn = sqlite3.connect('cfg.sqlite3', check_same_thread=False)
-        # self.cursor = self.conn.cursor()
-        self.local_conn.conn = sqlite3.connect('cfg.sqlite3', check_same_thread=False)
-        self.local_conn.cursor = self.local_conn.conn.cursor()
+        # 与web管理页面共用的数据库连接池
+        self.db_pool = get_pool(db_file)
 
-        # 创建连接池,最大连接数4096
-        self.pool = ThreadPool(processes=4096)
+        # 透传路由表,与web管理页面共用同一个对象时,修改透传组会立即生效
+        self.routing = routing if routing is not None else RoutingTable(db_file)
 
-        # 在初始化时启动TCP服务器
-        self.start()
+        # 设备登录信息索引,与web管理页面共用同一个对象时,修改设备会立即生效
+        self.credentials = credentials if credentials is not None else CredentialIndex(db_file)
 
-    def run_db_task(self):
-        """
-        这个函数 从队列中获取数据库操作并执行
-        :return:
-        """
-        while True:
-            func, args = self.db_queue.get()
-            func(*args)
-            self.db_queue.task_done()
+        # 设备在线状态,以内存为准,定时批量写入数据库
+        self.presence = PresenceRegistry(db_file)
+
+        # 转发统计,与web管理页面共用同一个对象时可以通过/metrics查看
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+
+        # 连接池在线程模式启动时才创建,异步模式不需要
+        self.pool = None
+
+        # 平滑重启:从旧进程接管的监听socket 端口 -> socket,正在从旧进程接管,正在交给新进程
+        self.inherited = {}
+        self.takeover = False
+        self.handing_off = False
+
+    # 读取config表中的配置项,不存在时返回默认值
+    def get_config(self, name, default=None):
+        return self.config.get(name, default)
 
     def start(self):
-        self.tools = Tools()
         # 获取数据库中的TCP端口号
-        self.local_conn.cursor.execute('SELECT value FROM config WHERE name="tcpPort"')
-        tcp_port = int(self.local_conn.cursor.fetchone()[0])
-
-        # 将所有协议类型为tcpServer的设备设置为离线状态
-        self.local_conn.cursor.execute('UPDATE devices SET online=0 WHERE protocol="tcpServer"')
-        self.local_conn.conn.commit()
+        tcp_port = int(self.get_config('tcpPort'))
+
+        # 接收缓冲区大小,一对一透传组每次最多读取这么多数据
+        self.buffer_size = int(self.get_config('tcpBufferSize', '65536'))
+
+        # 一对一透传组是否使用splice在内核中直接转发(仅Linux)
+        self.use_splice = self.get_config('tcpSplice', '0') == '1'
+        if self.use_splice and not hasattr(os, 'splice'):
+            logger.warning('当前系统不支持splice,使用普通转发')
+            self.use_splice = False
+
+        # 每个目标设备的发送队列大小(字节)和队列满时的处理策略
+        self.send_queue_size = int(self.get_config('sendQueueSize', '1048576'))
+        self.send_queue_policy = self.get_config('sendQueuePolicy', 'pause')
+
+        # 心跳包间隔(秒),0为不发送心跳包
+        self.heartbeat_interval = float(self.get_config('heartbeatInterval', '0.5'))
+        # 设备空闲超时(秒),超过这个时间没有收到设备的数据就断开,0为不限制
+        self.idle_timeout = float(self.get_config('idleTimeout', '0'))
+        # 所有设备的心跳包和空闲超时共用一个时间轮
+        self.timer_wheel = TimerWheel()
+
+        # 开启了离线缓存的透传组,目标设备不在线时缓存数据,上线后补发
+        self.offline = OfflineStore(self.get_spool_dir(), int(self.get_config('offlineMemorySize', '65536')),
+                                    int(self.get_config('offlineMaxBytes', '16777216')),
+                                    int(self.get_config('offlineMaxMessages', '10000')),
+                                    float(self.get_config('offlineTTL', '60')))
+        self.offline.start()
+        self.timer_wheel.schedule(OFFLINE_SWEEP_INTERVAL, self.sweep_offline)
+
+        # 监听队列长度,大量设备同时重连时放不下的连接要等SYN重传
+        self.backlog = int(self.get_config('tcpBacklog', '1024'))
+        # 登录准入控制和未登录连接的超时(秒),0为不限制
+        self.admission = AdmissionControl()
+        self.set_admission_limits()
+        self.login_timeout = float(self.get_config('loginTimeout', '10'))
+
+        # 将所有协议类型为tcpServer的设备设置为离线状态,从旧进程接管时等接管完成后再写入
+        if not self.takeover:
+            self.reset_online_status()
+
+        # 在线状态写入数据库的间隔(秒)
+        self.presence.start(float(self.get_config('presenceFlushInterval', '1')))
 
         # 创建字典用于存储设备连接
         self.device_connections = {}
@@ -56,139 +142,353 @@ class TCPServer(object):
         # 创建锁对象用于线程同步
         self.lock = threading.Lock()
 
-        # 启动TCP服务器
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.bind(('0.0.0.0', tcp_port))
-        self.server_socket.listen(5)
+        # 读取统计时提供发送队列长度和在线状态
+        self.metrics.add_collector(self.collect_metrics)
+
+        # 启动TCP服务器,旧监听socket -> 停止接受连接的时间
+        self.server_socket = self.create_server_socket(tcp_port)
+        self.draining = {}
+
+        logger.info('TCP服务器正在监听端口 %s...', tcp_port)
+
+        # TLS监听端口,0为不启用
+        self.tls_socket = None
+        tls_port = int(self.get_config('tlsPort', '0'))
+        if tls_port:
+            self.start_tls(tls_port)
+
+        self.start_accepting()
+
+        # 修改配置后不用重启,configPollInterval秒内生效
+        self.config.add_listener(self.on_config_change)
+        self.config.watch(float(self.get_config('configPollInterval', '1')))
+
+    # 配置修改后调用,参数为值有变化的配置项名称集合
+    def on_config_change(self, names):
+        self.apply_config(names)
+
+    # 应用修改后的配置:新的缓冲区大小用于之后建立的连接,发送队列、心跳包、离线缓存的设置立即用于所有设备
+    def apply_config(self, names):
+        if 'tcpBufferSize' in names:
+            self.buffer_size = int(self.get_config('tcpBufferSize', '65536'))
+        if names & {'sendQueueSize', 'sendQueuePolicy'}:
+            self.send_queue_size = int(self.get_config('sendQueueSize', '1048576'))
+            self.send_queue_policy = self.get_config('sendQueuePolicy', 'pause')
+            for connection in list(self.device_connections.values()):
+                connection.set_limits(self.send_queue_size, self.send_queue_policy)
+        if names & {'heartbeatInterval', 'idleTimeout'}:
+            self.heartbeat_interval = float(self.get_config('heartbeatInterval', '0.5'))
+            self.idle_timeout = float(self.get_config('idleTimeout', '0'))
+            # 原来没有定时任务的设备(心跳包和空闲超时都为0时)重新添加
+            for device_id, connection in list(self.device_connections.items()):
+                if connection.timer is None:
+                    self.start_device_timer(device_id, connection)
+        if names & {'offlineMemorySize', 'offlineMaxBytes', 'offlineMaxMessages', 'offlineTTL'}:
+            self.offline.memory_size = int(self.get_config('offlineMemorySize', '65536'))
+            self.offline.max_bytes = int(self.get_config('offlineMaxBytes', '16777216'))
+            self.offline.max_messages = int(self.get_config('offlineMaxMessages', '10000'))
+            self.offline.ttl = float(self.get_config('offlineTTL', '60'))
+        if names & {'loginRate', 'loginBurst', 'loginMaxPending', 'loginMaxPerIp'}:
+            self.set_admission_limits()
+        if 'loginTimeout' in names:
+            self.login_timeout = float(self.get_config('loginTimeout', '10'))
+        if 'tcpBacklog' in names:
+            self.backlog = int(self.get_config('tcpBacklog', '1024'))
+            # 再次调用listen修改已经在监听的socket的队列长度
+            for server_socket in (self.server_socket, self.tls_socket):
+                if server_socket is not None:
+                    server_socket.listen(self.backlog)
+        if 'tcpPort' in names:
+            self.rebind(int(self.get_config('tcpPort')))
+        if 'tlsPort' in names:
+            self.rebind_tls(int(self.get_config('tlsPort', '0')))
+
+    def set_admission_limits(self):
+        self.admission.set_limits(float(self.get_config('loginRate', '1000')), int(self.get_config('loginBurst', '2000')),
+                                  int(self.get_config('loginMaxPending', '1024')),
+                                  int(self.get_config('loginMaxPerIp', '0')))
+
+    # 监听新的端口,失败时返回None,继续使用原来的端口
+    def open_listener(self, port):
+        try:
+            return self.create_server_socket(port)
+        except OSError as e:
+            logger.error('监听端口 %s 失败:%s,继续使用原来的端口', port, e)
+            return None
+
+    # 修改监听端口:先监听新端口,旧端口继续接受连接LISTENER_DRAIN_TIME秒后关闭
+    def rebind(self, tcp_port):
+        server_socket = self.open_listener(tcp_port)
+        if server_socket is None:
+            return
+        old_socket, self.server_socket = self.server_socket, server_socket
+        self.draining[old_socket] = time.monotonic() + LISTENER_DRAIN_TIME
+        threading.Thread(target=self.handle_client_connections, args=(server_socket,)).start()
+        logger.info('TCP服务器改为监听端口 %s,原来的端口 %s 秒后关闭', tcp_port, LISTENER_DRAIN_TIME)
+
+    def rebind_tls(self, tls_port):
+        if tls_port:
+            self.start_tls(tls_port)
+
+    # 将所有协议类型为tcpServer的设备设置为离线状态
+    def reset_online_status(self):
+        self.presence.reset('tcpServer')
+
+    # 离线缓存落盘文件的目录,相对路径以程序目录为准
+    def get_spool_dir(self):
+        return os.path.join(BASE_DIR, self.get_config('offlineSpoolDir', 'spool'))
+
+    # 线程模式的写线程和接收线程会同时读写同一个连接,ssl模块不支持,只有异步模式支持TLS
+    def start_tls(self, tls_port):
+        logger.warning('线程模式不支持TLS,请使用异步模式(tcpMode=async),不支持TLS的设备可以使用加密模式登录')
+
+    # 创建监听socket,平滑重启时使用从旧进程接管的socket
+    def create_server_socket(self, tcp_port):
+        server_socket = self.inherited.pop(tcp_port, None)
+        if server_socket is not None:
+            return server_socket
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        set_reuse_address(server_socket)
+        server_socket.bind(('0.0.0.0', tcp_port))
+        server_socket.listen(self.backlog)
+        return server_socket
+
+    def start_accepting(self):
+        """
+        线程模式:每个设备连接占用连接池中的一个线程
+        :return:
+        """
+        # 创建连接池,最大连接数4096
+        self.pool = ThreadPool(processes=4096)
 
-        print(f"{self.tools.get_current_time()}:TCP服务器正在监听端口 {tcp_port}...")
+        # 一个线程推进时间轮,处理所有设备的心跳包
+        threading.Thread(target=self.timer_wheel.run).start()
 
         # 在独立线程中接收并处理客户端连接
-        threading.Thread(target=self.handle_client_connections).start()
-
-    def handle_client_connections(self):
-        self.local_conn.conn = sqlite3.connect('cfg.sqlite3', check_same_thread=False)
-        self.local_conn.cursor = self.local_conn.conn.cursor()
-        while True:
-            client_socket, address = self.server_socket.accept()
+        threading.Thread(target=self.handle_client_connections, args=(self.server_socket,)).start()
+
+    def handle_client_connections(self, server_socket):
+        # 非阻塞监听,可读时一次accept多个连接;定时检查监听端口是否已经修改,旧端口到期后关闭
+        server_socket.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(server_socket, selectors.EVENT_READ)
+        while server_socket.fileno() != -1:
+            deadline = self.draining.get(server_socket)
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            # 登录令牌用完或正在登录的连接太多时暂停accept,新连接留在内核的监听队列中
+            wait = self.admission.wait_time()
+            if wait:
+                time.sleep(min(wait, ACCEPT_CHECK_INTERVAL))
+                continue
+            if selector.select(ACCEPT_CHECK_INTERVAL):
+                self.accept_batch(server_socket)
+        selector.close()
+        self.draining.pop(server_socket, None)
+        server_socket.close()
+
+    # 连续accept,直到没有新连接、达到ACCEPT_BATCH个或不能再开始登录
+    def accept_batch(self, server_socket):
+        for _ in range(ACCEPT_BATCH):
+            if self.admission.wait_time():
+                return
+            try:
+                client_socket, address = server_socket.accept()
+            except BlockingIOError:
+                return
+            except OSError as e:
+                if server_socket.fileno() != -1:
+                    # 文件描述符用完等错误,稍后重试
+                    logger.error('接受连接失败:%s', e)
+                    time.sleep(ACCEPT_CHECK_INTERVAL)
+                return
+            # 同一IP未登录的连接太多时直接断开
+            if not self.admission.open(address[0]):
+                throttled.warning(address[0], '%s 未登录的连接太多,断开新连接', address[0])
+                client_socket.close()
+                continue
+            self.admission.start()
             # 使用连接池启动线程处理每个连接
-            self.pool.apply_async(self.handle_client_connection, (client_socket,))
-
-    def handle_client_connection(self, client_socket):
-
-        self.local_conn.conn = sqlite3.connect('cfg.sqlite3', check_same_thread=False)
-        self.local_conn.cursor = self.local_conn.conn.cursor()
-
-        remote_addr = client_socket.getpeername()
-        print(f"{self.tools.get_current_time()}:设备 {remote_addr} 建立连接,等待身份验证")
-
-        # 定义发送心跳包的函数
-        def send_heartbeat(device_id, username, password):
-            self.local_conn.conn = sqlite3.connect('cfg.sqlite3', check_same_thread=False)
-            self.local_conn.cursor = self.local_conn.conn.cursor()
-            print(f"{self.tools.get_current_time()}:设备 {remote_addr} {device_id} {username} {password} 开启心跳包线程!")
-            while True:
-                time.sleep(0.5)
-                try:
-                    # 获取目标设备ID
-                    target_device_ids = self.get_target_device_id(device_id)
-                    if target_device_ids is None:
-                        print(f"{self.tools.get_current_time()}:设备没有目标设备 send_heartbeat")
-                        continue
-                    # 判断目标设备 有没有在线的
-                    for target_device_id in target_device_ids:
-                        target_device_id = target_device_id[0]
-                        # 如果目标设备在线,则发送心跳包
-                        if target_device_id in self.device_connections:
-                            client_socket.send('!'.encode('gbk'))
-                            # 发送一次就行
-                            continue
-                        # 否则不发送
-                        else:
-                            continue
-                except Exception as e:
-                    print(f"{self.tools.get_current_time()}: {e} ")
-                    print(f"{self.tools.get_current_time()}:设备 {remote_addr} 发送心跳包错误,与其断开连接")
-                    break
+            self.pool.apply_async(self.handle_client_connection, (client_socket, address))
+
+    # 登录超时:超过loginTimeout秒还没有登录就断开
+    def start_login_timer(self, client_socket, remote_addr):
+        if self.login_timeout:
+            return self.timer_wheel.schedule(self.login_timeout, self.on_login_timeout, client_socket, remote_addr)
+        return None
+
+    def on_login_timeout(self, client_socket, remote_addr):
+        logger.info('设备 %s 超过 %s 秒没有登录,与其断开连接', remote_addr, self.login_timeout)
+        try:
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    # 登录成功或连接断开:取消登录超时,不再计入正在登录的连接数和同一IP未登录的连接数
+    def end_login(self, ip, login_timer):
+        if login_timer is not None:
+            login_timer.cancel()
+        self.admission.finish()
+        self.admission.close(ip)
+
+    def handle_client_connection(self, client_socket, remote_addr):
+
+        logger.info('设备 %s 建立连接,等待身份验证', remote_addr)
+        login_timer = self.start_login_timer(client_socket, remote_addr)
+        logging_in = True
 
         device_id = None
+        # 本设备的发送队列
+        send_queue = None
+        # splice模式使用的管道
+        pipe = None
         while True:
             try:
                 # 接收数据
-                data = client_socket.recv(1024).decode()
+                data = client_socket.recv(1024)
                 if not data:
-                    print(f"{self.tools.get_current_time()}:设备 {remote_addr} 收到空数据")
-                    print(f"{self.tools.get_current_time()}:设备 {remote_addr} 与其断开连接")
+                    logger.info('设备 %s 收到空数据,与其断开连接', remote_addr)
                     break
 
-                # 解析用户名和密码
-                username, password = self.parse_credentials(data)
-
-                # 验证用户名和密码
-                if self.verify_credentials(username, password):
-                    # 登录成功
+                # 帧协议:登录帧可能分多次收到,登录帧后面的数据帧留在缓冲区中
+                reader = None
+                cipher = None
+                if data[0] == FRAME_MAGIC:
+                    reader = FrameReader(self.buffer_size)
+                    data = self.receive_login_frame(client_socket, reader, data)
+                    if data is None:
+                        logger.warning('设备 %s 没有收到登录帧,与其断开连接', remote_addr)
+                        break
 
-                    # 获取设备ID
-                    device_id = self.get_device_id(username)
-                    if device_id is None:
-                        print(f"{self.tools.get_current_time()}:设备 {remote_addr} {username} {password} id号不存在!")
-                        print(f"{self.tools.get_current_time()}:设备 {remote_addr} 与其断开连接")
+                if reader is not None and is_cipher_login(data):
+                    # 加密模式:发送挑战帧,设备用密码和双方随机数计算出会话密钥后回复认证帧,密码不在网络上传输
+                    username, device_id, master, server_nonce = self.begin_cipher_login(data.decode())
+                    password = ''
+                    client_socket.sendall(pack_frame(CHALLENGE, server_nonce))
+                    cipher = self.finish_cipher_login(master, self.receive_frame(client_socket, reader))
+                    if cipher is None:
                         device_id = None
-                        break
+                else:
+                    # 解析用户名和密码
+                    username, password = self.parse_credentials(data.decode())
+
+                    # 验证用户名和密码,成功时得到设备ID
+                    device_id = self.verify_credentials(username, password)
+                if device_id is not None:
+                    # 登录成功
 
                     # 检查设备是否已在线
                     if self.is_device_online(device_id):
-                        print(f"{self.tools.get_current_time()}:设备 {remote_addr} {username} {password} 已在线,重复登陆!")
-                        print(f"{self.tools.get_current_time()}:设备 {remote_addr} 与其断开连接")
+                        logger.warning('设备 %s %s 已在线,重复登陆!与其断开连接', remote_addr, username)
                         device_id = None
                         break
 
+                    self.end_login(remote_addr[0], login_timer)
+                    logging_in = False
+
                     # 更新在线状态为在线
                     self.update_device_online_status(device_id, 1)
 
-                    # 关联设备ID和连接
-                    self.add_device_connection(device_id, client_socket)
+                    # 发送给本设备的数据都经过发送队列,由独立的写线程发送
+                    send_queue = ThreadedSendQueue(client_socket, self.send_queue_size, self.send_queue_policy)
+                    send_queue.framed = reader is not None
+                    send_queue.cipher = cipher
+                    self.set_device_options(device_id, send_queue, client_socket)
+                    send_queue.start()
+
+                    # 帧协议回复登录成功,应答帧在所有数据之前
+                    if reader is not None:
+                        send_queue.send(pack_frame(ACK, b'loginSuccess'))
+
+                    # 先补发离线期间缓存的数据再关联连接,之后实时转发的数据排在后面;
+                    # 关联前其他线程可能还在缓存数据,关联后再补发一次
+                    self.replay_offline(device_id, send_queue)
+                    self.add_device_connection(device_id, send_queue)
+                    self.replay_offline(device_id, send_queue)
 
                     # 打印登录成功信息
-                    print(f"{self.tools.get_current_time()}:设备 {remote_addr} {device_id} {username} {password} 登录成功!")
+                    logger.info('设备 %s %s %s 登录成功!', remote_addr, device_id, username)
 
-                    # 启动线程发送心跳包
-                    threading.Thread(target=send_heartbeat, args=(device_id, username, password,)).start()
+                    # 心跳包和空闲超时交给时间轮处理
+                    self.start_device_timer(device_id, send_queue)
+
+                    # 帧协议转发和登录帧一起收到的数据帧
+                    if reader is not None:
+                        self.handle_frames(device_id, reader, remote_addr, cipher)
+
+                    # 接收缓冲区重复使用,不再每次接收都创建新的bytes对象
+                    buffer = bytearray(self.buffer_size)
+                    view = memoryview(buffer)
 
                     # 循环接收并转发消息
                     while True:
-                        data = client_socket.recv(1024)
-                        if not data:
+                        # 帧协议按帧转发,保留每一帧的边界
+                        if reader is not None:
+                            if not self.receive_frames(device_id, client_socket, reader, send_queue, remote_addr):
+                                break
+                            continue
+
+                        # splice模式下一对一透传组的数据不经过用户态
+                        if self.use_splice and self.routing.get_pair_target(device_id) is not None:
+                            if pipe is None:
+                                pipe = self.create_splice_pipe()
+                            size = self.splice_message(device_id, client_socket, pipe, remote_addr,
+                                                       self.get_read_size(device_id, send_queue, self.buffer_size))
+                            if not size:
+                                break
+                            send_queue.last_recv_time = time.monotonic()
+                            self.wait_shaping(device_id, send_queue, size, 1)
+                            continue
+
+                        size = client_socket.recv_into(buffer, self.get_read_size(device_id, send_queue, len(buffer)))
+                        if not size:
                             break
+                        send_queue.last_recv_time = time.monotonic()
+                        start = time.perf_counter()
                         # 打印收到的设备信息。
-                        # print(f"{self.tools.get_current_time()}:设备 {remote_addr} {device_id} {username} {password}  的消息: {data}")
-
-                        # 获取目标设备ID
-                        target_device_ids = self.get_target_device_id(device_id)
+                        # logger.debug('设备 %s %s %s 的消息: %s', remote_addr, device_id, username, view[:size])
 
-                        # 启动线程发送心跳包
-                        # send_heartbeat(device_id, username, password, target_device_ids)
+                        # 一对一透传组直接发送接收缓冲区中的数据
+                        target_device_id = self.routing.get_pair_target(device_id)
+                        if self.is_raw_target(target_device_id):
+                            self.forward_to_pair(device_id, target_device_id, view[:size], remote_addr)
+                        else:
+                            # 获取目标设备ID
+                            target_device_ids = self.get_target_device_id(device_id)
 
-                        self.forward_message(device_id, username, password, data, remote_addr, target_device_ids)
-                        # self.forward_message(device_id, username, password, data, remote_addr)
+                            self.forward_message(device_id, username, password, bytes(view[:size]), remote_addr,
+                                                 target_device_ids)
+                        self.metrics.record_received(device_id, 1, size, time.perf_counter() - start)
+                        self.wait_shaping(device_id, send_queue, size, 1)
 
                 else:
                     # 登录失败
-                    print(f"{self.tools.get_current_time()}:设备 {remote_addr} {username} {password} 账号或密码不对!")
-                    print(f"{self.tools.get_current_time()}:设备 {remote_addr} 与其断开连接")
+                    logger.warning('设备 %s %s 账号或密码不对!与其断开连接', remote_addr, username)
                     break
 
             except Exception as e:
-                print(f"{self.tools.get_current_time()}:设备 {remote_addr} 发生错误:{e}")
-                print(f"{self.tools.get_current_time()}:设备 {remote_addr} 与其断开连接")
+                logger.warning('设备 %s 发生错误:%s,与其断开连接', remote_addr, e)
                 break
 
+        if logging_in:
+            self.end_login(remote_addr[0], login_timer)
+
+        if pipe is not None:
+            os.close(pipe[0])
+            os.close(pipe[1])
+
+        # 停止写线程和定时任务
+        if send_queue is not None:
+            send_queue.close()
+            if send_queue.timer is not None:
+                send_queue.timer.cancel()
+
         # 更新数据库中的在线状态
         if device_id is None:
             # 关闭客户端连接
             client_socket.close()
         else:
-            print(f"{self.tools.get_current_time()}:{device_id} 断开这个设备！")
+            logger.info('%s 断开这个设备！', device_id)
             self.update_device_online_status(device_id, 0)
             # 移除设备连接
             self.remove_device_connection(device_id)
@@ -208,88 +508,426 @@ class TCPServer(object):
 
         return username, password
 
-    # 验证用户名和密码  
+    # 帧协议:接收完整的登录帧,返回登录帧中的数据,连接断开或第一帧不是登录帧时返回None
+    def receive_login_frame(self, client_socket, reader, data):
+        reader.feed(data)
+        frame = self.receive_frame(client_socket, reader)
+        if frame is None:
+            return None
+        frame_type, payload = frame
+        if frame_type != LOGIN:
+            return None
+        return payload
+
+    # 帧协议:接收一个完整的帧,连接断开时返回None
+    def receive_frame(self, client_socket, reader):
+        frame = reader.next_frame()
+        while frame is None:
+            size = client_socket.recv_into(reader.get_buffer())
+            if not size:
+                return None
+            reader.written(size)
+            frame = reader.next_frame()
+        return frame
+
+    # 加密模式登录第一步:解析登录帧,返回(用户名, 设备ID, 会话主密钥, 服务器随机数),账号不存在时设备ID为None
+    def begin_cipher_login(self, data):
+        username, client_nonce = parse_cipher_login(data)
+        server_nonce = os.urandom(NONCE_SIZE)
+        entry = self.credentials.lookup('tcpServer', username)
+        if entry is None:
+            return username, None, None, server_nonce
+        device_id, password_hash = entry
+        return username, device_id, derive_master(password_hash, client_nonce, server_nonce), server_nonce
+
+    # 加密模式登录第二步:检查设备的认证帧,成功返回会话加密对象,失败返回None
+    def finish_cipher_login(self, master, frame):
+        if master is None or frame is None:
+            return None
+        frame_type, proof = frame
+        if frame_type != AUTH or not hmac.compare_digest(proof, auth_proof(master)):
+            return None
+        return SessionCipher(master)
+
+    # 帧协议:接收数据并转发其中所有完整的帧,返回0表示本设备断开
+    def receive_frames(self, device_id, client_socket, reader, connection, remote_addr):
+        limiter = self.get_limiter(device_id, connection)
+        buffer = reader.get_buffer()
+        size = client_socket.recv_into(buffer, self.get_read_size(device_id, connection, len(buffer)))
+        if not size:
+            return 0
+        reader.written(size)
+        connection.last_recv_time = time.monotonic()
+        # 限速时每批最多转发max_messages帧,暂停后再转发缓冲区中剩下的帧
+        while True:
+            messages, nbytes = self.handle_frames(device_id, reader, remote_addr, connection.cipher,
+                                                  limiter.max_messages)
+            self.wait_shaping(device_id, connection, nbytes, messages)
+            if not limiter.max_messages or messages < limiter.max_messages:
+                return size
+
+    # 取出缓冲区中所有完整的帧(max_messages不为0时最多取出这么多数据帧),数据帧一起转发,心跳帧只刷新空闲时间,
+    # 应答帧不需要处理;加密模式先解密数据帧;返回(转发的数据帧个数, 字节数)
+    def handle_frames(self, device_id, reader, remote_addr, cipher=None, max_messages=0):
+        start = time.perf_counter()
+        payloads = []
+        nbytes = 0
+        frame = reader.next_frame()
+        while frame is not None:
+            frame_type, payload = frame
+            if frame_type == DATA:
+                payloads.append(payload if cipher is None else cipher.decrypt(payload))
+                nbytes += len(payloads[-1])
+                if len(payloads) == max_messages:
+                    break
+            frame = reader.next_frame()
+        if payloads:
+            self.forward_frames(device_id, payloads, remote_addr)
+            self.metrics.record_received(device_id, len(payloads), nbytes, time.perf_counter() - start)
+        return len(payloads), nbytes
+
+    # 验证用户名和密码,成功返回设备ID,失败返回None
     def verify_credentials(self, username, password):
-        # 从数据库中获取账号密码
-        self.local_conn.cursor.execute('SELECT username, password FROM devices WHERE protocol="tcpServer"')
-        credentials = self.local_conn.cursor.fetchall()
-        for credential in credentials:
-            if credential[0] == username and credential[1] == password:
-                return True
-        return False
-
-    # 获取设备ID        
-    def get_device_id(self, username):
-        self.local_conn.cursor.execute('SELECT id FROM devices WHERE username=?', (username,))
-        result = self.local_conn.cursor.fetchone()
-        if result:
-            return result[0]
-        return None
+        # 查内存中的登录信息索引,不再每次登录都扫描devices表
+        return self.credentials.verify('tcpServer', username, password)
 
     # 获取目标设备ID
     def get_target_device_id(self, device_id):
-        # 不直接执行数据库操作,把操作封装成一个函数,加入队列
-        # def query_db():
-        self.local_conn.cursor.execute('SELECT device_b_id FROM passthrough WHERE device_a_id=?', (device_id,))
-        # 加入队列
-        # self.db_queue.put((query_db, ()))
-        # 等待队列空
-        # self.db_queue.join()
-        target_device_ids = self.local_conn.cursor.fetchall()
-        if target_device_ids:
-            return target_device_ids
-        return None
+        # 直接查内存中的路由表,不访问数据库
+        return self.routing.get_targets(device_id)
 
-    # 检查设备是否在线
+    # 检查设备是否在线,直接查内存中的在线状态
     def is_device_online(self, device_id):
-        self.local_conn.cursor.execute('SELECT online FROM devices WHERE id=?', (device_id,))
-        result = self.local_conn.cursor.fetchone()
-        if result and result[0] == 1:
-            return True
-        return False
-
-    # 检查设备是否在线
-    def is_device_in_device_connections(self, device_id):
-        self.local_conn.cursor.execute('SELECT online FROM devices WHERE id=?', (device_id,))
-        result = self.local_conn.cursor.fetchone()
-        if result and result[0] == 1:
-            return True
-        return False
-
-    # 更新设备在线状态
+        return self.presence.is_online(device_id)
+
+    # 更新设备在线状态,由在线状态表定时批量写入数据库
     def update_device_online_status(self, device_id, status):
-        self.local_conn.cursor.execute('UPDATE devices SET online=? WHERE id=?', (status, device_id))
-        self.local_conn.conn.commit()
+        # 交给新进程后在线状态由新进程写入数据库
+        if not self.handing_off:
+            self.presence.update(device_id, status)
 
     # 添加设备连接        
-    def add_device_connection(self, device_id, socket):
+    def add_device_connection(self, device_id, connection):
         with self.lock:
-            self.device_connections[device_id] = socket
+            self.device_connections[device_id] = connection
+        self.metrics.record_login(device_id)
 
-    # 移除设备连接
+    # 移除设备连接,记录其发送队列丢弃的数据
     def remove_device_connection(self, device_id):
         with self.lock:
-            if device_id in self.device_connections:
-                del self.device_connections[device_id]
+            connection = self.device_connections.pop(device_id, None)
+        if connection is not None:
+            stats = connection.get_stats()
+            self.metrics.record_drops(device_id, stats['dropped_messages'], stats['dropped_bytes'])
+
+    # 一对一透传组转发,目标设备发送队列为空时直接发送接收缓冲区中的数据
+    def forward_to_pair(self, device_id, target_device_id, view, remote_addr):
+        target = self.device_connections.get(target_device_id)
+        if target is None:
+            self.forward_not_connected(device_id, target_device_id, bytes(view), remote_addr)
+            return
+        target.last_send_time = time.monotonic()
+        self.metrics.record_forward(device_id, target_device_id, 1, len(view))
+        if target.send_direct(view) == FULL:
+            target.wait_writable()
+
+    # 来源设备转发nbytes字节、nmessages条消息后消耗设备和透传组的限速令牌,返回需要暂停读取的秒数;
+    # 设备选项或路由表的版本变化时重新创建令牌桶,web管理页面修改限速后立即生效
+    def get_shaping_delay(self, device_id, connection, nbytes, nmessages):
+        limiter = self.get_limiter(device_id, connection)
+        if not limiter.buckets:
+            return 0
+        return limiter.consume(nbytes, nmessages)
+
+    # 获取来源设备的限速令牌桶
+    def get_limiter(self, device_id, connection):
+        version = (self.credentials.version, self.routing.version)
+        limiter = connection.limiter
+        if limiter is None or limiter.version != version:
+            limiter = connection.limiter = RateLimiter(self.credentials.get_limits(device_id),
+                                                       self.routing.get_group_limits(device_id), version)
+        return limiter
+
+    # 每次最多接收的字节数:限速时为令牌桶容量,不超过缓冲区的大小buffer_size
+    def get_read_size(self, device_id, connection, buffer_size):
+        max_bytes = self.get_limiter(device_id, connection).max_bytes
+        return min(max_bytes, buffer_size) if max_bytes else buffer_size
+
+    # 超出限速时暂停本设备的接收循环,数据留在内核的接收缓冲区,TCP流量控制让设备放慢发送
+    def wait_shaping(self, device_id, connection, nbytes, nmessages):
+        delay = self.get_shaping_delay(device_id, connection, nbytes, nmessages)
+        if delay:
+            time.sleep(delay)
+
+    # 发送数据给目标设备,队列满且策略为暂停时阻塞本设备的接收循环
+    def send_to_device(self, device_id, target, message):
+        target.last_send_time = time.monotonic()
+        if target.send(message) == FULL:
+            target.wait_writable()
+
+    # 设置设备的合并发送和TCP选项,修改后设备重新登录生效
+    def set_device_options(self, device_id, connection, sock):
+        coalesce_bytes, coalesce_delay, tcp_mode = self.credentials.get_options(device_id)
+        connection.coalesce_bytes = coalesce_bytes or self.buffer_size
+        connection.coalesce_delay = coalesce_delay / 1000000
+        # nodelay:关闭Nagle算法,小包立即发出
+        if tcp_mode == 'nodelay':
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # cork:合并发送时内核只发完整的报文段,每次合并发送后推出剩余数据(仅Linux)
+        elif tcp_mode == 'cork' and connection.coalesce_delay and hasattr(socket, 'TCP_CORK'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+            connection.cork = True
+
+    # 设备登录后在时间轮中添加心跳包/空闲超时定时任务
+    def start_device_timer(self, device_id, connection):
+        connection.last_recv_time = connection.last_send_time = time.monotonic()
+        period = self.heartbeat_interval or self.idle_timeout
+        if period:
+            connection.timer = self.timer_wheel.schedule(period, self.on_device_timer, device_id, connection)
+
+    # 时间轮定时任务:检查空闲超时,发送心跳包
+    def on_device_timer(self, device_id, connection):
+        # 设备已断开
+        if self.device_connections.get(device_id) is not connection:
+            return
+        now = time.monotonic()
+        if self.idle_timeout and now - connection.last_recv_time > self.idle_timeout:
+            logger.info('设备 %s 超过 %s 秒没有数据,与其断开连接', device_id, self.idle_timeout)
+            connection.shutdown()
+            return
+        # 本周期内已经给设备发过数据就不用再发心跳包
+        if self.heartbeat_interval and now - connection.last_send_time >= self.heartbeat_interval:
+            # 目标设备有在线的就发送一次心跳包
+            for target_device_id in self.get_target_device_id(device_id):
+                if self.is_connected(target_device_id):
+                    connection.send(pack_frame(HEARTBEAT) if connection.framed else '!'.encode('gbk'))
+                    break
+        # 心跳包和空闲超时都改为0后不再检查
+        connection.timer = None
+        period = self.heartbeat_interval or self.idle_timeout
+        if period:
+            connection.timer = self.timer_wheel.schedule(period, self.on_device_timer, device_id, connection)
+
+    # 设备是否已连接到本服务器
+    def is_connected(self, device_id):
+        return device_id in self.device_connections
+
+    # 获取每个在线设备的发送队列统计信息
+    def get_send_queue_stats(self):
+        return {device_id: connection.get_stats() for device_id, connection in list(self.device_connections.items())}
+
+    # 统计收集函数:在线设备的发送队列长度,以及当前连接还没有计入的丢弃数据;离线缓存的数据
+    def collect_metrics(self):
+        devices = self.offline.get_stats()
+        for device_id, stats in self.get_send_queue_stats().items():
+            devices.setdefault(device_id, {}).update({
+                'online': 1,
+                'queued_bytes': stats['queued_bytes'],
+                'queued_messages': stats['queued_messages'],
+                'dropped_messages': stats['dropped_messages'],
+                'dropped_bytes': stats['dropped_bytes'],
+            })
+        return {'devices': devices}
+
+    # 创建splice使用的管道,尽量把管道容量调整为接收缓冲区大小
+    def create_splice_pipe(self):
+        pipe_r, pipe_w = os.pipe()
+        size = 65536
+        if fcntl is not None and hasattr(fcntl, 'F_SETPIPE_SZ'):
+            try:
+                fcntl.fcntl(pipe_w, fcntl.F_SETPIPE_SZ, self.buffer_size)
+                size = fcntl.fcntl(pipe_w, fcntl.F_GETPIPE_SZ)
+            except OSError:
+                pass
+        return pipe_r, pipe_w, size
+
+    # splice模式:socket -> 管道 -> 目标socket,数据不复制到用户态,每次最多max_size字节(0为不限制),返回0表示本设备断开
+    def splice_message(self, device_id, client_socket, pipe, remote_addr, max_size=0):
+        pipe_r, pipe_w, pipe_size = pipe
+        count = min(self.buffer_size, pipe_size, max_size or self.buffer_size)
+        size = os.splice(client_socket.fileno(), pipe_w, count, flags=os.SPLICE_F_MOVE)
+        if not size:
+            return 0
+        start = time.perf_counter()
+        # 读到数据后再取目标设备,期间透传组可能已经修改
+        target_device_id = self.routing.get_pair_target(device_id)
+        target = self.device_connections.get(target_device_id)
+        if target is not None:
+            target.last_send_time = time.monotonic()
+            self.metrics.record_forward(device_id, target_device_id, 1, size)
+        if target is None or target.framed or not target.acquire_direct():
+            # 目标设备发送队列不为空(为保证顺序)、使用帧协议或不在线时,把数据读出来放入队列或离线缓存
+            data = b''
+            while len(data) < size:
+                data += os.read(pipe_r, size - len(data))
+            if target is None:
+                self.forward_not_connected(device_id, target_device_id, data, remote_addr)
+            else:
+                self.send_to_device(device_id, target, self.encode_message(target, data))
+            self.metrics.record_received(device_id, 1, size, time.perf_counter() - start)
+            return size
+        remaining = size
+        try:
+            while remaining:
+                remaining -= os.splice(pipe_r, target.sock.fileno(), remaining, flags=os.SPLICE_F_MOVE)
+        except OSError as e:
+            # 丢弃管道中未发送的数据
+            while remaining:
+                remaining -= len(os.read(pipe_r, remaining))
+            throttled.warning((device_id, target_device_id), '设备 %s %s 消息转发失败,设备 %s %s',
+                              remote_addr, device_id, target_device_id, e)
+        finally:
+            target.release_direct()
+        self.metrics.record_received(device_id, 1, size, time.perf_counter() - start)
+        return size
 
     # 转发消息给其他设备
     def forward_message(self, device_id, username, password, message, remote_addr, target_device_ids):
         # 获取目标设备ID
         # target_device_ids = self.get_target_device_id(device_id)
-        if target_device_ids is None:
-            print(f"{self.tools.get_current_time()}:设备没有目标设备 forward_message")
+        if not target_device_ids:
+            throttled.info(device_id, '设备 %s 没有目标设备 forward_message', device_id)
             return
+        # 一包数据只封装一次,所有目标设备的发送队列引用同一个对象
+        prefixed_ids = self.routing.get_prefixed_targets(device_id)
+        framed = None
         for target_device_id in target_device_ids:
-            target_device_id = target_device_id[0]
+            data = message
+            if target_device_id in prefixed_ids:
+                # 多对一时目标设备可以根据帧头区分数据来自哪个设备
+                if framed is None:
+                    framed = SOURCE_HEADER.pack(device_id, len(message)) + message
+                data = framed
             # 如果目标设备在线,则直接转发
-            if target_device_id in self.device_connections:
-                target_socket = self.device_connections[target_device_id]
-                # target_socket.send(message.encode())
-                target_socket.send(message)
+            target = self.device_connections.get(target_device_id)
+            if target is not None:
+                self.send_to_device(device_id, target, self.encode_message(target, data))
+                self.metrics.record_forward(device_id, target_device_id, 1, len(data))
+            else:
+                self.forward_not_connected(device_id, target_device_id, data, remote_addr)
 
-            # 否则打印不在线提示
+    # 帧协议:转发一次接收到的多个数据帧,每个目标设备只入队一次
+    def forward_frames(self, device_id, payloads, remote_addr):
+        target_device_ids = self.get_target_device_id(device_id)
+        if not target_device_ids:
+            throttled.info(device_id, '设备 %s 没有目标设备 forward_frames', device_id)
+            return
+        prefixed_ids = self.routing.get_prefixed_targets(device_id)
+        for target_device_id in target_device_ids:
+            messages = payloads
+            if target_device_id in prefixed_ids:
+                messages = [SOURCE_HEADER.pack(device_id, len(payload)) + payload for payload in payloads]
+            target = self.device_connections.get(target_device_id)
+            if target is not None:
+                self.send_to_device(device_id, target,
+                                    b''.join([self.encode_message(target, message) for message in messages]))
+                self.metrics.record_forward(device_id, target_device_id, len(messages), sum(map(len, messages)))
             else:
-                print(f"{self.tools.get_current_time()}:设备 {remote_addr} {device_id} {username} {password}  消息转发失败,设备 {target_device_id}  不在线!")
+                for message in messages:
+                    self.forward_not_connected(device_id, target_device_id, message, remote_addr)
+
+    # 使用帧协议的目标设备收到的数据封装为数据帧,加密模式的设备先加密
+    def encode_message(self, target, message):
+        if target.cipher is not None:
+            return pack_frame(DATA, target.cipher.encrypt(message))
+        if target.framed:
+            return pack_frame(DATA, message)
+        return message
+
+    # 目标设备在线且不使用帧协议,可以直接发送接收缓冲区中的数据
+    def is_raw_target(self, target_device_id):
+        target = self.device_connections.get(target_device_id)
+        return target is not None and not target.framed
+
+    # 目标设备没有连接到本服务器,透传组开启了离线缓存时缓存数据,等设备上线后补发
+    def forward_not_connected(self, device_id, target_device_id, message, remote_addr):
+        if target_device_id in self.routing.get_buffered_targets(device_id):
+            self.offline.push(device_id, target_device_id, message)
+            return
+        throttled.warning((device_id, target_device_id), '设备 %s %s 消息转发失败,设备 %s 不在线!',
+                          remote_addr, device_id, target_device_id)
+
+    # 补发离线期间缓存的数据,一次放入发送队列,不等待队列空间;读落盘文件会阻塞当前线程,
+    # 线程模式中只在设备自己的接收线程里调用
+    def replay_offline(self, device_id, connection):
+        self.send_offline(device_id, connection, self.offline.take(device_id))
+
+    def send_offline(self, device_id, connection, messages):
+        if not messages:
+            return
+        logger.info('设备 %s 补发离线期间缓存的 %s 条数据', device_id, len(messages))
+        connection.last_send_time = time.monotonic()
+        connection.send(b''.join([self.encode_message(connection, message) for _, message in messages]))
+        for source_device_id, message in messages:
+            self.metrics.record_forward(source_device_id, device_id, 1, len(message))
+
+    # 定时任务:丢弃过期的缓存数据,补发给登录时还没有补发完的设备
+    def sweep_offline(self):
+        self.timer_wheel.schedule(OFFLINE_SWEEP_INTERVAL, self.sweep_offline)
+        self.offline.expire()
+        for target_device_id in self.offline.get_buffered_devices():
+            self.replay_buffered(target_device_id)
+
+    # 设备已经上线时补发缓存的数据,在写盘线程中读取,不阻塞定时任务
+    def replay_buffered(self, device_id):
+        connection = self.device_connections.get(device_id)
+        if connection is not None:
+            self.take_offline_later(device_id, self.resume_replay, device_id, connection)
+
+    # 在写盘线程中取出发给设备的缓存数据,然后调用callback(*args, messages)
+    def take_offline_later(self, device_id, callback, *args):
+        self.offline.take_later(device_id, lambda messages: callback(*args, messages))
+
+    # 读取期间设备已经断开或重新登录时放回离线缓存
+    def resume_replay(self, device_id, connection, messages):
+        if self.device_connections.get(device_id) is connection:
+            self.send_offline(device_id, connection, messages)
+        else:
+            self.adopt_offline(device_id, messages)
+
+    # 平滑重启:交给新进程的监听socket [(名称, socket), ...]
+    def get_listeners(self):
+        listeners = [('tcp', self.server_socket)]
+        if self.tls_socket is not None:
+            listeners.append(('tls', self.tls_socket))
+        return listeners
+
+    # 平滑重启:新进程已经在接受连接,停止接受连接;之前修改过的在线状态立即写入数据库,之后不再写入
+    def stop_accepting(self):
+        self.handing_off = True
+        self.presence.flush()
+        self.close_listeners()
+
+    def close_listeners(self):
+        now = time.monotonic()
+        for server_socket in [self.server_socket, *self.draining]:
+            self.draining[server_socket] = now
+
+    # 平滑重启:等待发送队列中的数据发完(最多HANDOFF_DRAIN_TIMEOUT秒)后断开所有设备,返回交给新进程的连接
+    # [(文件描述符, 连接状态), ...];线程模式的接收线程阻塞在recv上,不能交出连接,设备重新连接到新进程
+    def detach_devices(self, adopt):
+        deadline = time.monotonic() + HANDOFF_DRAIN_TIMEOUT
+        while time.monotonic() < deadline and any(connection.get_stats()['queued_bytes']
+                                                  for connection in list(self.device_connections.values())):
+            time.sleep(0.05)
+        for connection in list(self.device_connections.values()):
+            connection.shutdown()
+        return []
+
+    # 平滑重启:取出所有离线缓存 目标设备ID -> [(来源设备ID, 数据), ...]
+    def take_offline(self):
+        return {device_id: self.offline.take(device_id) for device_id in self.offline.get_buffered_devices()}
+
+    # 平滑重启:接管旧进程的离线缓存,有效期重新计算,设备在线时由定时任务补发
+    def adopt_offline(self, device_id, messages):
+        for source_device_id, message in messages:
+            self.offline.push(source_device_id, device_id, message)
+
+    # 平滑重启:接管完成,没有连接到本进程的设备在数据库中设为离线
+    def finish_takeover(self):
+        self.takeover = False
+        self.presence.sync('tcpServer')
 
 # 在其他地方调用函数启动TCP服务器
 # tcp_server = TCPServer()
+# tcp_server.start()
@@ -0,0 +1,737 @@
+"""
+透传服务器性能测试
+
+在临时目录中创建cfg.sqlite3,按测试场景添加设备和透传组,在子进程中启动TCP/UDP服务器,
+本进程通过本机回环地址模拟设备收发数据,统计消息数/秒、MB/秒和转发延迟(p50/p99/p999),
+结果保存为JSON文件,用于比较不同引擎和发现性能退化
+
+用法(在项目根目录下运行):
+    python test/benchmark.py --engine thread --output thread.json
+    python test/benchmark.py --engine async --scenarios login_storm,latency
+    python test/benchmark.py --engine async --tls --output async-tls.json   # 设备通过TLS连接,与上面的结果比较
+    python test/benchmark.py --engine async --scenarios client_sessions --clients 5000   # 一个进程运行大量AsyncTCPClient
+    python test/benchmark.py --scenarios login_storm --devices 5000 --concurrency 5000 --config loginRate=0   # 修改服务器配置
+    python test/benchmark.py --engine async --scenarios shaped_stream --shape-rate 500000   # 透传组限速
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import signal
+import socket
+import ssl
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from databases.DB import DB
+from framing import ACK, AUTH, DATA, FRAME_HEADER, LOGIN, pack_frame
+from security import NONCE_SIZE, SessionCipher, auth_proof, derive_master
+from tcp.tcp_client import AsyncTCPClient
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# 延迟测试的记录:发送时间(纳秒,8字节) + 序号(4字节),补齐到记录长度
+RECORD_HEADER = struct.Struct('!QI')
+
+SCENARIOS = ('login_storm', 'stream', 'latency', 'fanout', 'idle_memory', 'udp_latency', 'tls_handshake',
+             'cipher_stream', 'offline_replay', 'client_sessions', 'shaped_stream')
+
+
+# 取一个空闲端口
+def get_free_port(sock_type=socket.SOCK_STREAM):
+    with socket.socket(socket.AF_INET, sock_type) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+# 尽量提高文件描述符上限,大量连接时需要
+def raise_nofile_limit():
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or hard > soft:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard if hard != resource.RLIM_INFINITY else 65536, hard))
+        except (ValueError, OSError):
+            pass
+
+
+# 进程及其所有子进程占用的物理内存(字节),仅Linux
+def get_rss(pid):
+    total = 0
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    total += int(line.split()[1]) * 1024
+        for task in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                for child in f.read().split():
+                    total += get_rss(int(child))
+    except OSError:
+        return None
+    return total
+
+
+# 生成自签名证书,返回(证书文件, 私钥文件)
+def create_certificate(directory):
+    cert_file = os.path.join(directory, 'cert.pem')
+    key_file = os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', key_file,
+                    '-out', cert_file, '-days', '1', '-subj', '/CN=localhost'],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert_file, key_file
+
+
+# 读取一个完整的帧
+async def read_frame(reader):
+    _, frame_type, length = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    return frame_type, await reader.readexactly(length)
+
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    samples = sorted(samples)
+
+    def pick(p):
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+    return {
+        'count': len(samples),
+        'p50_us': round(pick(0.5) / 1000, 1),
+        'p99_us': round(pick(0.99) / 1000, 1),
+        'p999_us': round(pick(0.999) / 1000, 1),
+        'max_us': round(samples[-1] / 1000, 1),
+    }
+
+
+class Bench(object):
+    """
+    一次性能测试:临时数据库 + 服务器子进程 + 各个测试场景
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.db_dir = tempfile.mkdtemp(prefix='translucent-bench-')
+        self.db_file = os.path.join(self.db_dir, 'cfg.sqlite3')
+        self.db = DB(self.db_file)
+        self.db.initConfigTable()
+        # --config指定的配置项先写入,优先于下面的测试默认值
+        for option in args.config:
+            name, _, value = option.partition('=')
+            self.db.insert_default_config(name, value)
+        for name, value in (('tcpMode', args.engine),
+                            ('tcpWorkers', args.workers if args.engine == 'cluster' else 1),
+                            # 心跳包会混入透传数据,测试时关闭
+                            ('heartbeatInterval', 0), ('idleTimeout', 0),
+                            ('offlineSpoolDir', os.path.join(self.db_dir, 'spool'))):
+            self.db.insert_default_config(name, str(value))
+        self.next_device = 0
+        self.process = None
+        self.tls_port = 0
+        # 设备通过TLS连接时使用的上下文,不验证自签名证书
+        self.client_context = None
+        if args.tls:
+            cert_file, key_file = create_certificate(self.db_dir)
+            self.db.insert_default_config('tlsCertFile', cert_file)
+            self.db.insert_default_config('tlsKeyFile', key_file)
+            self.client_context = ssl.create_default_context()
+            self.client_context.check_hostname = False
+            self.client_context.verify_mode = ssl.CERT_NONE
+
+    # 批量添加设备,返回[(device_id, username)]
+    def add_devices(self, count, protocol='tcpServer'):
+        rows = []
+        for _ in range(count):
+            self.next_device += 1
+            rows.append((f'bench{self.next_device}', protocol, f'u{self.next_device}', 'p'))
+        with self.db.pool.connection() as conn:
+            conn.executemany('INSERT INTO devices (note, protocol, username, password) VALUES (?, ?, ?, ?)', rows)
+            return conn.execute('SELECT id, username FROM devices WHERE note IN (%s) ORDER BY id' %
+                                ','.join('?' * len(rows)), [row[0] for row in rows]).fetchall()
+
+    def add_passthrough(self, pairs, offline_buffer=0):
+        with self.db.pool.connection() as conn:
+            conn.executemany('INSERT INTO passthrough (device_a_id, device_b_id, offline_buffer) VALUES (?, ?, ?)',
+                             [(a, b, offline_buffer) for a, b in pairs])
+
+    # 在子进程中启动服务器,等待端口可以连接
+    def start_server(self):
+        # 每次启动换新的端口,上一次的连接可能还处于TIME_WAIT状态
+        self.tcp_port = get_free_port()
+        self.udp_port = get_free_port(socket.SOCK_DGRAM)
+        if self.args.tls:
+            self.tls_port = get_free_port()
+        with self.db.pool.connection() as conn:
+            conn.execute('DELETE FROM config WHERE name IN ("tcpPort", "udpPort", "tlsPort")')
+            conn.executemany('INSERT INTO config (name, value) VALUES (?, ?)',
+                             [('tcpPort', str(self.tcp_port)), ('udpPort', str(self.udp_port)),
+                              ('tlsPort', str(self.tls_port))])
+        self.process = multiprocessing.Process(target=run_server, args=(self.args.engine, self.db_file,
+                                                                        self.args.workers, self.args.verbose))
+        self.process.start()
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', self.tls_port or self.tcp_port), timeout=0.5).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError('服务器启动超时')
+
+    # 服务器子进程在独立的进程组中,连同多进程模式的工作进程一起结束
+    def stop_server(self):
+        if self.process is None:
+            return
+        if hasattr(os, 'killpg'):
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        self.process.kill()
+        self.process.join()
+        self.process = None
+
+    # 连接服务器,--tls时连接TLS端口
+    async def open_device(self):
+        if self.args.tls:
+            return await asyncio.open_connection('127.0.0.1', self.tls_port, ssl=self.client_context)
+        return await asyncio.open_connection('127.0.0.1', self.tcp_port)
+
+    # 帧协议登录,等待服务器的应答帧
+    async def login_framed(self, username):
+        reader, writer = await self.open_device()
+        writer.write(pack_frame(LOGIN, f'username:{username}.password:p'.encode()))
+        frame_type, payload = await read_frame(reader)
+        if frame_type != ACK or payload != b'loginSuccess':
+            raise RuntimeError(f'{username} 登录失败')
+        return reader, writer
+
+    # 加密模式登录,返回(reader, writer, 会话加密对象)
+    async def login_cipher(self, username):
+        reader, writer = await self.open_device()
+        client_nonce = os.urandom(NONCE_SIZE)
+        writer.write(pack_frame(LOGIN, f'username:{username}.cipher:{client_nonce.hex()}'.encode()))
+        _, server_nonce = await read_frame(reader)
+        master = derive_master(hashlib.sha256(b'p').digest(), client_nonce, server_nonce)
+        writer.write(pack_frame(AUTH, auth_proof(master)))
+        frame_type, payload = await read_frame(reader)
+        if frame_type != ACK or payload != b'loginSuccess':
+            raise RuntimeError(f'{username} 加密登录失败')
+        return reader, writer, SessionCipher(master, server_side=False)
+
+    # 依次以帧协议登录多个设备,收到应答帧时设备已关联到连接,之后发送的数据不会因为目标设备还在登录而丢失
+    async def login_devices(self, usernames):
+        return [await self.login_framed(username) for username in usernames]
+
+    # 登录风暴:大量设备同时连接并登录
+    async def login_storm(self):
+        devices = self.add_devices(self.args.devices)
+        self.restart_server()
+        latencies = []
+
+        # 同时进行的登录数,超过服务器的listen队列长度时多出的连接要等待SYN重传
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def one(username):
+            async with semaphore:
+                start = time.perf_counter_ns()
+                connection = await self.login_framed(username)
+                latencies.append(time.perf_counter_ns() - start)
+                return connection
+
+        start = time.perf_counter()
+        connections = await asyncio.gather(*[one(username) for _, username in devices])
+        elapsed = time.perf_counter() - start
+        for _, writer in connections:
+            writer.close()
+        result = {'devices': len(devices), 'concurrency': self.args.concurrency, 'seconds': round(elapsed, 3),
+                  'logins_per_second': round(len(devices) / elapsed, 1)}
+        result.update(percentiles(latencies))
+        return result
+
+    # 一对一透传组持续发送
+    async def stream(self):
+        (a_id, a_name), (b_id, b_name) = self.add_devices(2)
+        self.add_passthrough([(a_id, b_id)])
+        self.restart_server()
+        # 保留所有连接的引用,StreamWriter被回收时会关闭连接
+        connections = await self.login_devices([a_name, b_name])
+        a = connections[0][1]
+        b = connections[1][0]
+        size = self.args.size
+        total = size * self.args.messages
+        chunk = b'x' * size
+
+        async def receive():
+            received = 0
+            while received < total:
+                frame_type, payload = await read_frame(b)
+                if frame_type == DATA:
+                    received += len(payload)
+            return received
+
+        receiver = asyncio.ensure_future(receive())
+        start = time.perf_counter()
+        frame = pack_frame(DATA, chunk)
+        for _ in range(self.args.messages):
+            a.write(frame)
+            await a.drain()
+        received = await asyncio.wait_for(receiver, self.args.timeout)
+        elapsed = time.perf_counter() - start
+        return {'message_size': size, 'messages': self.args.messages, 'received_bytes': received,
+                'seconds': round(elapsed, 3), 'msgs_per_second': round(self.args.messages / elapsed, 1),
+                'mb_per_second': round(received / elapsed / 1e6, 2)}
+
+    # 限速:透传组限速为--shape-rate字节/秒,设备A尽快发送--duration秒,统计设备B实际收到的速度
+    async def shaped_stream(self):
+        (a_id, a_name), (b_id, b_name) = self.add_devices(2)
+        with self.db.pool.connection() as conn:
+            conn.execute('INSERT INTO passthrough (device_a_id, device_b_id, rate_bytes) VALUES (?, ?, ?)',
+                         (a_id, b_id, self.args.shape_rate))
+        self.restart_server()
+        connections = await self.login_devices([a_name, b_name])
+        a = connections[0][1]
+        b = connections[1][0]
+        chunk = b'x' * self.args.size
+        received = 0
+
+        async def receive():
+            nonlocal received
+            while True:
+                frame_type, payload = await read_frame(b)
+                if frame_type == DATA:
+                    received += len(payload)
+
+        receiver = asyncio.ensure_future(receive())
+        start = time.perf_counter()
+        deadline = start + self.args.duration
+        frame = pack_frame(DATA, chunk)
+        # 服务器暂停读取后发送缓冲区会满,drain等到测试结束为止
+        while time.perf_counter() < deadline:
+            a.write(frame)
+            try:
+                await asyncio.wait_for(a.drain(), deadline - time.perf_counter())
+            except asyncio.TimeoutError:
+                break
+        elapsed = time.perf_counter() - start
+        receiver.cancel()
+        # 令牌桶开始时有1秒的突发额度
+        return {'limit_bytes_per_second': self.args.shape_rate, 'seconds': round(elapsed, 3),
+                'received_bytes': received, 'bytes_per_second': round(received / elapsed, 1),
+                'expected_bytes': round(self.args.shape_rate * (elapsed + 1))}
+
+    # 离线缓存:目标设备不在线时缓存数据的速度,以及目标设备上线后收完所有补发数据的耗时
+    async def offline_replay(self):
+        (a_id, a_name), (b_id, b_name) = self.add_devices(2)
+        self.add_passthrough([(a_id, b_id)], offline_buffer=1)
+        size = self.args.size
+        messages = self.args.messages
+        total = size * messages
+        self.db.insert_default_config('offlineMaxMessages', str(messages))
+        self.db.insert_default_config('offlineMaxBytes', str(total))
+        self.restart_server()
+        _, a = await self.login_framed(a_name)
+        frame = pack_frame(DATA, b'x' * size)
+        start = time.perf_counter()
+        for _ in range(messages):
+            a.write(frame)
+            await a.drain()
+        buffer_elapsed = time.perf_counter() - start
+        # 等服务器处理完接收缓冲区中的数据
+        await asyncio.sleep(1)
+
+        start = time.perf_counter()
+        b, b_writer = await self.open_device()
+        b_writer.write(f'username:{b_name}.password:p'.encode())
+        received = 0
+        while received < total:
+            data = await asyncio.wait_for(b.read(1 << 20), self.args.timeout)
+            if not data:
+                break
+            received += len(data)
+        replay_elapsed = time.perf_counter() - start
+        a.close()
+        b_writer.close()
+        return {'message_size': size, 'messages': messages, 'received_bytes': received,
+                'buffer_msgs_per_second': round(messages / buffer_elapsed, 1),
+                'replay_seconds': round(replay_elapsed, 3),
+                'replay_mb_per_second': round(received / replay_elapsed / 1e6, 2)}
+
+    # 一个进程中运行大量AsyncTCPClient(一半发送一半接收),统计全部登录的耗时、转发速度和每个客户端占用的内存
+    async def client_sessions(self):
+        devices = self.add_devices(self.args.clients // 2 * 2)
+        self.add_passthrough([(devices[i][0], devices[i + 1][0]) for i in range(0, len(devices), 2)])
+        self.restart_server()
+        messages = 100
+        record = b'x' * self.args.record_size
+        total = len(devices) // 2 * messages * len(record)
+        received = [0]
+
+        def on_message(data):
+            received[0] += len(data)
+
+        before = get_rss(os.getpid())
+        port = self.tls_port or self.tcp_port
+        start = time.perf_counter()
+        clients = [AsyncTCPClient('127.0.0.1', port, username, 'p', framed=True, on_message=on_message,
+                                  min_backoff=0.05, max_backoff=1, ssl=self.client_context).start()
+                   for _, username in devices]
+        while not all(client.is_connected() for client in clients):
+            await asyncio.sleep(0.01)
+        login_elapsed = time.perf_counter() - start
+        after = get_rss(os.getpid())
+
+        start = time.perf_counter()
+        for client in clients[0::2]:
+            for _ in range(messages):
+                client.send(record)
+        while received[0] < total:
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        await asyncio.gather(*(client.close() for client in clients))
+        result = {'clients': len(clients), 'login_seconds': round(login_elapsed, 3),
+                  'logins_per_second': round(len(clients) / login_elapsed, 1),
+                  'messages': len(clients) // 2 * messages, 'seconds': round(elapsed, 3),
+                  'msgs_per_second': round(len(clients) // 2 * messages / elapsed, 1)}
+        if before is not None and after is not None:
+            result['client_bytes_per_session'] = round((after - before) / len(clients))
+        return result
+
+    # 固定速率发送小包,统计转发延迟
+    async def latency(self):
+        (a_id, a_name), (b_id, b_name) = self.add_devices(2)
+        self.add_passthrough([(a_id, b_id)])
+        self.restart_server()
+        # 保留所有连接的引用,StreamWriter被回收时会关闭连接
+        connections = await self.login_devices([a_name, b_name])
+        a = connections[0][1]
+        b = connections[1][0]
+        record_size = max(self.args.record_size, RECORD_HEADER.size)
+        padding = b'\0' * (record_size - RECORD_HEADER.size)
+        count = int(self.args.rate * self.args.duration)
+        latencies = []
+
+        async def receive():
+            while len(latencies) < count:
+                frame_type, payload = await read_frame(b)
+                if frame_type != DATA:
+                    continue
+                now = time.perf_counter_ns()
+                # 每个数据帧是一条记录
+                sent_time, _ = RECORD_HEADER.unpack_from(payload)
+                latencies.append(now - sent_time)
+
+        receiver = asyncio.ensure_future(receive())
+        await self.send_paced(count, lambda seq: a.write(
+            pack_frame(DATA, RECORD_HEADER.pack(time.perf_counter_ns(), seq) + padding)))
+        try:
+            await asyncio.wait_for(receiver, self.args.timeout)
+        except asyncio.TimeoutError:
+            pass
+        result = {'rate': self.args.rate, 'record_size': record_size, 'sent': count, 'lost': count - len(latencies)}
+        result.update(percentiles(latencies))
+        return result
+
+    # 按设定速率发送,每毫秒发送一批
+    async def send_paced(self, count, send):
+        start = time.perf_counter()
+        seq = 0
+        while seq < count:
+            due = min(count, int((time.perf_counter() - start) * self.args.rate) + 1)
+            while seq < due:
+                send(seq)
+                seq += 1
+            await asyncio.sleep(0.001)
+
+    # 一对多透传组
+    async def fanout(self):
+        devices = self.add_devices(self.args.fanout + 1)
+        source_id, source_name = devices[0]
+        self.add_passthrough([(source_id, target_id) for target_id, _ in devices[1:]])
+        self.restart_server()
+        connections = await self.login_devices([username for _, username in devices])
+        source = connections[0][1]
+        size = self.args.size
+        messages = self.args.messages // self.args.fanout or 1
+        total = size * messages
+        chunk = b'x' * size
+
+        async def receive(reader):
+            received = 0
+            while received < total:
+                frame_type, payload = await read_frame(reader)
+                if frame_type == DATA:
+                    received += len(payload)
+            return received
+
+        receivers = asyncio.gather(*[receive(reader) for reader, _ in connections[1:]])
+        start = time.perf_counter()
+        frame = pack_frame(DATA, chunk)
+        for _ in range(messages):
+            source.write(frame)
+            await source.drain()
+        received = sum(await asyncio.wait_for(receivers, self.args.timeout))
+        elapsed = time.perf_counter() - start
+        return {'targets': self.args.fanout, 'message_size': size, 'messages': messages,
+                'delivered_bytes': received, 'seconds': round(elapsed, 3),
+                'delivered_msgs_per_second': round(messages * self.args.fanout / elapsed, 1),
+                'delivered_mb_per_second': round(received / elapsed / 1e6, 2)}
+
+    # 空闲连接占用的内存
+    async def idle_memory(self):
+        devices = self.add_devices(self.args.idle)
+        self.restart_server()
+        # 服务器已开始监听,等多进程模式的其他工作进程也完成启动后再统计内存
+        await asyncio.sleep(0.5)
+        before = get_rss(self.process.pid)
+        # 每个设备都收到登录应答后再统计,不需要额外等待
+        connections = await self.login_devices([username for _, username in devices])
+        after = get_rss(self.process.pid)
+        for _, writer in connections:
+            writer.close()
+        if before is None or after is None:
+            return {'connections': len(devices), 'rss_bytes': None}
+        return {'connections': len(devices), 'rss_before_bytes': before, 'rss_after_bytes': after,
+                'bytes_per_connection': round((after - before) / len(devices))}
+
+    # UDP一对一透传组转发延迟
+    async def udp_latency(self):
+        (a_id, a_name), (b_id, b_name) = self.add_devices(2, 'udpServer')
+        self.add_passthrough([(a_id, b_id)])
+        self.restart_server()
+        loop = asyncio.get_running_loop()
+        received = asyncio.Queue()
+
+        class Receiver(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                received.put_nowait((time.perf_counter_ns(), data))
+
+        endpoints = []
+        for username in (a_name, b_name):
+            transport, _ = await loop.create_datagram_endpoint(Receiver, remote_addr=('127.0.0.1', self.udp_port))
+            # UDP服务器在TCP服务器之后启动,没有回复时重发登录包
+            reply = None
+            for _ in range(25):
+                transport.sendto(f'username:{username}.password:p'.encode())
+                try:
+                    _, reply = await asyncio.wait_for(received.get(), 0.2)
+                    break
+                except asyncio.TimeoutError:
+                    pass
+            if reply != b'loginSuccess':
+                raise RuntimeError(f'{username} 登录失败')
+            endpoints.append(transport)
+        a, b = endpoints
+        record_size = max(self.args.record_size, RECORD_HEADER.size)
+        padding = b'\0' * (record_size - RECORD_HEADER.size)
+        count = int(self.args.rate * self.args.duration)
+        latencies = []
+
+        async def receive():
+            while len(latencies) < count:
+                now, data = await received.get()
+                sent_time, _ = RECORD_HEADER.unpack_from(data)
+                latencies.append(now - sent_time)
+
+        receiver = asyncio.ensure_future(receive())
+        await self.send_paced(count, lambda seq: a.sendto(RECORD_HEADER.pack(time.perf_counter_ns(), seq) + padding))
+        try:
+            await asyncio.wait_for(receiver, 2)
+        except asyncio.TimeoutError:
+            pass
+        for transport in endpoints:
+            transport.close()
+        result = {'rate': self.args.rate, 'record_size': record_size, 'sent': count, 'lost': count - len(latencies)}
+        result.update(percentiles(latencies))
+        return result
+
+    # TLS握手耗时:完整握手与用会话票据恢复的握手,各连接一次并完成登录
+    async def tls_handshake(self):
+        if not self.args.tls:
+            return {'skipped': '需要--tls'}
+        (_, username), = self.add_devices(1)
+        self.restart_server()
+        count = min(self.args.devices, 200)
+
+        def connect(session):
+            start = time.perf_counter_ns()
+            sock = self.client_context.wrap_socket(socket.create_connection(('127.0.0.1', self.tls_port)),
+                                                   session=session)
+            sock.sendall(pack_frame(LOGIN, f'username:{username}.password:p'.encode()))
+            # 读到应答帧时TLS1.3的会话票据也已经收到
+            response = b''
+            while len(response) < FRAME_HEADER.size + len(b'loginSuccess'):
+                response += sock.recv(64)
+            elapsed = time.perf_counter_ns() - start
+            session, reused, version = sock.session, sock.session_reused, sock.version()
+            sock.close()
+            return elapsed, session, reused, version
+
+        def run():
+            full = []
+            resumed = []
+            reused_count = 0
+            _, session, _, version = connect(None)
+            for _ in range(count):
+                # 等服务器处理完上一个连接的断开,同一设备才能再次登录
+                time.sleep(0.005)
+                elapsed, _, _, _ = connect(None)
+                full.append(elapsed)
+                time.sleep(0.005)
+                elapsed, session, reused, _ = connect(session)
+                resumed.append(elapsed)
+                reused_count += reused
+            return full, resumed, reused_count, version
+
+        full, resumed, reused_count, version = await asyncio.get_running_loop().run_in_executor(None, run)
+        return {'connections': count, 'resumed': reused_count, 'tls_version': version,
+                'full_handshake': percentiles(full), 'resumed_handshake': percentiles(resumed)}
+
+    # 帧协议一对一透传:明文帧与加密模式帧的吞吐量对比,加密模式包括设备端加解密的开销
+    async def cipher_stream(self):
+        return {'plain': await self.framed_stream(False), 'cipher': await self.framed_stream(True)}
+
+    async def framed_stream(self, cipher):
+        (a_id, a_name), (b_id, b_name) = self.add_devices(2)
+        self.add_passthrough([(a_id, b_id)])
+        self.restart_server()
+        if cipher:
+            _, a, a_cipher = await self.login_cipher(a_name)
+            b, b_writer, b_cipher = await self.login_cipher(b_name)
+        else:
+            _, a = await self.login_framed(a_name)
+            b, b_writer = await self.login_framed(b_name)
+        size = self.args.size
+        messages = self.args.messages
+        chunk = b'x' * size
+
+        async def receive():
+            received = 0
+            for _ in range(messages):
+                frame_type, payload = await read_frame(b)
+                if frame_type == DATA:
+                    received += len(b_cipher.decrypt(payload) if cipher else payload)
+            return received
+
+        receiver = asyncio.ensure_future(receive())
+        start = time.perf_counter()
+        for _ in range(messages):
+            a.write(pack_frame(DATA, a_cipher.encrypt(chunk) if cipher else chunk))
+            await a.drain()
+        received = await asyncio.wait_for(receiver, self.args.timeout)
+        elapsed = time.perf_counter() - start
+        a.close()
+        b_writer.close()
+        return {'message_size': size, 'messages': messages, 'received_bytes': received,
+                'seconds': round(elapsed, 3), 'msgs_per_second': round(messages / elapsed, 1),
+                'mb_per_second': round(received / elapsed / 1e6, 2)}
+
+    # 每个场景使用新启动的服务器,启动时加载本场景新增的设备和透传组,各场景互不影响
+    def restart_server(self):
+        self.stop_server()
+        self.start_server()
+
+    async def run(self, scenarios):
+        results = {}
+        for name in scenarios:
+            print(f'运行 {name} ...')
+            try:
+                results[name] = await asyncio.wait_for(getattr(self, name)(), self.args.timeout)
+            except Exception as e:
+                results[name] = {'error': repr(e)}
+            print(f'  {json.dumps(results[name], ensure_ascii=False)}')
+        self.stop_server()
+        return results
+
+
+# 服务器子进程入口
+def run_server(engine, db_file, workers, verbose):
+    if hasattr(os, 'setsid'):
+        os.setsid()
+    raise_nofile_limit()
+    from log import setup_logging
+    setup_logging('INFO' if verbose else 'ERROR', '')
+    from tcpAsyncModule import AsyncTCPServer
+    from tcpClusterModule import TCPCluster
+    from tcpModule import TCPServer
+    from udpModule import UDPServer
+    if engine == 'cluster':
+        tcp_server = TCPCluster(db_file, workers=workers)
+    elif engine == 'async':
+        tcp_server = AsyncTCPServer(db_file)
+    else:
+        tcp_server = TCPServer(db_file)
+    tcp_server.start()
+    udp_server = UDPServer(db_file)
+    udp_server.start()
+    # 保持服务器对象的引用,多进程模式的共享内存随对象释放
+    threading.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='透传服务器性能测试')
+    parser.add_argument('--engine', choices=('thread', 'async', 'cluster'), default='thread')
+    parser.add_argument('--workers', type=int, default=2, help='cluster引擎的工作进程数')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='逗号分隔的测试场景')
+    parser.add_argument('--devices', type=int, default=500, help='登录风暴的设备数')
+    parser.add_argument('--concurrency', type=int, default=50, help='登录风暴同时进行的登录数')
+    parser.add_argument('--idle', type=int, default=1000, help='空闲连接数')
+    parser.add_argument('--clients', type=int, default=1000, help='client_sessions场景的客户端数')
+    parser.add_argument('--fanout', type=int, default=8, help='一对多的目标设备数')
+    parser.add_argument('--messages', type=int, default=20000, help='吞吐量测试的消息数')
+    parser.add_argument('--size', type=int, default=1024, help='吞吐量测试的消息长度')
+    parser.add_argument('--rate', type=int, default=5000, help='延迟测试每秒发送的消息数')
+    parser.add_argument('--duration', type=float, default=3, help='延迟测试的秒数')
+    parser.add_argument('--record-size', type=int, default=64, help='延迟测试的消息长度')
+    parser.add_argument('--shape-rate', type=int, default=1000000, help='限速测试透传组每秒的字节数')
+    parser.add_argument('--timeout', type=float, default=60, help='单个场景的超时秒数')
+    parser.add_argument('--output', help='结果JSON文件')
+    parser.add_argument('--tls', action='store_true', help='设备通过TLS连接(thread引擎不支持)')
+    parser.add_argument('--verbose', action='store_true', help='显示服务器日志')
+    parser.add_argument('--config', action='append', default=[], metavar='NAME=VALUE',
+                        help='服务器配置项,可以指定多次,如 --config loginRate=0')
+    args = parser.parse_args()
+
+    scenarios = [name for name in args.scenarios.split(',') if name]
+    for name in scenarios:
+        if name not in SCENARIOS:
+            parser.error(f'未知的测试场景 {name}')
+
+    raise_nofile_limit()
+    bench = Bench(args)
+    try:
+        results = asyncio.run(bench.run(scenarios))
+    finally:
+        bench.stop_server()
+
+    report = {
+        'engine': args.engine,
+        'workers': args.workers if args.engine == 'cluster' else 1,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'options': vars(args),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f'结果已保存到 {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Timer(object):
+    """
+    时间轮中的一个定时任务
+    """
+
+    def __init__(self, rounds, callback, args):
+        # 还需要转几圈才到期
+        self.rounds = rounds
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    # 取消定时任务,下次轮到所在槽位时丢弃
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel(object):
+    """
+    哈希时间轮,所有设备的心跳包和空闲超时都放在同一个轮子里,
+    由一个线程(线程模式)或事件循环的一个定时器(异步模式)每个tick推进一格,
+    添加/取消定时任务都是O(1),每个tick只处理一个槽位
+    """
+
+    def __init__(self, tick=0.1, slots=512):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = 0
+        self.lock = threading.Lock()
+
+    # 添加定时任务,delay秒后在推进时间轮的线程中调用callback(*args)
+    def schedule(self, delay, callback, *args):
+        ticks = max(1, int(round(delay / self.tick)))
+        timer = Timer((ticks - 1) // len(self.slots), callback, args)
+        with self.lock:
+            self.slots[(self.current + ticks) % len(self.slots)].append(timer)
+        return timer
+
+    # 推进一格,执行到期的定时任务
+    def advance(self):
+        due = []
+        with self.lock:
+            self.current = (self.current + 1) % len(self.slots)
+            pending = []
+            for timer in self.slots[self.current]:
+                if timer.cancelled:
+                    continue
+                if timer.rounds:
+                    timer.rounds -= 1
+                    pending.append(timer)
+                else:
+                    due.append(timer)
+            self.slots[self.current] = pending
+        for timer in due:
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                logger.exception('定时任务执行错误:%s', e)
+
+    # 线程模式下在独立线程中运行
+    def run(self):
+        next_time = time.monotonic() + self.tick
+        while True:
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.advance()
+            next_time += self.tick
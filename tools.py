@@ -1,11 +1,21 @@
 import datetime
+import time
 
 
 class Tools:
 
     def __init__(self):
-        pass
+        # (秒, 格式化后的日期时间),同一秒内只格式化一次
+        self.cache = (None, '')
 
     def get_current_time(self):
-        now = datetime.datetime.now()
-        return now.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+        return self.format_time(time.time())
+
+    # 格式化时间戳,精确到毫秒
+    def format_time(self, timestamp):
+        second = int(timestamp)
+        cached_second, text = self.cache
+        if second != cached_second:
+            text = datetime.datetime.fromtimestamp(second).strftime("%Y-%m-%d %H:%M:%S")
+            self.cache = (second, text)
+        return f"{text}.{int((timestamp - second) * 1000):03d}"
@@ -1,125 +1,323 @@
-import sqlite3
-import threading
+import logging
+import selectors
 import socket
+import threading
+import time
 
+from config_store import ConfigStore
+from credentials import CredentialIndex
+from databases.DB import DEFAULT_DB_FILE, get_pool
+from log import ThrottledLogger
+from metrics import MetricsRegistry
+from presence import PresenceRegistry
+from routing import SOURCE_HEADER, RoutingTable
+from tcpModule import LISTENER_DRAIN_TIME
 
-def start_udp_server():
-    # 连接到SQLite数据库
-    conn = sqlite3.connect('cfg.sqlite3', check_same_thread=False)
-    cursor = conn.cursor()
+logger = logging.getLogger(__name__)
+# 每包数据都可能触发的日志按设备限制输出频率
+throttled = ThrottledLogger(logger)
 
-    # 获取数据库中的端口号
-    cursor.execute('SELECT value FROM config WHERE name="udpPort"')
-    udp_port = int(cursor.fetchone()[0])
 
-    # 创建字典用于存储设备连接
-    device_connections = {}
+class UDPServer(object):
+    """
+    UDP透传服务器,一个socket、一个线程处理所有设备
+    会话表以设备地址(ip, port)为键,收到数据时O(1)找到发送方设备
+    """
 
-    # 创建锁对象用于线程同步
-    lock = threading.Lock()
+    def __init__(self, db_file=DEFAULT_DB_FILE, routing=None, credentials=None, metrics=None, config=None):
+        # 数据库文件位置
+        self.db_file = db_file
 
-    # 函数用于处理客户端连接
-    def handle_client_connection(client_socket, address):
-        device_id = None
-        while True:
-            try:
-                data = client_socket.recv(1024).decode()
-                if not data:
-                    break
-                device_id = get_device_id_by_address(address)
-                if address not in device_connections.values():  # 未登录状态
-                    # 解析接收到的消息
-                    if data.startswith("username:") and data.count(".") == 1:
-                        username, password = data.split(".")
-                        username = username.split(":")[1]
-                        password = password.split(":")[1]
-
-                        # 根据用户名和密码验证登录
-                        if verify_credentials(username, password):
-                            device_id = username  # 使用username作为设备ID
-                            add_device_connection(device_id, address)
-                            send_response(client_socket, 'loginSuccess')
-                            print(f" {address} ")
-                            print(f"设备 {device_id} 登录成功！")
-                        else:
-                            send_response(client_socket, 'loginFailed')
-                            print(f"设备登录失败！")
-                    else:
-                        send_response(client_socket, 'loginRequired')
-                else:  # 登录状态
-                    # 打印接收到的消息
-                    print(f" {address} ")
-                    print(f"收到设备 {device_id} 的消息: {data}")
-
-                    # 转发消息给其他设备
-                    forward_message(device_id, data)
+        # 配置项,与TCP服务器和web管理页面共用
+        self.config = config if config is not None else ConfigStore(db_file)
+
+        # 透传路由表,与TCP服务器和web管理页面共用
+        self.routing = routing if routing is not None else RoutingTable(db_file)
+
+        # 设备登录信息索引,与TCP服务器和web管理页面共用
+        self.credentials = credentials if credentials is not None else CredentialIndex(db_file)
+
+        # 设备在线状态,以内存为准,定时批量写入数据库
+        self.presence = PresenceRegistry(db_file)
+
+        # 转发统计,与TCP服务器和web管理页面共用
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+
+        # 与web管理页面共用的数据库连接池
+        self.db_pool = get_pool(db_file)
+
+        # 会话表 (ip, port) -> device_id
+        self.sessions = {}
+        # 设备当前地址 device_id -> (ip, port)
+        self.device_addresses = {}
+        # 最后一次收到设备数据的时间 device_id -> time
+        self.last_seen = {}
+        # 设备登录时使用的socket (ip, port) -> socket,修改端口后还在旧端口上的设备继续从旧端口收发
+        self.address_sockets = {}
+        # 正在处理的数据包是从哪个socket收到的
+        self.receiving_socket = None
+        # 等待切换的新端口,在接收线程中处理
+        self.rebind_port = None
+        # 旧端口的socket -> 最早关闭的时间,到期且没有设备还在使用时关闭
+        self.draining = {}
+        # 平滑重启:从旧进程接管的socket 端口 -> socket,正在从旧进程接管,已经交给新进程停止接收
+        self.inherited = {}
+        self.takeover = False
+        self.stopped = False
+        self.serve_thread = None
+
+    # 读取config表中的配置项,不存在时返回默认值
+    def get_config(self, name, default=None):
+        return self.config.get(name, default)
+
+    def start(self):
+        # 获取数据库中的UDP端口号
+        udp_port = int(self.get_config('udpPort', '12347'))
+
+        # 会话超时(秒),超过这个时间没有收到设备的数据就认为设备离线
+        self.session_timeout = float(self.get_config('udpSessionTimeout', '60'))
+
+        # 每次可读时最多连续接收多少个数据包,减少select调用次数
+        self.batch_size = int(self.get_config('udpBatchSize', '64'))
+
+        # 接收缓冲区重复使用
+        self.buffer = bytearray(65535)
+        self.view = memoryview(self.buffer)
+
+        # 将所有协议类型为udpServer的设备设置为离线状态,从旧进程接管时只有接管的会话在线
+        if self.takeover:
+            self.presence.sync('udpServer')
+        else:
+            self.presence.reset('udpServer')
+        self.presence.start(float(self.get_config('presenceFlushInterval', '1')))
+
+        # 读取统计时提供在线状态
+        self.metrics.add_collector(self.collect_metrics)
+
+        # 启动UDP服务器,平滑重启时使用从旧进程接管的socket
+        self.server_socket = self.inherited.pop(udp_port, None)
+        if self.server_socket is None:
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.server_socket.bind(('0.0.0.0', udp_port))
+        self.server_socket.setblocking(False)
+
+        logger.info('UDP服务器正在监听端口 %s...', udp_port)
+
+        self.serve_thread = threading.Thread(target=self.serve)
+        self.serve_thread.start()
+
+        # 修改配置后不用重启
+        self.config.add_listener(self.on_config_change)
+        self.config.watch(float(self.get_config('configPollInterval', '1')))
+
+    # 配置修改后调用,超时和批量接收个数立即生效,端口修改交给接收线程处理
+    def on_config_change(self, names):
+        if 'udpSessionTimeout' in names:
+            self.session_timeout = float(self.get_config('udpSessionTimeout', '60'))
+        if 'udpBatchSize' in names:
+            self.batch_size = int(self.get_config('udpBatchSize', '64'))
+        if 'udpPort' in names:
+            self.rebind_port = int(self.get_config('udpPort', '12347'))
+
+    # 接收并处理所有设备的数据包
+    def serve(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.server_socket, selectors.EVENT_READ)
+        # 每隔会话超时时间的一半检查一次过期会话
+        next_check = time.monotonic() + self.session_timeout / 2
+        while not self.stopped:
+            for key, _ in selector.select(timeout=1):
+                self.receive_batch(key.fileobj)
+            now = time.monotonic()
+            if now >= next_check:
+                self.expire_sessions(now)
+                next_check = now + self.session_timeout / 2
+            if self.rebind_port is not None:
+                self.rebind(selector)
+            if self.draining:
+                self.close_drained(selector, now)
 
+    # 平滑重启:停止接收,返回交给新进程的会话 [(设备ID, 地址, 空闲秒数), ...];
+    # 还在旧端口上的设备不交出,会话超时后重新登录到新进程
+    def stop_serving(self):
+        self.stopped = True
+        self.serve_thread.join()
+        # 之前修改过的在线状态立即写入数据库,之后由新进程负责
+        self.presence.flush()
+        now = time.monotonic()
+        return [(device_id, address, now - self.last_seen[device_id])
+                for device_id, address in self.device_addresses.items()
+                if self.address_sockets.get(address, self.server_socket) is self.server_socket]
+
+    # 平滑重启:在启动前恢复旧进程交出的会话
+    def adopt_sessions(self, sessions):
+        now = time.monotonic()
+        for device_id, address, idle in sessions:
+            self.sessions[address] = device_id
+            self.device_addresses[device_id] = address
+            self.last_seen[device_id] = now - idle
+            self.update_device_online_status(device_id, 1)
+
+    # 修改端口:先绑定新端口,新登录的设备使用新端口,旧端口等还在使用它的设备都离线后再关闭
+    def rebind(self, selector):
+        udp_port, self.rebind_port = self.rebind_port, None
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            server_socket.bind(('0.0.0.0', udp_port))
+        except OSError as e:
+            server_socket.close()
+            logger.error('监听端口 %s 失败:%s,继续使用原来的端口', udp_port, e)
+            return
+        server_socket.setblocking(False)
+        selector.register(server_socket, selectors.EVENT_READ)
+        self.draining[self.server_socket] = time.monotonic() + LISTENER_DRAIN_TIME
+        self.server_socket = server_socket
+        logger.info('UDP服务器改为监听端口 %s', udp_port)
+
+    # 关闭到期且没有设备使用的旧端口
+    def close_drained(self, selector, now):
+        in_use = set(self.address_sockets.values())
+        for server_socket, deadline in list(self.draining.items()):
+            if now >= deadline and server_socket not in in_use:
+                selector.unregister(server_socket)
+                server_socket.close()
+                del self.draining[server_socket]
+
+    # 一次可读事件中连续接收多个数据包,直到socket中没有数据
+    def receive_batch(self, server_socket):
+        self.receiving_socket = server_socket
+        for _ in range(self.batch_size):
+            try:
+                size, address = server_socket.recvfrom_into(self.buffer)
+            except BlockingIOError:
+                return
+            except ConnectionResetError:
+                # Windows下对端端口不可达会收到这个错误,忽略
+                continue
+            try:
+                self.handle_datagram(self.view[:size], address)
             except Exception as e:
-                print(f"发生错误：{str(e)}")
-                break
-
-        # 关闭客户端连接
-        client_socket.close()
-        # 移除设备连接
-        remove_device_connection(device_id)
-
-    # 函数用于发送响应消息给客户端
-    def send_response(client_socket, message):
-        client_socket.sendto(message.encode(), client_address)
-
-    # 函数用于获取设备ID
-    def get_device_id_by_address(address):
-        with lock:
-            for device_id, client_address in device_connections.items():
-                if client_address == address:
-                    return device_id
-        return None
-
-    # 函数用于验证用户名和密码是否匹配
-    def verify_credentials(username, password):
-        # 获取数据库中的账号密码
-        cursor.execute('SELECT username, password FROM devices WHERE protocol="udpServer"')
-        credentials = cursor.fetchall()
-        for credential in credentials:
-            # if credential[0] == username and hashlib.sha256(password.encode()).hexdigest() == credential[1]:
-            if credential[0] == username and password == credential[1]:
-                return True
-        return False
-
-    # 函数用于添加设备连接到字典中
-    def add_device_connection(device_id, client_address):
-        with lock:
-            device_connections[device_id] = client_address
-
-    # 函数用于移除设备连接
-    def remove_device_connection(device_id):
-        with lock:
-            if device_id in device_connections:
-                del device_connections[device_id]
-
-    # 函数用于转发消息给其他设备
-    def forward_message(device_id, message):
-        cursor.execute('SELECT device_b_id FROM passthrough WHERE device_a_id=?', (device_id,))
-        target_device_ids = cursor.fetchall()
-        for target_device_id in target_device_ids:
-            target_device_id = target_device_id[0]
-            if target_device_id in device_connections:
-                target_address = device_connections[target_device_id]
-                server_socket.sendto(message.encode(), target_address)
-            else:
-                print(f"设备 {target_device_id} 不在线！")
+                throttled.warning(address, '设备 %s 发生错误:%s', address, e)
+
+    def handle_datagram(self, data, address):
+        device_id = self.sessions.get(address)
+        # 未登录的地址第一包数据为账号密码
+        if device_id is None:
+            self.login(bytes(data), address)
+            return
+        # 已登录的地址再次发送登录包(设备重启后重新登录)时重新验证并应答,不能当作数据转发出去
+        if data[:9] == b'username:' and b'.password:' in bytes(data):
+            self.login(bytes(data), address)
+            return
+        self.last_seen[device_id] = time.monotonic()
+        start = time.perf_counter()
+        self.forward_message(device_id, data, address)
+        self.metrics.record_received(device_id, 1, len(data), time.perf_counter() - start)
+
+    def login(self, data, address):
+        try:
+            data = data.decode()
+        except UnicodeDecodeError:
+            self.send_response('loginRequired', address)
+            return
+        if not data.startswith('username:') or '.password:' not in data:
+            self.send_response('loginRequired', address)
+            return
+
+        # 解析用户名和密码
+        username, password = self.parse_credentials(data)
+
+        # 验证用户名和密码
+        device_id = self.verify_credentials(username, password)
+        if device_id is None:
+            throttled.warning(address, '设备 %s %s 账号或密码不对!', address, username)
+            self.send_response('loginFailed', address)
+            return
 
-    # 创建UDP服务器
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    server_socket.bind(('0.0.0.0', udp_port))
+        # 同一个地址换了账号登录,原来的设备离线
+        previous_id = self.sessions.get(address)
+        if previous_id is not None and previous_id != device_id:
+            self.device_addresses.pop(previous_id, None)
+            self.last_seen.pop(previous_id, None)
+            self.update_device_online_status(previous_id, 0)
 
-    print(f"UDP服务器正在监听端口 {udp_port}...")
+        old_address = self.device_addresses.get(device_id)
+        if old_address is None:
+            self.update_device_online_status(device_id, 1)
+        else:
+            # 设备地址变化(NAT重新映射或设备重启),删除旧地址的会话
+            self.sessions.pop(old_address, None)
+            self.address_sockets.pop(old_address, None)
 
-    # 接收并处理客户端连接
-    while True:
-        data, client_address = server_socket.recvfrom(1024)
-        client_thread = threading.Thread(target=handle_client_connection, args=(server_socket, client_address))
-        client_thread.start()
+        self.sessions[address] = device_id
+        self.address_sockets[address] = self.receiving_socket
+        self.device_addresses[device_id] = address
+        self.last_seen[device_id] = time.monotonic()
+        self.metrics.record_login(device_id)
+        self.send_response('loginSuccess', address)
+        logger.info('设备 %s %s %s 登录成功!', address, device_id, username)
+
+    # 解析用户名和密码
+    def parse_credentials(self, data):
+        username_start = data.find("username:") + len("username:")
+        username_end = data.find(".password:")
+        username = data[username_start:username_end]
+
+        password_start = data.find("password:") + len("password:")
+        password = data[password_start:]
+
+        return username, password
+
+    # 验证用户名和密码,成功返回设备ID
+    def verify_credentials(self, username, password):
+        return self.credentials.verify('udpServer', username, password)
+
+    # 更新设备在线状态
+    def update_device_online_status(self, device_id, status):
+        self.presence.update(device_id, status)
+
+    # 删除超时没有数据的会话
+    def expire_sessions(self, now):
+        for device_id, last_seen in list(self.last_seen.items()):
+            if now - last_seen > self.session_timeout:
+                logger.info('设备 %s %s 会话超时,设为离线', self.device_addresses[device_id], device_id)
+                address = self.device_addresses.pop(device_id)
+                self.sessions.pop(address, None)
+                self.address_sockets.pop(address, None)
+                del self.last_seen[device_id]
+                self.update_device_online_status(device_id, 0)
+
+    # 统计收集函数:在线的udp设备
+    def collect_metrics(self):
+        return {'devices': {device_id: {'online': 1} for device_id in list(self.device_addresses)}}
+
+    def send_response(self, message, address):
+        self.sendto(message.encode(), address)
+
+    # 从设备登录时使用的端口发送,还没有登录的设备从收到数据的端口回复
+    def sendto(self, data, address):
+        try:
+            self.address_sockets.get(address, self.receiving_socket or self.server_socket).sendto(data, address)
+        except OSError as e:
+            # 发送缓冲区满或地址不可达,UDP直接丢弃
+            throttled.warning(address, '发送到 %s 失败:%s', address, e)
+
+    # 转发消息给其他设备
+    def forward_message(self, device_id, message, address):
+        prefixed_ids = self.routing.get_prefixed_targets(device_id)
+        for target_device_id in self.routing.get_targets(device_id):
+            target_address = self.device_addresses.get(target_device_id)
+            if target_address is None:
+                throttled.warning((device_id, target_device_id), '设备 %s %s 消息转发失败,设备 %s 不在线!',
+                                  address, device_id, target_device_id)
+                continue
+            if target_device_id in prefixed_ids:
+                self.sendto(SOURCE_HEADER.pack(device_id, len(message)) + message, target_address)
+                self.metrics.record_forward(device_id, target_device_id, 1, SOURCE_HEADER.size + len(message))
+            else:
+                self.sendto(message, target_address)
+                self.metrics.record_forward(device_id, target_device_id, 1, len(message))
 
 # 在其他地方调用函数启动UDP服务器
-# start_udp_server()
+# udp_server = UDPServer()
+# udp_server.start()